@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Micro-benchmark of the parsing of the 8567_ internal notes: one call to
+each get_* helper of media_utils against a single parse_media_note call.
+
+Usage: python bench_media_note_parser.py [number of iterations]
+"""
+
+import sys
+import timeit
+
+from invenio.media_utils import get_dimension, get_video_bitrate, \
+     get_framerate, get_nb_audio_canal, get_audio_bitrate, \
+     get_audio_frequency, get_percentage, parse_media_note, MediaNoteInfo
+
+# (internal note, path) couples as found in weblecture and video records
+NOTES = [
+    ("Video 640x360, 25 fps, 700 kbps, audio 128 kbps, 44 kHz, stereo",
+     "http://mediaarchive.cern.ch/MediaArchive/Video/Public/Movies/CERN/2013/CERN-MOVIE-2013-001/CERN-MOVIE-2013-001-0753-kbps-640x360-25-fps-audio-128-kbps-44-kHz-stereo.mp4"),
+    ("Video 1280x720, 25 fps, 2000 kbps, audio 128 kbps, 48 kHz, stereo",
+     "http://mediaarchive.cern.ch/MediaArchive/Video/Public/Movies/CERN/2013/CERN-MOVIE-2013-001/CERN-MOVIE-2013-001-2128-kbps-1280x720-25-fps-audio-128-kbps-48-kHz-stereo.mp4"),
+    ("Posterframe 640x360 at 10 percent",
+     "http://mediaarchive.cern.ch/MediaArchive/Video/Public/Movies/CERN/2013/CERN-MOVIE-2013-001/CERN-MOVIE-2013-001-posterframe-640x360-at-10-percent.jpg"),
+    ("Thumbnail 90x90 at 50 percent",
+     "http://mediaarchive.cern.ch/MediaArchive/Video/Public/Movies/CERN/2013/CERN-MOVIE-2013-001/CERN-MOVIE-2013-001-thumbnail-90x90-at-50-percent.jpg"),
+    ("Audio only, audio 64 kbps, 22 kHz, mono",
+     "http://mediaarchive.cern.ch/MediaArchive/Video/Public/WebLectures/2013/123456/123456.mp3"),
+    ("", "http://mediaarchive.cern.ch/MediaArchive/Video/Public/WebLectures/2013/123456/123456-1920x1080.mp4"),
+]
+
+def parse_with_helpers(internal_note, path):
+    """Parses the note the way _construct_info_dict used to."""
+    return MediaNoteInfo(get_dimension(internal_note, path),
+                         get_video_bitrate(internal_note),
+                         get_framerate(internal_note),
+                         get_nb_audio_canal(internal_note),
+                         get_audio_bitrate(internal_note),
+                         get_audio_frequency(internal_note),
+                         get_percentage(internal_note))
+
+def run_helpers():
+    for internal_note, path in NOTES:
+        parse_with_helpers(internal_note, path)
+
+def run_parser():
+    for internal_note, path in NOTES:
+        parse_media_note(internal_note, path)
+
+def main():
+    number = 10000
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+
+    for internal_note, path in NOTES:
+        expected = parse_with_helpers(internal_note, path)
+        result = parse_media_note(internal_note, path)
+        if expected != result:
+            print "Mismatch for %r: %r != %r" % (internal_note, expected, result)
+            sys.exit(1)
+
+    helpers = min(timeit.repeat(run_helpers, number=number, repeat=3))
+    parser = min(timeit.repeat(run_parser, number=number, repeat=3))
+    notes = number * len(NOTES)
+    print "get_* helpers:    %.2f us/note" % (helpers * 1e6 / notes)
+    print "parse_media_note: %.2f us/note" % (parser * 1e6 / notes)
+    print "speedup:          %.2fx" % (helpers / parser)
+
+if __name__ == '__main__':
+    main()
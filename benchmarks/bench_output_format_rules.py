@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Benchmark of the choice of the format template of the records in the
+HB and HD output formats: linear scan of the rules (as BibFormat does)
+against the compiled rules (output_format_rules), on a synthetic corpus
+of records mixing the values of the rules and unknown values.
+
+The templates chosen both ways are also checked to be the same.
+
+Usage: python bench_output_format_rules.py [number of records]
+"""
+
+import random
+import re
+import sys
+import timeit
+
+from invenio.output_format_rules import parse_output_format, \
+     get_output_format_path, CompiledOutputFormat
+
+# Values of the records matching the regexp rules
+REGEXP_VALUES = {'970__a': ['FCS.project.1234', 'avw.project.56', 'AVW.PROJECT.7', 'INDICO.123'],
+                 '980__a': ['CERN_COURIER_2013', 'CERN_BULLETIN_12', 'ATLVN-2013-001',
+                            'cern_courier_digital']}
+# Fields without rules, read by the templates anyway
+UNKNOWN_VALUES = ['ARTICLE', 'PREPRINT', 'THESIS', 'ISOLDE', '99', 'NOTE']
+
+
+class RecordFields(object):
+    """Minimal BibFormatObject: the values of the fields of a record"""
+
+    def __init__(self, fields):
+        self._fields = fields
+        self.reads = 0
+
+    def fields(self, tag):
+        self.reads += 1
+        return self._fields.get(tag, [])
+
+    def control_field(self, tag):
+        self.reads += 1
+        return (self._fields.get(tag) or [''])[0]
+
+
+def generate_records(rules, nb_records):
+    """Returns records with one to three values from the rules of each field."""
+    rng = random.Random(42)
+    values = {}
+    for rule in rules:
+        if not re.search(r'[.*+?|\[(]', rule['value']):
+            values.setdefault(rule['field'], []).append(rule['value'].strip())
+    for (tag, regexp_values) in REGEXP_VALUES.items():
+        values.setdefault(tag, []).extend(regexp_values)
+    records = []
+    for dummy in xrange(nb_records):
+        fields = {}
+        for tag in values:
+            if rng.random() < 0.3:
+                fields[tag] = [rng.choice(values[tag]) for dummy in xrange(rng.randint(1, 3))]
+            elif rng.random() < 0.2:
+                fields[tag] = [rng.choice(UNKNOWN_VALUES)]
+        records.append(RecordFields(fields))
+    return records
+
+
+def decide_format_template(output_format, bfo):
+    """Chooses the template as bibformat_engine.decide_format_template."""
+    for rule in output_format['rules']:
+        if rule['field'].startswith('00'):
+            values = [bfo.control_field(rule['field']).strip()]
+        else:
+            values = bfo.fields(rule['field'])
+        if len(values) > 0:
+            for value in values:
+                value = value.strip()
+                pattern = rule['value'].strip()
+                match_obj = re.match(pattern, value, re.IGNORECASE)
+                if match_obj is not None and match_obj.end() == len(value):
+                    return rule['template']
+    return output_format['default'] or None
+
+
+def main():
+    nb_records = 10000
+    if len(sys.argv) > 1:
+        nb_records = int(sys.argv[1])
+
+    for of in ('HB', 'HD'):
+        output_format = parse_output_format(get_output_format_path(of))
+        compiled = CompiledOutputFormat(output_format)
+        records = generate_records(output_format['rules'], nb_records)
+
+        for record in records:
+            if decide_format_template(output_format, record) != compiled.decide_format_template(record):
+                print "Different templates for %s" % record._fields
+                sys.exit(1)
+
+        for record in records:
+            record.reads = 0
+        linear = min(timeit.repeat(lambda: [decide_format_template(output_format, record)
+                                            for record in records], number=1, repeat=3))
+        linear_reads = sum([record.reads for record in records]) / 3.0 / nb_records
+        for record in records:
+            record.reads = 0
+        fast = min(timeit.repeat(lambda: [compiled.decide_format_template(record)
+                                          for record in records], number=1, repeat=3))
+        fast_reads = sum([record.reads for record in records]) / 3.0 / nb_records
+        print "%s (%s rules, %s records)" % (of, len(output_format['rules']), nb_records)
+        print "  linear:    %.1f us/record, %.1f field reads/record" % (linear * 1e6 / nb_records,
+                                                                       linear_reads)
+        print "  compiled:  %.1f us/record, %.1f field reads/record" % (fast * 1e6 / nb_records,
+                                                                       fast_reads)
+
+if __name__ == '__main__':
+    main()
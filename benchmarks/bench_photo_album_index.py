@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Benchmark of get_bibdoc_pictures_struct (BFE_CERN_PHOTO_RESOURCES) on
+synthetic albums of 10, 1000 and 10000 photos: the way it used to read
+the bibdocs (two BibRecDocs, the files of each bibdoc listed up to four
+times, the tirage found with list.index) against the album index
+(photo_album_index), built once then read from the cache.
+
+The bibdocs are simulated in memory, BibRecDocs.get_docname looking
+the bibdoc up in the bibdocs of the record (a query with bibdocfile).
+The pictures are also checked to be the same both ways.
+
+Usage: python bench_photo_album_index.py [--all]
+  --all  also time the former way on the album of 10000 photos (slow)
+"""
+
+import random
+import sys
+import time
+from operator import itemgetter
+
+from invenio.config import CFG_SITE_URL, CFG_ICON_CREATION_FORMAT_MAPPINGS
+from invenio.media_utils import alphanum
+from invenio.urlutils import create_html_link
+from invenio import photo_album_index
+from invenio.bibformat_elements import bfe_CERN_photo_resources
+
+ALBUM_SIZES = (10, 1000, 10000)
+# Sizes of the album at which the former way is only timed with --all
+SLOW_ALBUM_SIZE = 10000
+
+
+class BibDocFile(object):
+    def __init__(self, docname, format, subformat, size, hidden=False):
+        self.format = format
+        self.subformat = subformat
+        self.size = size
+        self.hidden = hidden
+        self.url = '%s/record/1/files/%s%s?subformat=%s' % (CFG_SITE_URL, docname, format, subformat)
+        self.description = subformat == '' and 'Photo %s' % docname or ''
+
+    def get_format(self): return self.subformat and '%s;%s' % (self.format, self.subformat) or self.format
+    def get_subformat(self): return self.subformat
+    def get_url(self): return self.url
+    def get_size(self): return self.size
+    def is_icon(self): return self.subformat.startswith('icon')
+    def hidden_p(self): return self.hidden
+    def get_description(self): return self.description
+    def get_comment(self): return ''
+
+
+class BibDoc(object):
+    def __init__(self, docid, docname, deleted, files):
+        self.id = docid
+        self.docname = docname
+        self.deleted = deleted
+        self.files = files
+
+    def get_id(self): return self.id
+    def get_type(self): return 'Main'
+    def deleted_p(self): return self.deleted
+    def list_latest_files(self): return list(self.files)
+    def format_already_exists_p(self, format):
+        return format in [docfile.format for docfile in self.files]
+
+
+class BibRecDocs(object):
+    albums = {}
+
+    def __init__(self, recid, deleted_too=False):
+        self.bibdocs = [bibdoc for bibdoc in self.albums[recid] if deleted_too or not bibdoc.deleted]
+
+    def list_bibdocs(self): return list(self.bibdocs)
+    def get_docname(self, docid):
+        for bibdoc in self.bibdocs:
+            if bibdoc.id == docid:
+                return bibdoc.docname
+
+
+class BibFormatObject(object):
+    def __init__(self, recid):
+        self.recID = recid
+
+    def field(self, tag):
+        return 'CERN-PHOTO-2013-%s' % self.recID
+
+
+def generate_album(nb_photos):
+    """Returns the bibdocs of an album, with a few deleted photos."""
+    rng = random.Random(nb_photos)
+    bibdocs = []
+    for i in xrange(nb_photos):
+        docname = 'CERN-PHOTO-2013-%s-%s' % (nb_photos, rng.randint(1, 10 * nb_photos))
+        files = [BibDocFile(docname, '.jpg', '', 3000000)]
+        for (subformat, size) in (('icon-180', 8000), ('icon-640', 60000), ('icon-1440', 300000)):
+            files.append(BibDocFile(docname, '.jpg', subformat, size))
+        rng.shuffle(files)
+        bibdocs.append(BibDoc(1000000 + i, docname, rng.random() < 0.05, files))
+    rng.shuffle(bibdocs)
+    return bibdocs
+
+
+def get_bibdoc_pictures_struct_one_by_one(bfo, submission_doctype):
+    """The pictures, computed the way get_bibdoc_pictures_struct used to."""
+    bibarchive = BibRecDocs(bfo.recID)
+    bibarchive_with_deleted = BibRecDocs(bfo.recID, deleted_too=True)
+    report_number = bfo.field('037__a')
+    if 'EVENTDISPLAY' in report_number and len(bibarchive.list_bibdocs()) > 1:
+        display_only_main = True
+    else:
+        display_only_main = False
+    doc_numbers = [(bibdoc.get_id(), bibarchive_with_deleted.get_docname(bibdoc.get_id()), bibdoc) for bibdoc in bibarchive_with_deleted.list_bibdocs() if (not display_only_main) or (bibdoc.get_type().lower() == 'main' and display_only_main)]
+    doc_numbers.sort()
+    number_of_photos_to_display = len([x for x in doc_numbers if not x[2].deleted_p()])
+    bibdocs = bibarchive.list_bibdocs()
+    if len(bibdocs) == 0:
+        return ""
+    bibdoc_pictures = []
+    for (docid, docname, bibdoc) in doc_numbers:
+        if bibdoc.deleted_p():
+            continue
+        if True in [docfile.hidden_p() for docfile in bibdoc.list_latest_files()]:
+            continue
+        if bibdoc.get_type().lower() != 'main' and display_only_main:
+            continue
+        if bibdoc.format_already_exists_p('.swf') and bibdoc.get_type() == 'panorama':
+            continue
+        found_icons = []
+        for docfile in bibdoc.list_latest_files():
+            if docfile.is_icon() and not docfile.hidden_p():
+                found_icons.append((docfile.get_size(), docfile.get_url()))
+        found_icons.sort()
+        icon_url = None
+        if found_icons:
+            icon_url = found_icons[0][1]
+        if not icon_url:
+            icon_url = CFG_SITE_URL + '/img/file-icon-image-96x128.png'
+        try:
+            preview_url = found_icons[len(found_icons)/2][1]
+        except:
+            preview_url = icon_url
+        if number_of_photos_to_display == 1:
+            icon_url = preview_url
+        name = bibarchive_with_deleted.get_docname(docid)
+        description = ""
+        comment = ""
+        bibdoc_number = doc_numbers.index((docid, docname, bibdoc)) + 1
+        download_links = []
+        orig_formats = []
+        for bibdoc_file in bibdoc.list_latest_files():
+            if bibdoc_file.hidden_p():
+                continue
+            format = bibdoc_file.get_format().lstrip('.').upper()
+            url = bibdoc_file.get_url()
+            if not description and bibdoc_file.get_description():
+                description = bibdoc_file.get_description()
+            if not comment and bibdoc_file.get_comment():
+                comment = bibdoc_file.get_comment()
+            if not bibdoc_file.get_subformat():
+                orig_formats.append(format)
+            download_links.append({'url': url, 'format': format})
+        if 'JPG' in orig_formats:
+            orig_formats.remove('JPG')
+            orig_formats = ['JPG'] + orig_formats
+        format_label = {'Large': ';ICON-1440', 'Medium': ';ICON-640', 'Small': ';ICON-180', 'Original': ''}
+        format_order = ['Small', 'Medium', 'Large', 'Original']
+        for orig_format in orig_formats:
+            format_for_icon = CFG_ICON_CREATION_FORMAT_MAPPINGS.get(orig_format.lower(), [orig_format])[0]
+            temp_download_links = [{'url': li['url'], 'format': format} for format in format_order for li in download_links if li['format'].upper() == "%s%s" %(format_for_icon.upper(), format_label[format])]
+            if len(temp_download_links) > 2:
+                other_originals = [li for li in download_links if li['format'].upper() in orig_formats and li['format'].upper() != format_for_icon]
+                download_links = temp_download_links
+                download_links.extend(other_originals)
+                preview_url = [li['url'] for li in download_links if li['format'] == 'Large'][0]
+                if number_of_photos_to_display == 1:
+                    icon_url = [li['url'] for li in download_links if li['format'] == 'Medium'][0]
+                else:
+                    icon_url = [li['url'] for li in download_links if li['format'] == 'Small'][0]
+                break
+        bibdoc_pictures.append({'bibdoc_number': bibdoc_number,
+                                'icon_url': icon_url,
+                                'preview_url': preview_url,
+                                'report_number': report_number,
+                                'name': name,
+                                'download_links': download_links,
+                                'description': description,
+                                'comment': comment,
+                                'submit_link': submission_doctype and (create_html_link(CFG_SITE_URL + '/submit/direct', urlargd={'DEMOPIC_RN': report_number, 'sub': 'MBI' + submission_doctype}, link_label='<img src="%s/img/iconpen.gif">' % CFG_SITE_URL)) or ''})
+    bibdoc_pictures = sorted(bibdoc_pictures, key=itemgetter('name'), cmp=alphanum)
+    return bibdoc_pictures
+
+
+def timed(function, *args):
+    """Returns the result of the call, and its duration in ms."""
+    start = time.time()
+    result = function(*args)
+    return (result, (time.time() - start) * 1e3)
+
+
+def run_sql(query, params):
+    """The names of the bibdocs of a record, from bibrec_bibdoc."""
+    return [(bibdoc.id, bibdoc.docname) for bibdoc in BibRecDocs.albums[params[0]]]
+
+
+def main():
+    photo_album_index.BibRecDocs = BibRecDocs
+    photo_album_index.run_sql = run_sql
+    revisions = {}
+    bfe_CERN_photo_resources.get_cached_record_revision = lambda bfo: revisions[bfo.recID]
+    bfe_CERN_photo_resources.get_cached_bibdocs_revision = lambda bfo: revisions[bfo.recID]
+
+    print "%8s  %12s  %12s  %12s" % ('photos', 'former', 'index built', 'index cached')
+    for nb_photos in ALBUM_SIZES:
+        BibRecDocs.albums[nb_photos] = generate_album(nb_photos)
+        bfo = BibFormatObject(nb_photos)
+        revisions[nb_photos] = '20131024153012'
+
+        (pictures, built) = timed(bfe_CERN_photo_resources.get_bibdoc_pictures_struct, BibFormatObject(nb_photos), '')
+        (cached_pictures, cached) = timed(bfe_CERN_photo_resources.get_bibdoc_pictures_struct, BibFormatObject(nb_photos), '')
+        former = '-'
+        if nb_photos < SLOW_ALBUM_SIZE or '--all' in sys.argv[1:]:
+            (expected, former) = timed(get_bibdoc_pictures_struct_one_by_one, bfo, '')
+            if pictures != expected or cached_pictures != expected:
+                print "Different pictures for the album of %s photos" % nb_photos
+                sys.exit(1)
+            former = '%.1f ms' % former
+        print "%8s  %12s  %9.1f ms  %9.1f ms" % (nb_photos, former, built, cached)
+
+if __name__ == '__main__':
+    main()
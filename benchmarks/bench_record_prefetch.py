@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Benchmark of the reading of the records of a page of brief results
+(81.brief, 85.brief), against the site database: the fields read by
+the elements of the templates, from BibFormatObjects reading their
+record one by one, and from BibFormatObjects prefetched together
+(record_prefetch), for pages of 10, 50 and 200 records.
+
+The fields read are also checked to be the same both ways.
+
+Usage: python bench_record_prefetch.py [collection]
+"""
+
+import sys
+import timeit
+
+from invenio.bibformat_engine import BibFormatObject
+from invenio.search_engine import get_collection_reclist
+from invenio.record_prefetch import get_prefetched_bfos
+
+# The fields read by the elements of the brief templates (title, date,
+# keywords, tirage, thumbnails, copyright, movie)
+BRIEF_TAGS = ('245__a', '245__b', '245__y', '246__a', '246__b', '246__i', '246__y',
+              '269__c', '260__c', '037__a', '088__a', '6531_', '653_1', '690C_a',
+              '8567_', '8564_', '999__a', '774', '542__', '540__', '960__a', '980__a')
+PAGE_SIZES = (10, 50, 200)
+
+
+def read_fields(bfos):
+    """Reads the fields of the brief templates of the records."""
+    return [[bfo.fields(tag) for tag in BRIEF_TAGS] for bfo in bfos]
+
+
+def read_one_by_one(recids):
+    return read_fields([BibFormatObject(recid, ln='en') for recid in recids])
+
+
+def read_prefetched(recids):
+    return read_fields(get_prefetched_bfos(recids, 'en'))
+
+
+def main():
+    collection = 'Photos'
+    if len(sys.argv) > 1:
+        collection = sys.argv[1]
+    reclist = list(get_collection_reclist(collection))
+    reclist.reverse()
+
+    print "%s (%s records)" % (collection, len(reclist))
+    for page_size in PAGE_SIZES:
+        recids = reclist[:page_size]
+        if read_one_by_one(recids) != read_prefetched(recids):
+            print "Different fields for the page of %s records" % page_size
+            sys.exit(1)
+        one_by_one = min(timeit.repeat(lambda: read_one_by_one(recids), number=1, repeat=5))
+        prefetched = min(timeit.repeat(lambda: read_prefetched(recids), number=1, repeat=5))
+        print "  %3s records:  one by one %7.1f ms,  prefetched %7.1f ms" % \
+              (len(recids), one_by_one * 1e3, prefetched * 1e3)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Benchmark of the offline similar videos engine (video_similarity) on a
+synthetic corpus: time to build the neighbours, and latency of looking
+up the videos similar to a record in the memory-mapped file.
+
+The neighbours of a sample of records are also checked against a brute
+force computation.
+
+Usage: python bench_video_similarity.py [number of records]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+import numpy
+
+from invenio import video_similarity
+
+# Size of the vocabulary of the synthetic corpus, and number of words
+# of the title + keywords + abstract of a record
+VOCABULARY_SIZE = 50000
+WORDS_PER_RECORD = (20, 120)
+
+def generate_texts(nb_records):
+    """Returns recid -> text, with words following a Zipf distribution."""
+    rng = numpy.random.RandomState(42)
+    words = ['w%s' % i for i in xrange(VOCABULARY_SIZE)]
+    words = [''.join([chr(ord('a') + int(digit)) for digit in word[1:]]) + 'xyz' for word in words]
+    texts = {}
+    for recid in xrange(1, nb_records + 1):
+        nb_words = rng.randint(*WORDS_PER_RECORD)
+        ranks = numpy.minimum(rng.zipf(1.3, nb_words), VOCABULARY_SIZE) - 1
+        texts[recid * 3] = ' '.join([words[rank] for rank in ranks])
+    return texts
+
+def check_neighbours(texts, nb_samples=20):
+    """Compares the neighbours of some records with a brute force computation."""
+    recids = sorted(texts)
+    documents = [video_similarity.tokenize(texts[recid]) for recid in recids]
+    ((indptr, indices, data), nb_words) = video_similarity.build_tfidf_matrix(documents)
+    for row in random.Random(0).sample(xrange(len(recids)), min(nb_samples, len(recids))):
+        vector = numpy.zeros(nb_words)
+        vector[indices[indptr[row]:indptr[row + 1]]] = data[indptr[row]:indptr[row + 1]]
+        scores = numpy.zeros(len(recids))
+        for other in xrange(len(recids)):
+            scores[other] = numpy.dot(vector[indices[indptr[other]:indptr[other + 1]]],
+                                      data[indptr[other]:indptr[other + 1]])
+        scores[row] = 0
+        similar = video_similarity.get_similar_videos(recids[row])
+        expected = sorted([score for score in scores if score > 0], reverse=True)
+        expected = expected[:video_similarity.CFG_VIDEO_SIMILARITY_NEIGHBOURS]
+        found = [scores[recids.index(recid)] for recid in similar]
+        if len(found) != len(expected) or not numpy.allclose(found, expected, atol=1e-5):
+            print "Mismatch for record %s" % recids[row]
+            sys.exit(1)
+
+def main():
+    nb_records = 100000
+    if len(sys.argv) > 1:
+        nb_records = int(sys.argv[1])
+
+    tmp_dir = tempfile.mkdtemp()
+    video_similarity.CFG_VIDEO_SIMILARITY_FILE = os.path.join(tmp_dir, 'neighbours.npy')
+    try:
+        texts = generate_texts(nb_records)
+        start = time.time()
+        video_similarity.build_video_similarity(texts)
+        build = time.time() - start
+        print "records:     %s" % nb_records
+        print "build:       %.1f s" % build
+        print "file:        %.1f MB" % (os.path.getsize(video_similarity.CFG_VIDEO_SIMILARITY_FILE) / 1e6)
+
+        recids = sorted(texts)
+        rng = random.Random(1)
+        queries = [rng.choice(recids) for dummy in xrange(1000)]
+        def run_queries():
+            for recid in queries:
+                video_similarity.get_similar_videos(recid)
+        lookup = min(timeit.repeat(run_queries, number=1, repeat=3))
+        print "lookup:      %.1f us/record" % (lookup * 1e6 / len(queries))
+
+        if nb_records <= 20000:
+            check_neighbours(texts)
+            print "neighbours:  checked"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
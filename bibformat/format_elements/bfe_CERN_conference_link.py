@@ -23,6 +23,7 @@
 __revision__ = "$Id$"
 from invenio.config import CFG_SITE_URL
 from invenio.search_engine import search_pattern
+from invenio.identifier_index import get_recids_for_identifier
 from invenio.bibformat_engine import BibFormatObject
 
 def format_element(bfo,
@@ -62,7 +63,10 @@ def format_element(bfo,
                 # There is no link label. We'll need to extract
                 # information from related record. So fetch recid now
                 try:
-                    recid_of_related_record = search_pattern(p=aleph_sysno, f='sysno').tolist()[0]
+                    recids = get_recids_for_identifier('sysno', aleph_sysno)
+                    if recids is None:
+                        recids = search_pattern(p=aleph_sysno, f='sysno').tolist()
+                    recid_of_related_record = recids[0]
                 except:
                     # Too bad, no link will be displayed
                     continue
@@ -38,21 +38,26 @@ from invenio.search_engine import (
 )
 
 from invenio.media_utils import (
-    get_media,
-    get_ordered_media_names as get_ordered_names,
+    get_cached_media,
+    get_request_cache,
     resize_dimension,
     get_preferred_posterframe_url,
     format_size,
-    get_high_res_info,
+    get_high_res_infos,
     front_code_to_embed_video,
     get_level_list,
     select_best_path,
     select_best_bitrate,
+    get_video_posterframe,
     CFG_VIDEO_STREAMER_URL,
-    file_exists,
     get_toc_relationship
 )
 
+from invenio.smil_index import get_smil_url, smil_file_exists
+from invenio.identifier_index import get_recids_for_identifier, \
+     get_recids_for_identifiers
+from invenio.record_prefetch import prefetch_records
+from invenio.fragment_cache import cached_format_element, set_fragment_uncacheable
 from invenio.jsonutils import json
 import cgi
 import re
@@ -61,6 +66,12 @@ REPORT_NUMBER_ASSET_IN_TOC_MARC = '774__r'
 REPORT_NUMBER_TOC_MARC = '773__r'
 REPORT_NUMBER_MARC = '037__a'
 
+# Number of assets of a TOC record displayed per page (0 for all the
+# assets on one page), and URL of the next pages, served by
+# media_webinterface (see format_toc_assets_page)
+CFG_TOC_ASSETS_PAGE_SIZE = 0
+CFG_TOC_ASSETS_PAGE_URL = '%s/video/toc/%%(recid)s?page=%%(page)s&page_size=%%(page_size)s' % CFG_SITE_URL
+
 # WARNING PLEASE FILL OUT HIDDEN_KEYWORD IF YOU WANT
 # THE DOWNLOAD BOX TO BE HIDDEN
 HIDDEN_DOWNLOADS = '595__a'
@@ -89,6 +100,7 @@ JWPLAYER_SCRIPTS = """<script type="text/javascript" src="%(jwplayer_location)s/
        <script type="text/javascript">jwplayer.key="bsak02ZblA+UnaKB/oceaAIgGHzwL49kGPkmIpJDjPk=";</script>
        <script type="text/javascript" src="%(jwplayer_location)s/jwpsrv.js"></script>""" % {'jwplayer_location': JWPLAYER_LOCATION}
 
+@cached_format_element('BFE_CERN_MOVIE', bibdocs=True)
 def format_element(bfo,
            display_as="embed",
            media_type="slave",
@@ -105,7 +117,9 @@ def format_element(bfo,
            hide_restricted_record_images="yes",
            button_list=None,
            max_heigth="",
-           wrap_video=None):
+           wrap_video=None,
+           toc_page="1",
+           toc_page_size=""):
     """
     Prints the movie of the record. <br/>
     Can also embed the movie in the template, or returns a link to the
@@ -139,6 +153,8 @@ def format_element(bfo,
     @param hide_restricted_record_images if yes, images of restricted records are not displayed
     @param wrap_video wraps the video player, please note the wrapper should contain {video} word
            in order to include the video.
+    @param toc_page for TOC records, the page of assets to display
+    @param toc_page_size for TOC records, the number of assets per page (default: CFG_TOC_ASSETS_PAGE_SIZE, 0 for all)
     """
 
     out = ''
@@ -159,29 +175,36 @@ def format_element(bfo,
 
     if record_is_from_indico_p:
         resolve_movie_path = 'yes'
+    if resolve_movie_path == 'yes':
+        # The media are looked for on the MediaArchive
+        set_fragment_uncacheable(bfo)
 
     record_is_toc_p = is_record_toc(bfo)
     if record_is_toc_p and display_as.lower() not in ['embed']: # if the record is TOC, only 'embed' makes sense
         return ''
+    if record_is_toc_p:
+        # The assets, their media and restrictions are read from other records
+        set_fragment_uncacheable(bfo)
 
     if record_is_toc_p and media_type != 'slave': # for everything else except 'slave' use the bfo of the first assset
         assets = get_assets_for_toc(bfo)
         if assets:
-            bfo = BibFormatObject(assets[0])
+            bfo = get_bfo_for_asset(bfo, assets[0])
 
     # We might have records with restricted access to slaves. In that
     # case, the following line should return True:
     is_restricted_record = bfo.field('5061_d') and True or False
 
-    multimedia = get_media(bfo, resolve_movie_path=resolve_movie_path)
-    ordered_names = get_ordered_names(multimedia)
+    multimedia = get_cached_media(bfo, resolve_movie_path=resolve_movie_path)
+    ordered_names = multimedia.get_ordered_names()
 
     ## HTML DISPLAY ##
     if display_as.lower() in ['embed']:
 
         if media_type == 'slave':
             if record_is_toc_p:
-                out = _generate_display_for_assets(get_assets_for_toc(bfo))
+                out = _generate_display_for_assets(bfo, get_assets_for_toc(bfo),
+                                                   toc_page, toc_page_size)
             else:
                 out = _generate_display_for_slaves(bfo, multimedia, is_restricted_record, max_nb, width, max_width, ordered_names, percent, record_is_conf_p)
                 if wrap_video:
@@ -421,7 +444,7 @@ def _generate_display_for_slaves(bfo, multimedia, is_restricted_record, max_nb,
             pass
         else:
             media = multimedia['slave'][media_name]
-            posterframe = get_video_posterframe(multimedia['posterframe'].get(media_name, ''), 5, (640, 360))
+            posterframe = multimedia.get_posterframe(media_name, 5, (640, 360))
             if 'mp4' in media or 'flv' in media:
                 #embed only mp4 or flv
                 video_html =  _generate_display_for_video_jwplayer(bfo, multimedia, media, posterframe, is_restricted_record, media_name)
@@ -537,10 +560,9 @@ def js_code_for_video_selection(first_video, movies):
 def get_smil_file_path(mp4_path):
     """Returns the smil file path, if it exists"""
 
-    mp4_path_tokens = mp4_path.split('/')
-    smil_filepath = '%s/%s.smil' % ('/'.join(mp4_path_tokens[:-1]), mp4_path_tokens[-2])
-    #does the smil_filepath exist?
-    if not file_exists(smil_filepath):
+    smil_filepath = get_smil_url(mp4_path)
+    #does the smil_filepath exist? (see smil_index)
+    if not smil_file_exists(smil_filepath):
         return ''
     smil_filepath = smil_filepath.split(MEDIAARCHIVE_PATH)[1]
     #return "%s/smil:Video/%s" %(CFG_VIDEO_STREAMER_URL, smil_file)
@@ -562,14 +584,16 @@ def generate_thumbnails_file_content(recid, reportnumber, secure=True):
 """
 
     if not recid:
-        possible_recids = search_pattern(p='reportnumber:%s' % reportnumber)
+        possible_recids = get_recids_for_identifier('reportnumber', reportnumber)
+        if possible_recids is None:
+            possible_recids = search_pattern(p='reportnumber:%s' % reportnumber)
         if len(possible_recids) == 1:
             recid = possible_recids[0]
     if not recid:
         return ''
 
     bfo = BibFormatObject(recid)
-    media = get_media(bfo)
+    media = get_cached_media(bfo)
 
     try:
         total_duration = get_fieldvalues(recid, '300__a')[0]
@@ -632,15 +656,8 @@ def generate_jwplayer_config(bfo, multimedia, media, posterframe,
         copyright = 'CERN'
     record_id = bfo.recID
 
-    mp4_slaves = media.get('mp4', [])
-    mp4_path = ''
-    if mp4_slaves:
-        mp4_path = select_best_path(mp4_slaves, video_width)
-
-    flv_path = ''
-    flv_slaves = media.get('flv', [])
-    if flv_slaves:
-        flv_path = select_best_path(flv_slaves, video_width)
+    mp4_path = multimedia.get_best_path(media_name, 'mp4', video_width)
+    flv_path = multimedia.get_best_path(media_name, 'flv', video_width)
 
     player_config = {}
 
@@ -649,6 +666,7 @@ def generate_jwplayer_config(bfo, multimedia, media, posterframe,
     if mp4_path:
         player_file = mp4_path
         smil_file = get_smil_file_path(mp4_path)
+        set_fragment_uncacheable(bfo)
     elif flv_path:
         player_file = flv_path
         smil_file = ''
@@ -914,43 +932,6 @@ def _generate_display_for_video_jwplayer_jw5(media, posterframe, is_restricted_r
     return player_code
 
 
-def get_video_posterframe(media_posterframes, nth_percentage, nth_dimension):
-    """Return the path to the posterframe that has the NiceToHave_percentage
-       and NiceToHave_dimension
-       If no posterframe is found for nth_dimension, we take the first
-       available from nth_percentage;
-       If nth_percentage is not available, we take the first posterframe with
-       nth_dimension;
-       If none of the above, we take the first posterframe available.
-       """
-    if not media_posterframes:
-        return ''
-
-    #try to return the posterframe, at the nth_percentage and nth_dimension
-    if nth_percentage in media_posterframes:
-        for item in media_posterframes[nth_percentage]:
-            if item.get('dimension', '') == nth_dimension and item.get('path', ''):
-                return item['path']
-        #there is no posterframe with nth_dimension, return another one
-        for item in media_posterframes[nth_percentage]:
-            if item.get('path', ''):
-                return item['path']
-
-
-    #none of the above worked, return the first posterframe with nth_dimension
-    for percentage in media_posterframes:
-        for item in media_posterframes[percentage]:
-            if item.get('dimension', '') == nth_dimension and item.get('path', ''):
-                return item['path']
-
-    # nothing worked so far, return the first posterframe
-    for percentage in media_posterframes:
-        for item in media_posterframes[percentage]:
-            if item.get('path', ''):
-                return item['path']
-
-    return ''
-
 def _generate_HD_button(url, normal_url):
     """ Return a button which toggles HD functionality """
     # check which key is availble and get the path
@@ -1114,8 +1095,12 @@ def _generate_display_for_weblecture(weblecture_movies, is_restricted_record, bf
     weblectures_html += '''</div><br/>'''
     return weblectures_html
 
-def _generate_display_for_assets(recids):
-    """Returns the html code for displaying the assets"""
+def _generate_display_for_assets(toc_bfo, recids, page="1", page_size=""):
+    """
+    Returns the html code for displaying the assets of the TOC record
+    formatted with toc_bfo: the given page of assets, and a link to load
+    the next ones (see format_toc_assets_page)
+    """
 
     css_code = '''
 <style type="text/css">
@@ -1154,9 +1139,48 @@ a.toc_asset_item_desc_link {
     # Add css code for download buttons
     html_code = '''<div class="toc_ul_title">Number of videos: %s</div>''' %len(recids)
     html_code += '''<ul class="toc_ul">'''
+    html_code += _generate_display_for_assets_page(toc_bfo, recids, page, page_size)
+    html_code += '</ul>'
+    html_code += """<script type="text/javascript">
+    $(document).ready(function(){
+        $('.toc_ul').on('click', '.toc_assets_more a', function(event){
+            event.preventDefault();
+            var more = $(this).closest('.toc_assets_more');
+            $.get($(this).attr('href'), function(data){
+                more.replaceWith(data);
+            });
+        });
+    });
+</script>"""
+    return css_code + html_code
+
+
+def _get_page(page, page_size):
+    """Returns the page and the page size (0 for all) as integers"""
+    page = str(page).isdigit() and max(int(page), 1) or 1
+    if str(page_size).isdigit():
+        page_size = int(page_size)
+    else:
+        page_size = CFG_TOC_ASSETS_PAGE_SIZE
+    if not page_size:
+        return (1, 0)
+    return (page, page_size)
 
-    for recid in recids:
-        bfo = BibFormatObject(recid)
+
+def _generate_display_for_assets_page(toc_bfo, recids, page="1", page_size=""):
+    """
+    Returns the list items of the given page of assets, followed by a
+    link to the next page if any
+    """
+    (page, page_size) = _get_page(page, page_size)
+    if page_size:
+        page_recids = recids[(page - 1) * page_size:page * page_size]
+    else:
+        page_recids = recids
+    prefetch_assets(toc_bfo, page_recids)
+    html_code = ''
+    for recid in page_recids:
+        bfo = get_bfo_for_asset(toc_bfo, recid)
         additional_info = [bfe_CERN_duration_multimedia.format_element(bfo), bfe_CERN_languages.format_element(bfo)]
         additional_info = [item for item in additional_info if item]
 
@@ -1174,8 +1198,26 @@ a.toc_asset_item_desc_link {
                     'additional_info': ' | '.join(additional_info)
                    }
 
-    html_code += '</ul>'
-    return css_code + html_code
+    if page_size and page * page_size < len(recids):
+        html_code += """<li class="toc_assets_more"><a href="%s">More videos</a></li>""" % \
+                     cgi.escape(CFG_TOC_ASSETS_PAGE_URL % {'recid': toc_bfo.recID,
+                                                           'page': page + 1,
+                                                           'page_size': page_size}, True)
+    return html_code
+
+
+def format_toc_assets_page(recid, page="1", page_size=""):
+    """
+    Returns the list items of the given page of assets of the TOC record,
+    to be appended to its list of assets (see _generate_display_for_assets).
+    Served at CFG_TOC_ASSETS_PAGE_URL by media_webinterface, which checks
+    that the user can see the record.
+    """
+    toc_bfo = BibFormatObject(recid)
+    if not is_record_toc(toc_bfo):
+        return ''
+    return _generate_display_for_assets_page(toc_bfo, get_assets_for_toc(toc_bfo),
+                                             page, page_size)
 
 
 def _generate_download_movie_box(bfo, multimedia, ordered_names, record_is_conf_p):
@@ -1309,7 +1351,7 @@ def _generate_download_movie_box(bfo, multimedia, ordered_names, record_is_conf_
         movie_info = {}
         movie_info['name'] = name
         try:
-            master_path = multimedia['master'][name].values()[0][0]['path']
+            master_path = multimedia['master'][name].values()[0][0].path
             master_path = master_path.replace('\\\\cern.ch\\dfs\\Services\\MediaArchive',
                                                   'https://mediastream.cern.ch/MediaArchive')
             master_path = master_path.replace('\\', '/')
@@ -1319,7 +1361,7 @@ def _generate_download_movie_box(bfo, multimedia, ordered_names, record_is_conf_
 
         movie_info['format'] = {}
         for fmt in dict_of_formats:
-            available_video_bitrates = [(resource.get('path',''), resource.get('video_bitrate','')) for resource in dict_of_formats[fmt] if resource.get('label', '').find('Multirate') < 0] # do not add the multirates to the main formats, only to the 'More..' tab
+            available_video_bitrates = [(resource.path, resource.video_bitrate) for resource in dict_of_formats[fmt] if resource.label.find('Multirate') < 0] # do not add the multirates to the main formats, only to the 'More..' tab
             available_video_bitrates.sort(key=lambda tuple: tuple[1]) #sort on bitrates
             low_quality_link = high_quality_link = medium_quality_link = ''
             if len(available_video_bitrates) < 1:# there are no bitrates available
@@ -1334,13 +1376,17 @@ def _generate_download_movie_box(bfo, multimedia, ordered_names, record_is_conf_
             if medium_video_bitrates:
                 medium_quality_link = medium_video_bitrates[len(medium_video_bitrates)/2] # take the middle one
                 medium_video_bitrates.remove(medium_quality_link) # list with the rest of the bitrates
-            medium_video_bitrates.extend([(resource.get('path',''), "Multi%s" % resource.get('video_bitrate','')) for resource in dict_of_formats[fmt] if resource.get('label', '').find('Multirate') > -1]) #add Multirates, if any
+            medium_video_bitrates.extend([(resource.path, "Multi%s" % resource.video_bitrate) for resource in dict_of_formats[fmt] if resource.label.find('Multirate') > -1]) #add Multirates, if any
             movie_info['format'][fmt] = (low_quality_link, medium_quality_link, high_quality_link, medium_video_bitrates)
         videos.append(movie_info)
 
     if not videos: # make sure there is something to print
         return ''
 
+    # Probe the high-res files of all the parts at once
+    high_res_infos = get_high_res_infos([movie['master'] for movie in videos if movie.get('master', '')])
+    set_fragment_uncacheable(bfo)
+
     videos_content = {}
     for i, movie in enumerate(videos):
         videos_content[i] = {}
@@ -1384,7 +1430,7 @@ def _generate_download_movie_box(bfo, multimedia, ordered_names, record_is_conf_
                   for (url, bitrate) in more_available_formats] #(label, link)
         #High-res
         if movie.get('master', ''):
-            high_res_versions = get_high_res_info(movie['master'])
+            high_res_versions = high_res_infos[movie['master']]
             videos_content[i]['high_res_links'] = [('%s/tools/mediaarchive.py/copyright_notice?recid=%s&master_path=%s&ln=%s&reference=%s' % \
                                                      (CFG_SITE_SECURE_URL, bfo.recID, cgi.escape(this_master_path), bfo.lang, movie.get('name', '')), \
                                                    extension, \
@@ -1652,14 +1698,14 @@ def print_image(multimedia, name, percent=50, media_type="thumbnail",
     elif multimedia[alternative_media_type][name].get(percent, []):
         avail_media_type = alternative_media_type
     if avail_media_type:
-        max_width = max([image['dimension'][0] for image in multimedia[avail_media_type][name][percent] \
-                             if image['dimension'][0] is not None])
+        images = multimedia.get_files(avail_media_type, name, percent)
+        max_width = max([image.dimension[0] for image in images \
+                             if image.dimension[0] is not None])
         if max_width == 0:
             max_width = None
-        image = [img for img in multimedia[avail_media_type][name][percent] \
-                      if img['dimension'][0] == max_width][0]
-        image_path = image.get('path', None)
-        image_dimension = image.get('dimension', (None, None))
+        image = multimedia.get_files_by_width(avail_media_type, max_width, name, percent)[0]
+        image_path = image.path
+        image_dimension = image.dimension
 
     if not image_path:
         # Take first image found
@@ -1671,8 +1717,8 @@ def print_image(multimedia, name, percent=50, media_type="thumbnail",
         if avail_media_type:
             for images in multimedia[avail_media_type][name].values():
                 for image in images:
-                    image_path = image.get('path', None)
-                    image_dimension = image.get('dimension', (None, None))
+                    image_path = image.path
+                    image_dimension = image.dimension
                     if image_path:
                         break
     if not image_path:
@@ -1764,16 +1810,16 @@ def print_images(multimedia, name, max_nb=None, min_nb=None, media_type="thumbna
     for percentage in percentages:
         media = multimedia[media_type][name][percentage]
         try:
-            max_width = max([image['dimension'][0] for image in media \
-                             if image['dimension'][0] is not None])
+            max_width = max([image.dimension[0] for image in media \
+                             if image.dimension[0] is not None])
         except:
             max_width = None
         for image in media:
             if max_nb is not None and i >= int(max_nb):
                 # stop as soon as max number of video is reached
                 break
-            image_path = image.get('path', None)
-            image_dimension = image.get('dimension', (None, None))
+            image_path = image.path
+            image_dimension = image.dimension
             if (image_dimension[0] is not None and \
                     image_dimension[0] != max_width) or \
                     (image_dimension[0] is None and max_width > 0):
@@ -1870,12 +1916,16 @@ def get_recid_for_toc(bfo):
 
     report_number_toc = _toc_relationship.get('r')
     if report_number_toc:
-        toc_recid = perform_request_search(p='"%s"' %report_number_toc, f=REPORT_NUMBER_MARC, ap=0)
+        toc_recid = get_recids_for_identifier(REPORT_NUMBER_MARC, report_number_toc)
+        if toc_recid is None:
+            toc_recid = perform_request_search(p='"%s"' %report_number_toc, f=REPORT_NUMBER_MARC, ap=0)
         if len(toc_recid) == 1: # if one and only one
             _toc_recid = toc_recid[0]
         else:
             toc_id = _toc_relationship.get('o')
-            toc_recid = search_pattern(p='970__a:"%s"' %toc_id)
+            toc_recid = get_recids_for_identifier('970__a', toc_id)
+            if toc_recid is None:
+                toc_recid = search_pattern(p='970__a:"%s"' %toc_id)
             if len(toc_recid) == 1:
                 _toc_recid = toc_recid[0]
 
@@ -1887,19 +1937,66 @@ def is_record_toc(bfo):
         return True
     return False
 
+def get_bfo_for_asset(bfo, recid):
+    """
+    Returns the BibFormatObject of the asset 'recid' of the TOC record
+    being formatted with 'bfo'. The object is created only once while
+    formatting the TOC, so that the media of the asset are shared by
+    all the elements of the format template.
+    """
+    assets_bfo = get_request_cache(bfo, 'toc_assets_bfo')
+    if recid not in assets_bfo:
+        assets_bfo[recid] = BibFormatObject(recid)
+    return assets_bfo[recid]
+
+def prefetch_assets(toc_bfo, recids):
+    """
+    Creates at once the BibFormatObjects of the given assets of the TOC
+    record being formatted with toc_bfo (see get_bfo_for_asset), with
+    their records, revisions and media manifests read together (see
+    record_prefetch).
+    """
+    assets_bfo = get_request_cache(toc_bfo, 'toc_assets_bfo')
+    missing = [recid for recid in recids if recid not in assets_bfo]
+    if not missing:
+        return
+    for recid in missing:
+        assets_bfo[recid] = BibFormatObject(recid)
+    prefetch_records([assets_bfo[recid] for recid in missing], related=False)
+
 def get_assets_for_toc(bfo):
+    """
+    Returns the list of assets recids, computed only once while
+    formatting the TOC record
+    """
+    cache = get_request_cache(bfo, 'toc_assets')
+    if bfo.recID not in cache:
+        cache[bfo.recID] = _get_assets_for_toc(bfo)
+    return cache[bfo.recID]
+
+def _get_assets_for_toc(bfo):
     """Returns the list of assets recids"""
     result = []
     repnum_assets = bfo.fields(REPORT_NUMBER_ASSET_IN_TOC_MARC)
     repnum_assets.sort()
-    if record_public_p(bfo.recID):
+    toc_is_public = record_public_p(bfo.recID)
+    if toc_is_public:
         #TOC is public, show only public assets
         search_fnc = perform_request_search
     else:
         #TOC is restricted, show all assets
         search_fnc = search_pattern
+    # Look all the assets up at once in the index if possible (see
+    # identifier_index), and search for the ones it does not contain
+    assets = get_recids_for_identifiers(REPORT_NUMBER_MARC, repnum_assets) or {}
     for repnum_asset in repnum_assets:
-        result.extend(search_fnc(p='"%s"' %repnum_asset, f=REPORT_NUMBER_MARC, ap=0))
+        recids = assets.get(repnum_asset)
+        if recids is None:
+            result.extend(search_fnc(p='"%s"' %repnum_asset, f=REPORT_NUMBER_MARC, ap=0))
+        elif toc_is_public:
+            result.extend([recid for recid in recids if record_public_p(recid)])
+        else:
+            result.extend(recids)
     return result
 
 def get_reportnumber_for_toc(bfo):
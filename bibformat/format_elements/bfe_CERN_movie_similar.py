@@ -25,9 +25,65 @@ BibFormat element - Prints the movie link or player for the movie.
 
 __revision__ = "$Id$"
 
+from multiprocessing.pool import ThreadPool
+
 from invenio.config import weburl
-from invenio.bibformat import format_records
-from invenio.search_engine import perform_request_search
+from invenio.bibformat import format_record
+from invenio.bibformat_engine import BibFormatObject, format_with_format_template
+from invenio.fragment_cache import get_cached_fragments, is_fragment_uncacheable
+from invenio.format_template_plans import format_with_format_template_plan
+from invenio.output_format_rules import decide_format_template
+from invenio.search_engine import perform_request_search, get_collection_reclist
+from invenio.video_similar_index import get_similar_records, get_recent_records
+from invenio.video_similarity import get_similar_videos
+
+# Number of threads rendering the snippets missing from the cache (0 to
+# render them one after the other)
+CFG_SIMILAR_SNIPPETS_RENDER_THREADS = 0
+
+def format_cached_records(recids, of='hs'):
+    """
+    Same as format_records(recids, of=of), but the snippet of each record
+    is cached until the record or its documents are modified, and only
+    the snippets missing from the cache are rendered (see fragment_cache).
+    """
+    def render(recid):
+        "Renders the snippet of a record, and tells if it can be cached"
+        bfo = BibFormatObject(recid, output_format=of)
+        template = decide_format_template(bfo, of)
+        if template is None:
+            return (format_record(recid, of), False)
+        if template.endswith('.bft'):
+            output = format_with_format_template_plan(template, bfo)
+        else:
+            output = format_with_format_template(template, bfo)
+        # The elements mark the snippet as uncacheable when it does not
+        # depend only on the record (e.g. TOC, paths resolved on the
+        # MediaArchive)
+        return (output, not is_fragment_uncacheable(bfo))
+
+    def render_all(recids):
+        "Renders the snippets of the records"
+        if CFG_SIMILAR_SNIPPETS_RENDER_THREADS > 1 and len(recids) > 1:
+            pool = ThreadPool(min(CFG_SIMILAR_SNIPPETS_RENDER_THREADS, len(recids)))
+            try:
+                return pool.map(render, recids)
+            finally:
+                pool.close()
+                pool.join()
+        return [render(recid) for recid in recids]
+
+    return ''.join(get_cached_fragments('format_record', {'of': of}, recids,
+                                        None, None, render_all, bibdocs=True))
+
+def extend_results(results, other_results, recid):
+    """
+    Appends to results the recids of other_results that are not in
+    results yet, except recid (the record of the page)
+    """
+    for other_recid in other_results:
+        if other_recid != recid and other_recid not in results:
+            results.append(other_recid)
 
 def format_element(bfo, display_recent_too='no', nb_max='10'):
     """
@@ -60,28 +116,41 @@ def format_element(bfo, display_recent_too='no', nb_max='10'):
     if 'rush' in video_type:
         search_in_coll = 'Video Rushes'
 
-    results = perform_request_search(
-        of="id",
-        p="recid:{0!s}".format(bfo.recID),
-        rm="wrd",
-        c=search_in_coll,
-        cc=search_in_coll
-    )
-
-    if bfo.recID in results:
-        results.remove(bfo.recID)
+    # Use the content similarity computed offline if available (see
+    # video_similarity), and complete with the similar and recent videos
+    # read from the index if possible (see video_similar_index)
+    results = []
+    similar_videos = get_similar_videos(bfo.recID)
+    if similar_videos is not None:
+        reclist = get_collection_reclist(search_in_coll)
+        extend_results(results, [recid for recid in similar_videos if recid in reclist],
+                       bfo.recID)
+    if len(results) < nb_max:
+        # Not enough similar videos in the collection: complete with the
+        # word similarity (some records may be in both)
+        other_results = get_similar_records(bfo.recID, search_in_coll, nb_max + len(results))
+        if other_results is None:
+            other_results = perform_request_search(
+                of="id",
+                p="recid:{0!s}".format(bfo.recID),
+                rm="wrd",
+                c=search_in_coll,
+                cc=search_in_coll
+            )
+        extend_results(results, other_results, bfo.recID)
 
     if len(results) < nb_max and display_recent_too == 'yes':
-        other_results = perform_request_search(
-            of="id",
-            c=search_in_coll,
-            cc=search_in_coll
-        )
-        if bfo.recID in other_results:
-            other_results.remove(bfo.recID)
-        results.extend(other_results)
-
-    out += format_records(results[:nb_max], of='hs')
+        # Some of the recent records may be similar ones already
+        other_results = get_recent_records(search_in_coll, nb_max + len(results))
+        if other_results is None:
+            other_results = perform_request_search(
+                of="id",
+                c=search_in_coll,
+                cc=search_in_coll
+            )
+        extend_results(results, other_results, bfo.recID)
+
+    out += format_cached_records(results[:nb_max], of='hs')
 
     return out
 
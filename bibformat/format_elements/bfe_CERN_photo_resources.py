@@ -22,19 +22,22 @@
 """
 __revision__ = "$Id$"
 
-import os
 import cgi
 import re
-from urllib import urlopen, quote
+from urllib import urlopen, quote, urlencode
 from invenio.config import CFG_SITE_URL, CFG_SITE_SECURE_URL, CFG_ICON_CREATION_FORMAT_MAPPINGS
-from invenio.bibdocfile import BibRecDocs
 from invenio.urlutils import create_html_link, url_safe_escape
-from invenio.bibdocfile_config import CFG_BIBDOCFILE_DEFAULT_ICON_SUBFORMAT
 from invenio.bibformat_elements import bfe_copyright
 from invenio.webstat import get_url_customevent
 from operator import itemgetter
-from invenio.search_engine import get_all_restricted_recids, get_record
-from invenio.media_utils import alphanum, get_photolab_image_caption
+from invenio.search_engine import get_all_restricted_recids
+from invenio.media_utils import get_photolab_image_captions, get_request_cache, is_cern_ip
+from invenio.bibformat_engine import BibFormatObject
+from invenio.media_manifest import get_manifest_photo_media
+from invenio.media_prober import get_missing_urls
+from invenio.fragment_cache import cached_format_element, get_cached_record_revision, \
+     get_cached_bibdocs_revision, set_fragment_uncacheable
+from invenio.photo_album_index import get_album_index
 from invenio.bibknowledge import get_kb_mapping
 
 # Mapping from eg A4 -> "Large"
@@ -44,13 +47,22 @@ version_mapping = {'a4': 'Large',
 
 MAX_LEN_CAPTION = 50
 
-def format_element(bfo, magnify='yes', check_existence='yes', source="auto", display_name="no", display_reference="yes", display_description="yes", display_comment="yes", display_tirage="yes", submission_doctype=""):
+# Number of photos of an album displayed per page (0 for all the photos
+# on one page), and the URL of the next pages, served by
+# media_webinterface (see format_photo_album_page)
+CFG_PHOTO_ALBUM_PAGE_SIZE = 0
+CFG_PHOTO_ALBUM_PAGE_URL = '%s/photo/album/%%(recid)s?%%(args)s' % CFG_SITE_URL
+
+@cached_format_element('BFE_CERN_PHOTO_RESOURCES', bibdocs=True)
+def format_element(bfo, magnify='yes', check_existence='yes', source="auto", display_name="no", display_reference="yes", display_description="yes", display_comment="yes", display_tirage="yes", submission_doctype="", page="1", page_size=""):
     """
     Prints html image and link to photo resources, if 8567 exists print only 8567
     otherwise if exists 8564.
     @param magnify If 'yes', images will be magnified when mouse is over images
     @param check_existence if 'yes' check that file is reachable
     @param source where to look for photos. Possible values are 'mediaarchive', 'doc', 'bibdoc' or 'auto' (check everywhere)
+    @param page for photos attached to the record, the page of photos to display
+    @param page_size for photos attached to the record, the number of photos per page (default: CFG_PHOTO_ALBUM_PAGE_SIZE, 0 for all)
     """
     out = ""
 
@@ -79,12 +91,11 @@ def format_element(bfo, magnify='yes', check_existence='yes', source="auto", dis
         out += '<div about="%s" rev="license">' % get_kb_mapping(kb_name='LICENSE2URL', key=bfo.field('540__a'))['value']
     multimedia = {}
     if source in ['auto', 'mediaarchive']:
-        multimedia = get_media(bfo, check_existence=(check_existence.lower() == 'yes'))
-        # Also append master information to the multimedia structure
-        masters = get_media(bfo, path_code='d', internal_note_code='x', check_existence=(check_existence.lower() == 'yes'))
-        for (tirage, info) in masters.iteritems():
-            if multimedia.has_key(tirage):
-                multimedia[tirage]['master'] = info['master']
+        multimedia = None
+        if check_existence.lower() != 'yes':
+            multimedia = get_manifest_photo_media(bfo)
+        if multimedia is None:
+            multimedia = get_photo_media(bfo, check_existence=(check_existence.lower() == 'yes'))
 
     if multimedia != {} and source in ['auto', 'mediaarchive']:
         out += '''<center><small><strong>%s%s</strong></small></center><br />''' % (cond_of_use, bfe_copyright.format_element(bfo) or '&copy; CERN')
@@ -114,9 +125,10 @@ def format_element(bfo, magnify='yes', check_existence='yes', source="auto", dis
 
         bibdoc_pictures = get_bibdoc_pictures(bfo, display_name, display_reference,
                                               display_description, display_comment,
-                                              display_tirage, submission_doctype)
+                                              display_tirage, submission_doctype,
+                                              page, page_size)
         if bibdoc_pictures and source in ['auto', 'bibdoc']:
-            if bibdoc_pictures.count('<img ') > 1 and not rec_is_restricted:# we have at least 1 photo
+            if (len(get_bibdoc_pictures_struct(bfo, submission_doctype)) > 1 or bibdoc_pictures.count('<img ') > 1) and not rec_is_restricted:# we have at least 1 photo
                 out += generate_view_button(bfo, report_number, bibdoc_pictures)
             else:
                 out += bibdoc_pictures
@@ -262,14 +274,25 @@ def get_doc_pictures(bfo, tag="8564_"):
 
 
 def get_bibdoc_pictures_struct(bfo, submission_doctype):
+    """
+    Returns an associative array of the record data and images,
+    computed only once while formatting the record
+    """
+    cache = get_request_cache(bfo, 'bibdoc_pictures_struct')
+    if submission_doctype not in cache:
+        cache[submission_doctype] = _get_bibdoc_pictures_struct(bfo, submission_doctype)
+    return cache[submission_doctype]
+
+
+def _get_bibdoc_pictures_struct(bfo, submission_doctype):
     """
     Returns an associative array of the record data and images
     """
-    bibarchive = BibRecDocs(bfo.recID)
-    bibarchive_with_deleted = BibRecDocs(bfo.recID, deleted_too=True)
+    album = get_album_index(bfo.recID, (get_cached_record_revision(bfo),
+                                        get_cached_bibdocs_revision(bfo)))
     report_number = bfo.field('037__a')
 
-    if 'EVENTDISPLAY' in report_number and len(bibarchive.list_bibdocs()) > 1:
+    if 'EVENTDISPLAY' in report_number and album.nb_photos > 1:
         #display only main file
         display_only_main = True
     else:
@@ -279,41 +302,37 @@ def get_bibdoc_pictures_struct(bfo, submission_doctype):
     # to assign a "tirage" to all photos, even if deleted.  (if
     # someone refers to a specific photo, we should keep its number
     # even if photos are reordered or deleted)
-    doc_numbers = [(bibdoc.get_id(), bibarchive_with_deleted.get_docname(bibdoc.get_id()), bibdoc) for bibdoc in bibarchive_with_deleted.list_bibdocs() if (not display_only_main) or (bibdoc.get_type().lower() == 'main' and display_only_main)]
-    #doc_numbers = [(bibdoc.get_id(), bibdoc.get_docname(), bibdoc) for bibdoc in bibarchive_with_deleted.list_bibdocs()]
-    doc_numbers.sort()
+    doc_numbers = [photo for photo in album.photos if (not display_only_main) or (photo.doctype.lower() == 'main' and display_only_main)]
 
-    number_of_photos_to_display = len([x for x in doc_numbers if not x[2].deleted_p()])
+    number_of_photos_to_display = len([photo for photo in doc_numbers if not photo.deleted])
 
-    bibdocs = bibarchive.list_bibdocs()
-    if len(bibdocs) == 0:
+    if album.nb_photos == 0:
         return ""
 
-    # Compile a regular expression that can match the "default" icon,
-    # and not larger version.
-    CFG_BIBDOCFILE_ICON_SUBFORMAT_RE_DEFAULT = re.compile(CFG_BIBDOCFILE_DEFAULT_ICON_SUBFORMAT + '\Z')
-
     bibdoc_pictures = []
+    # The names of the pictures, split as alphanum compares them
+    sort_keys = []
 
-    for (docid, docname, bibdoc) in doc_numbers:
-        if bibdoc.deleted_p():
+    for (bibdoc_number, photo) in enumerate(doc_numbers):
+        bibdoc_number += 1
+        if photo.deleted:
             continue
 
-        if True in [docfile.hidden_p() for docfile in bibdoc.list_latest_files()]:
+        if True in [docfile.hidden for docfile in photo.files]:
             continue
 
-        if bibdoc.get_type().lower() != 'main' and display_only_main:
+        if photo.doctype.lower() != 'main' and display_only_main:
             continue
 
-        if bibdoc.format_already_exists_p('.swf') and bibdoc.get_type() == 'panorama':
+        if photo.flash_panorama:
             # We do not want to consider Flash panoramas here
             continue
 
         found_icons = []
         found_url = ''
-        for docfile in bibdoc.list_latest_files():
-            if docfile.is_icon() and not docfile.hidden_p():
-                found_icons.append((docfile.get_size(), docfile.get_url()))
+        for docfile in photo.files:
+            if docfile.icon and not docfile.hidden:
+                found_icons.append((docfile.size, docfile.url))
         found_icons.sort()
 
         icon = None
@@ -334,23 +353,22 @@ def get_bibdoc_pictures_struct(bfo, submission_doctype):
             icon_url = preview_url
 
         photo_files = []
-        name = bibarchive_with_deleted.get_docname(docid)
+        name = photo.docname
         description = "" # Limit to one description per bibdoc
         comment = "" # Limit to one comment per bibdoc
-        bibdoc_number = doc_numbers.index((docid, docname, bibdoc)) + 1
         download_links = []
         orig_formats = []
-        for bibdoc_file in bibdoc.list_latest_files():
-            if bibdoc_file.hidden_p(): # ignore hidden formats
+        for bibdoc_file in photo.files:
+            if bibdoc_file.hidden: # ignore hidden formats
                 continue
-            format = bibdoc_file.get_format().lstrip('.').upper()
-            url = bibdoc_file.get_url()
+            format = bibdoc_file.format.lstrip('.').upper()
+            url = bibdoc_file.url
             photo_files.append((format, url))
-            if not description and bibdoc_file.get_description():
-                description = bibdoc_file.get_description()
-            if not comment and bibdoc_file.get_comment():
-                comment = bibdoc_file.get_comment()
-            if not bibdoc_file.get_subformat():
+            if not description and bibdoc_file.description:
+                description = bibdoc_file.description
+            if not comment and bibdoc_file.comment:
+                comment = bibdoc_file.comment
+            if not bibdoc_file.subformat:
                 orig_formats.append(format)
             download_links.append({'url': url, 'format': format})
 
@@ -379,6 +397,7 @@ def get_bibdoc_pictures_struct(bfo, submission_doctype):
                 else:
                     icon_url = [li['url'] for li in download_links if li['format'] == 'Small'][0]
                 break
+        sort_keys.append(photo.sort_key)
         bibdoc_pictures.append({'bibdoc_number': bibdoc_number,
                                 'icon_url': icon_url,
                                 'preview_url': preview_url,
@@ -392,15 +411,77 @@ def get_bibdoc_pictures_struct(bfo, submission_doctype):
                                 #'submit_link': ''})
 
     #sort this structure based on the name of each picture (closest to chronological order)
-    bibdoc_pictures = sorted(bibdoc_pictures, key=itemgetter('name'), cmp=alphanum)
+    bibdoc_pictures = [picture for (dummy, picture) in
+                       sorted(zip(sort_keys, bibdoc_pictures), key=itemgetter(0))]
 
     return bibdoc_pictures
 
 
 def get_bibdoc_pictures(bfo, display_name, display_reference,
                         display_description, display_comment,
-                        display_tirage, submission_doctype):
+                        display_tirage, submission_doctype,
+                        page="1", page_size=""):
+    """
+    Returns the html code of the given page of photos attached to the
+    record, with a link to load the next ones (see
+    format_photo_album_page)
+    """
     rec_data = get_bibdoc_pictures_struct(bfo, submission_doctype)
+
+    show_hide_images_js = '''
+        <script type="text/javascript">
+        function load_more_images(link){
+            $.get(link.href, function(data){
+                $(link).replaceWith(data);
+                hs.updateAnchors();
+            });
+        }
+
+        </script>
+        '''
+
+    return _get_bibdoc_pictures_page(bfo, rec_data, display_name, display_reference,
+                                     display_description, display_comment,
+                                     display_tirage, submission_doctype,
+                                     page, page_size) + \
+           '''<script type="text/javascript">
+        window.onload = function() {
+            if (location.hash != ''){
+                    var pic = document.getElementById('thumb'+location.hash.substring(1));
+                    if (pic != null){
+                        hs.expand(pic)
+                    }
+                }
+        }
+                </script>''' + \
+           show_hide_images_js
+
+
+def _get_page(page, page_size):
+    """Returns the page and the page size (0 for all) as integers"""
+    page = str(page).isdigit() and max(int(page), 1) or 1
+    if str(page_size).isdigit():
+        page_size = int(page_size)
+    else:
+        page_size = CFG_PHOTO_ALBUM_PAGE_SIZE
+    if not page_size:
+        return (1, 0)
+    return (page, page_size)
+
+
+def _get_bibdoc_pictures_page(bfo, rec_data, display_name, display_reference,
+                              display_description, display_comment,
+                              display_tirage, submission_doctype,
+                              page="1", page_size=""):
+    """
+    Returns the html code of the photos of the given page, followed by a
+    link to the next page if any
+    """
+    (page, page_size) = _get_page(page, page_size)
+    if page_size:
+        page_data = rec_data[(page - 1) * page_size:page * page_size]
+    else:
+        page_data = rec_data
     out = []
     separator = ''
 
@@ -413,7 +494,7 @@ def get_bibdoc_pictures(bfo, display_name, display_reference,
         image_style_2 = "height:210px;width:180px;float:left;text-align:center;vertical-align:bottom;"
         image_style_3 = "max-height:140px; max-width:180px;"
 
-    for bibdoc_picture_struct in rec_data:
+    for bibdoc_picture_struct in page_data:
         photo_files = []
         for picture_details in bibdoc_picture_struct['download_links']:
             photo_files.append((picture_details['format'], picture_details['url']))
@@ -458,37 +539,53 @@ def get_bibdoc_pictures(bfo, display_name, display_reference,
              'separator': separator,
              'edit_link': bibdoc_picture_struct['submit_link']})
 
-    show_hide_images_js = '''
-        <script type="text/javascript">
-        function toggle_images_visibility(){
-            var more = document.getElementById('more');
-            var link = document.getElementById('link');
-            more.innerHTML = more.innerHTML.substring(4, more.innerHTML.length - 3);
-            link.style.display='none';
-            hs.updateAnchors();
-        }
+    if page_size and page * page_size < len(rec_data):
+        args = urlencode([('page', page + 1), ('page_size', page_size),
+                          ('display_name', display_name),
+                          ('display_reference', display_reference),
+                          ('display_description', display_description),
+                          ('display_comment', display_comment),
+                          ('display_tirage', display_tirage),
+                          ('submission_doctype', submission_doctype)])
+        out.append('<a class="more_images_link" href="%s" onclick="load_more_images(this);return false;" style="float:left;color:rgb(204,0,0);">%s</a>' % \
+                   (cgi.escape(CFG_PHOTO_ALBUM_PAGE_URL % {'recid': bfo.recID, 'args': args}, True),
+                    "Show %i more of %i images" % (min(page_size, len(rec_data) - page * page_size),
+                                                          len(rec_data))))
+    return ''.join(out)
+
+
+def format_photo_album_page(recid, page="1", page_size="", display_name="no",
+                            display_reference="yes", display_description="yes",
+                            display_comment="yes", display_tirage="yes",
+                            submission_doctype=""):
+    """
+    Returns the html code of the given page of photos attached to the
+    record, to be appended to the photos already displayed (see
+    get_bibdoc_pictures). Served at CFG_PHOTO_ALBUM_PAGE_URL by
+    media_webinterface, which checks that the user can see the record;
+    the parameters of the URL are the arguments of this function.
+    """
+    bfo = BibFormatObject(recid)
+    return _get_bibdoc_pictures_page(bfo, get_bibdoc_pictures_struct(bfo, submission_doctype),
+                                     display_name, display_reference,
+                                     display_description, display_comment,
+                                     display_tirage, submission_doctype,
+                                     page, page_size)
 
-        </script>
-        '''#%{'show_less': "Hide",
-           #  'show_more': "Show all %i images" % len(rec_data)}
-
-    DISPLAY_MAX_RECORDS = 20
-    return ''.join(out[:DISPLAY_MAX_RECORDS])+ \
-           (len(out) > DISPLAY_MAX_RECORDS and \
-            ('<div id="more"><!--' + ''.join(out[DISPLAY_MAX_RECORDS:]) + '--></div>' + \
-        '<a id="link" href="" onclick="toggle_images_visibility();return false;" style="float:left;color:rgb(204,0,0);">%s</a>' % "Show all %i images" % len(rec_data))
-            or '') + \
-           '''<script type="text/javascript">
-        window.onload = function() {
-            if (location.hash != ''){
-                    var pic = document.getElementById('thumb'+location.hash.substring(1));
-                    if (pic != null){
-                        hs.expand(pic)
-                    }
-                }
-        }
-                </script>''' + \
-           show_hide_images_js
+
+def get_photo_media(bfo, check_existence=True):
+    """
+    Returns the structure returned by get_media, with the information
+    about the master of each tirage.
+    @param check_existence if True, check that files are reachable
+    """
+    multimedia = get_media(bfo, check_existence=check_existence)
+    # Also append master information to the multimedia structure
+    masters = get_media(bfo, path_code='d', internal_note_code='x', check_existence=check_existence)
+    for (tirage, info) in masters.iteritems():
+        if multimedia.has_key(tirage):
+            multimedia[tirage]['master'] = info['master']
+    return multimedia
 
 def get_media(bfo, tag="8567_", tirage_code='8', path_code='u', internal_note_code='y', label_code='x',
               check_existence=True):
@@ -520,14 +617,16 @@ def get_media(bfo, tag="8567_", tirage_code='8', path_code='u', internal_note_co
 
     """
     out = {}
-    files = bfo.fields(tag)
+    files = [media for media in bfo.fields(tag) if media.get(path_code, None) is not None]
+    missing_paths = set()
+    if check_existence:
+        if files:
+            set_fragment_uncacheable(bfo)
+        # Check all the files at once
+        missing_paths = get_missing_urls([media[path_code].replace('http://mediaarchive.cern.ch', 'https://mediastream.cern.ch') \
+                                          for media in files])
     for media in files:
-        path = media.get(path_code, None)
-        if path is None:
-            # Do not process if path does not exist
-            continue
-        else:
-            path = path.replace('http://mediaarchive.cern.ch', 'https://mediastream.cern.ch')
+        path = media[path_code].replace('http://mediaarchive.cern.ch', 'https://mediastream.cern.ch')
         tirage = media.get(tirage_code, '')
         if not out.has_key(tirage):
             out[tirage] = {}
@@ -535,7 +634,7 @@ def get_media(bfo, tag="8567_", tirage_code='8', path_code='u', internal_note_co
         label = media.get(label_code, '')
         media_type = get_media_type(internal_note)
         info = {}
-        if not check_existence or file_exists(path):
+        if path not in missing_paths:
             info['path'] = path
         info['filename'] = get_filename(path)
         info['file_type'] = get_format(path)
@@ -616,7 +715,7 @@ def print_images(multimedia, bfo, media_type="icon", on_magnify_type="a5", on_cl
     except:
         tirages.sort()
 
-    recstruct = get_record(bfo.recID)
+    captions = get_photolab_image_captions(bfo.get_record())
     for tirage in tirages:
         if max_nb is not None and i >= int(max_nb):
             # stop as soon as max number of video is reached
@@ -668,7 +767,7 @@ def print_images(multimedia, bfo, media_type="icon", on_magnify_type="a5", on_cl
             image_url = ''
 
         #get description
-        full_photo_description = get_photolab_image_caption(recstruct, tirage)
+        full_photo_description = captions.get(tirage, '')
         photo_description = full_photo_description[:]
         if len(photo_description) > MAX_LEN_CAPTION:
             photo_description = photo_description[:MAX_LEN_CAPTION] + \
@@ -721,26 +820,11 @@ def print_images(multimedia, bfo, media_type="icon", on_magnify_type="a5", on_cl
     return ' '.join(out)
 
 def is_user_at_cern(bfo):
-    client_ip = bfo.user_info['remote_ip']
-    if client_ip.startswith("137.138") or \
-          client_ip.startswith("128.141") or \
-          client_ip.startswith("128.142") or \
-          client_ip.startswith("192.91") or \
-          client_ip.startswith("194.12") or \
-          client_ip.startswith("192.16"):
-        return True
-    return False
+    return is_cern_ip(bfo.user_info['remote_ip'])
 
 def file_exists(url):
     """
     Returns True if resource could be found at url. Else returns false
+    (see media_prober.get_missing_urls)
     """
-    pipe_input, pipe_output, pipe_error = os.popen3('/usr/bin/wget --spider -S -t 1 -T 3 ' +\
-                                                    url)
-    pipe_input.close()
-    res = pipe_error.read()
-    pipe_output.close()
-    if not 'ERROR 404' in res:
-        return True
-    else:
-        return False
+    return url not in get_missing_urls([url])
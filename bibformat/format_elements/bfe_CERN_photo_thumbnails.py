@@ -25,15 +25,17 @@ BibFormat element - Prints brief HTML picture and links to resources.
 
 __revision__ = "$Id$"
 
-import os
 from operator import itemgetter
 from invenio.config import weburl
 from invenio.bibdocfile import BibRecDocs
-from invenio.mediaarchive_utils import _perform_request_add_slave_url
 from invenio.media_utils import alphanum
-from invenio.bibformat_engine import BibFormatObject
+from invenio.media_prober import get_missing_urls
+from invenio.icon_repair_queue import enqueue_icon_repair
+from invenio.fragment_cache import cached_format_element, set_fragment_uncacheable
+from invenio.record_prefetch import get_related_bfo
 from invenio.urlutils import url_safe_escape
 
+@cached_format_element('BFE_CERN_PHOTO_THUMBNAILS', bibdocs=True)
 def format_element(
     bfo,
     limit,
@@ -61,6 +63,8 @@ def format_element(
     album = bfo.field('999__a') == "ALBUM"
 
     if album:
+        # The photos are read from other records
+        set_fragment_uncacheable(bfo)
         if use_cover_photos_only == "yes":
             # Get all the photos in this album
             photos_in_album = bfo.fields('774')
@@ -79,7 +83,7 @@ def format_element(
                 return ''
         else:
             record_id = bfo.field('774__r')
-        record = BibFormatObject(record_id)
+        record = get_related_bfo(bfo, record_id)
         resources_1 = record.fields("8567_")
         resources_2 = record.fields("8564_")
         bibarchive = BibRecDocs(record_id)
@@ -248,13 +252,15 @@ def format_element(
     # icon exist for that record (there are chances that this
     # icon will be created later)
     #
-    # If icon exists but not in metadata, try to update record metadata
+    # If icon exists but not in metadata, enqueue the update of the record
+    # metadata (see icon_repair_queue)
     icon_exists_links = []
     icon_missing_links = []
     if out == '':
         masters_paths = [link['d'] for link in bfo.fields('8567_') \
                          if link.get('x', '') == 'Absolute master path' and \
                             link.get('d', '') != '']
+        icon_links = []
         for master_path in masters_paths:
             try:
                 path_components = master_path.split('\\')[-3:] # take 3 last components
@@ -263,8 +269,17 @@ def format_element(
                 path_components.append(filename)
                 link = 'http://mediaarchive.cern.ch/MediaArchive/Photo/Public/' + \
                        '/'.join(path_components)
-                # check if file exists
-                if file_exists(link):
+                icon_links.append((link, path_components))
+            except Exception, e:
+                continue
+        # check if files exist, all at once, without waiting: the icons
+        # that were not checked yet are assumed to exist
+        missing_links = get_missing_urls([link for (link, dummy) in icon_links], budget=0)
+        if icon_links:
+            set_fragment_uncacheable(bfo)
+        for (link, path_components) in icon_links:
+            try:
+                if link not in missing_links:
                     icon_exists_links.append('<a href="' + weburl + '/record/' + \
                                              bfo.control_field("001") + '">' + \
                                              '<img '+style+' src="' + link + '" alt="" border="0"/></a>')
@@ -273,7 +288,7 @@ def format_element(
                     info_xml_url = 'http://mediaarchive.cern.ch/MediaArchive/Photo/Public/' + \
                                    '/'.join(path_components[:-1]) + \
                                    '/' + 'info.xml'
-                    _perform_request_add_slave_url(info_xml_url)
+                    enqueue_icon_repair(info_xml_url, link)
                 else:
                     icon_missing_links.append('<a href="' + weburl + '/record/' + \
                                               bfo.control_field("001") + '">' + \
@@ -313,17 +328,10 @@ def escape_values(bfo):
 def file_exists(url, download_result=False):
     """
     Returns True if resource could be found at url. Else returns false
+    (see media_prober.get_missing_urls)
 
-    @param download_result If False, use 'wget' with --spider option.
-                           You should use download_result=True if accessed url has get/post parameters.
+    @param download_result Kept for compatibility: files are checked
+                           with HEAD requests, and downloaded only if
+                           the server does not support them.
     """
-    pipe_input, pipe_output, pipe_error = os.popen3('/usr/bin/wget %s -S -t 1 -T 3 -O - %s > /dev/null' % \
-                                                    ((not download_result and '--spider') or '',
-                                                    url))
-    pipe_input.close()
-    res = pipe_error.read()
-    pipe_output.close()
-    if not 'ERROR 404' in res:
-        return True
-    else:
-        return False
+    return url not in get_missing_urls([url])
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Utils functions for the caches of values computed from records.
+"""
+
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from invenio.dbquery import run_sql, get_table_update_time, deserialize_via_marshal
+from invenio.search_engine import get_collection_reclist
+
+# Time (in seconds) after which the records of a collection are read
+# again, if the collections have been updated since (see
+# get_collection_members)
+CFG_COLLECTION_MEMBERSHIP_REFRESH = 300
+
+# The records of the collections: collection -> (time of the last check,
+# update time of the collections, records)
+_collection_members = {}
+
+
+def get_record_revision(recid):
+    """
+    Returns the revision of the record, i.e. its last modification date
+    as a string (e.g. '20131024153012'), or None if the record does not
+    exist. Values computed from a record can be stored together with
+    its revision, and be considered stale once the revision changed.
+    """
+    return get_record_revisions([recid]).get(int(recid))
+
+
+def get_record_revisions(recids):
+    """
+    Returns a dictionary with the revisions of the given records (see
+    get_record_revision). Records that do not exist are not returned.
+    """
+    revisions = {}
+    recids = [int(recid) for recid in recids]
+    for i in xrange(0, len(recids), 1000):
+        chunk = recids[i:i + 1000]
+        res = run_sql("SELECT id, DATE_FORMAT(modification_date, '%%Y%%m%%d%%H%%i%%s') "
+                      "FROM bibrec WHERE id IN (%s)" % ','.join(['%s'] * len(chunk)),
+                      tuple(chunk))
+        revisions.update(dict(res))
+    return revisions
+
+
+def get_bibdocs_revision(recid):
+    """
+    Returns the revision of the documents attached to the record (see
+    get_bibdocs_revisions), or None if the record has no documents.
+    """
+    return get_bibdocs_revisions([recid]).get(int(recid))
+
+
+def get_bibdocs_revisions(recids):
+    """
+    Returns a dictionary with the revisions of the documents attached to
+    the given records: the last modification date of their bibdocs and
+    their number (e.g. '20131024153012-12'). The bibdocfile operations
+    (hiding, deleting, adding a format...) change the documents without
+    changing the revision of the record. Records without documents are
+    not returned.
+    """
+    revisions = {}
+    recids = [int(recid) for recid in recids]
+    for i in xrange(0, len(recids), 1000):
+        chunk = recids[i:i + 1000]
+        res = run_sql("SELECT bb.id_bibrec, DATE_FORMAT(MAX(bd.modification_date), '%%Y%%m%%d%%H%%i%%s'), "
+                      "COUNT(*) FROM bibrec_bibdoc AS bb JOIN bibdoc AS bd ON bb.id_bibdoc=bd.id "
+                      "WHERE bb.id_bibrec IN (%s) GROUP BY bb.id_bibrec" % ','.join(['%s'] * len(chunk)),
+                      tuple(chunk))
+        for (recid, modification_date, nb_bibdocs) in res:
+            revisions[recid] = '%s-%s' % (modification_date, nb_bibdocs)
+    return revisions
+
+
+def get_marcxml_records(recids):
+    """
+    Returns a dictionary with the MARCXML of the given records, read at
+    once from the formatted records cache (bibfmt). Records whose MARCXML
+    is not cached are not returned.
+    """
+    records = {}
+    recids = [int(recid) for recid in recids]
+    for i in xrange(0, len(recids), 1000):
+        chunk = recids[i:i + 1000]
+        res = run_sql("SELECT id_bibrec, value FROM bibfmt WHERE format='xm' "
+                      "AND id_bibrec IN (%s)" % ','.join(['%s'] * len(chunk)),
+                      tuple(chunk))
+        for (recid, value) in res:
+            try:
+                records[recid] = zlib.decompress(value)
+            except zlib.error:
+                continue
+    return records
+
+
+def get_record_structures(recids):
+    """
+    Returns a dictionary with the record structures of the given records
+    (as search_engine.get_record returns them), read at once from the
+    serialized structures of the formatted records cache (bibfmt).
+    Records whose structure is not cached are not returned.
+    """
+    records = {}
+    recids = [int(recid) for recid in recids]
+    for i in xrange(0, len(recids), 1000):
+        chunk = recids[i:i + 1000]
+        res = run_sql("SELECT id_bibrec, value FROM bibfmt WHERE format='recstruct' "
+                      "AND id_bibrec IN (%s)" % ','.join(['%s'] * len(chunk)),
+                      tuple(chunk))
+        for (recid, value) in res:
+            try:
+                records[recid] = deserialize_via_marshal(value)
+            except (zlib.error, ValueError, EOFError, TypeError):
+                continue
+    return records
+
+
+def get_collection_members(collection):
+    """
+    Returns the records of the collection (intbitset), kept in memory
+    and read again every CFG_COLLECTION_MEMBERSHIP_REFRESH seconds if the
+    collections have been updated (by webcoll) since.
+    """
+    now = time.time()
+    entry = _collection_members.get(collection)
+    if entry is None or now - entry[0] >= CFG_COLLECTION_MEMBERSHIP_REFRESH:
+        update_time = get_table_update_time('collection')
+        if entry is None or entry[1] != update_time:
+            entry = (now, update_time, get_collection_reclist(collection))
+        else:
+            entry = (now, update_time, entry[2])
+        _collection_members[collection] = entry
+    return entry[2]
+
+
+def is_record_in_collection(recid, collections):
+    """
+    Returns True if the record belongs to the collection, or to one of
+    the collections if a list is given, as a search for 'recid:RECID' in
+    these collections would tell, but without searching.
+    """
+    if isinstance(collections, basestring):
+        collections = [collections]
+    recid = int(recid)
+    for collection in collections:
+        if recid in get_collection_members(collection):
+            return True
+    return False
+
+
+class TTLCache(object):
+    """
+    A bounded and thread-safe cache, whose values expire after a given
+    time to live. When full, the least recently used values are dropped
+    first.
+
+    The time to live can be given for each value, e.g. so that negative
+    results are kept for less time than positive ones:
+
+        cache = TTLCache(max_size=1000, ttl=3600)
+        value = cache.get(key)
+        if value is None:
+            value = compute(key)
+            cache.set(key, value, ttl=value and 3600 or 300)
+    """
+
+    def __init__(self, max_size=1000, ttl=3600):
+        """
+        @param max_size: the maximum number of values in the cache
+        @param ttl: the default time to live of the values, in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for key, or default if there is none or
+        if it expired
+        """
+        self._lock.acquire()
+        try:
+            try:
+                (expires, value) = self._values.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < time.time():
+                self.misses += 1
+                return default
+            # Mark as most recently used
+            self._values[key] = (expires, value)
+            self.hits += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl=None):
+        """
+        Caches value for key, for ttl seconds (or the default time to live)
+        """
+        if ttl is None:
+            ttl = self.ttl
+        self._lock.acquire()
+        try:
+            self._values.pop(key, None)
+            self._values[key] = (time.time() + ttl, value)
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        """Removes the value cached for key, if any"""
+        self._lock.acquire()
+        try:
+            self._values.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Removes all the values"""
+        self._lock.acquire()
+        try:
+            self._values.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get_stats(self):
+        """Returns a dictionary with the number of hits, misses and evictions"""
+        return {'size': len(self._values),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Precompiled format templates (.bft files).
+
+For each record, BibFormat filters the <lang> tags of the template,
+translates its _(...)_ strings, and looks for the <BFE_...> tags and
+their parameters with regular expressions. A plan does all this once
+per template and language: it is the list of the static chunks of the
+template, and of the elements to call with their parameters already
+parsed. Rendering a record with a plan gives the same output as
+bibformat_engine.format_with_format_template, since the plan is built
+with the patterns of the engine and the elements are evaluated the
+same way.
+
+The plans are compiled again when their template file changes, and the
+plans of the photo and video templates can be compiled when the worker
+starts (see load_format_template_plans). They are checked against the
+engine by running this module with some records:
+
+    $ python format_template_plans.py --check 1234,5678
+"""
+
+import cgi
+import os
+import threading
+from optparse import OptionParser
+
+from invenio.config import CFG_BIBFORMAT_TEMPLATES_PATH, CFG_SITE_LANGS
+from invenio.bibformat_engine import pattern_tag, pattern_function_params, \
+     pattern_format_template_name, pattern_format_template_desc, \
+     translation_pattern, filter_languages, get_format_element, \
+     eval_format_element, format_with_format_template, BibFormatObject
+from invenio.bibformat_config import InvenioBibFormatError
+from invenio.errorlib import register_exception
+from invenio.messages import gettext_set_language
+from invenio.record_prefetch import get_prefetched_bfos
+
+# The templates whose plans are compiled when the worker starts
+CFG_FORMAT_TEMPLATE_PLANS_PRELOAD = ('81.brief.bft', '81.detail.bft', '81.similarity.bft',
+                                     '81.actions.bft', '85.brief.bft', '85.detail.bft',
+                                     '85.similarity.bft', '85.horizontal.bft')
+
+# The plans: (template filename, ln) -> (mtime, plan)
+_plans = {}
+_plans_lock = threading.Lock()
+
+
+def compile_format_template(code, ln):
+    """
+    Returns the plan of the code of a format template in the given
+    language: a list of static chunks (strings) and of elements to call
+    (name, parameters) couples, in the order of the template.
+    """
+    _ = gettext_set_language(ln)
+    def translate(match):
+        "Translates a _(...)_ string of the template"
+        return _(match.group("word"))
+    localized_code = translation_pattern.sub(translate, filter_languages(code, ln))
+
+    plan = []
+    position = 0
+    for match in pattern_tag.finditer(localized_code):
+        if match.start() > position:
+            plan.append(localized_code[position:match.start()])
+        params = {}
+        if match.group('params') is not None:
+            for param_match in pattern_function_params.finditer(match.group('params')):
+                params[param_match.group('param')] = param_match.group('value')
+        plan.append((match.group('function_name'), params))
+        position = match.end()
+    if position < len(localized_code):
+        plan.append(localized_code[position:])
+    return plan
+
+
+def _get_format_template_code(filename):
+    """
+    Returns the code of the format template file, without its name and
+    description, and the mtime of the file
+    """
+    path = os.path.join(CFG_BIBFORMAT_TEMPLATES_PATH, filename)
+    mtime = os.path.getmtime(path)
+    template_file = open(path)
+    try:
+        code = template_file.read()
+    finally:
+        template_file.close()
+    code = pattern_format_template_name.sub("", code, 1)
+    code = pattern_format_template_desc.sub("", code, 1)
+    return (code, mtime)
+
+
+def get_format_template_plan(filename, ln):
+    """
+    Returns the plan of the format template in the given language,
+    compiled again when the template file changes
+    """
+    path = os.path.join(CFG_BIBFORMAT_TEMPLATES_PATH, filename)
+    mtime = os.path.getmtime(path)
+    plan = _plans.get((filename, ln))
+    if plan is not None and plan[0] == mtime:
+        return plan[1]
+    _plans_lock.acquire()
+    try:
+        (code, mtime) = _get_format_template_code(filename)
+        plan = compile_format_template(code, ln)
+        _plans[(filename, ln)] = (mtime, plan)
+        return plan
+    finally:
+        _plans_lock.release()
+
+
+def load_format_template_plans(filenames=CFG_FORMAT_TEMPLATE_PLANS_PRELOAD):
+    """
+    Compiles the plans of the format templates in all the languages of
+    the site, e.g. when the worker starts
+    """
+    for filename in filenames:
+        for ln in CFG_SITE_LANGS:
+            get_format_template_plan(filename, ln)
+
+
+def _eval_element(function_name, params, bfo, verbose=0):
+    """
+    Returns the output of an element of a plan, as
+    bibformat_engine.eval_format_template_elements computes it
+    """
+    _ = gettext_set_language(bfo.lang)
+    try:
+        format_element = get_format_element(function_name, verbose)
+    except Exception, e:
+        format_element = None
+        if verbose >= 5:
+            return '<b><span style="color: rgb(255, 0, 0);">' + \
+                   cgi.escape(str(e)).replace('\n', '<br/>') + \
+                   '</span>'
+    if format_element is None:
+        try:
+            raise InvenioBibFormatError(_('Could not find format element named %s.') % function_name)
+        except InvenioBibFormatError, exc:
+            register_exception()
+        if verbose >= 5:
+            return '<b><span style="color: rgb(255, 0, 0);">' + \
+                   str(exc.message) + '</span></b>'
+        return ''
+    # The parameters are modified by some elements
+    (result, dummy) = eval_format_element(format_element, bfo, dict(params), verbose)
+    return result or ''
+
+
+def format_with_format_template_plan(filename, bfo, verbose=0):
+    """
+    Returns the record of bfo formatted with the format template (same
+    as bibformat_engine.format_with_format_template for .bft templates)
+    """
+    out = []
+    for chunk in get_format_template_plan(filename, bfo.lang):
+        if isinstance(chunk, tuple):
+            out.append(_eval_element(chunk[0], chunk[1], bfo, verbose))
+        else:
+            out.append(chunk)
+    return ''.join(out)
+
+
+def format_records_with_format_template_plan(recids, filename, ln, search_pattern=None,
+                                             user_info=None, verbose=0):
+    """
+    Returns the list of the given records formatted with the format
+    template, e.g. for a page of results, after reading the records at
+    once (see record_prefetch)
+    """
+    return [format_with_format_template_plan(filename, bfo, verbose)
+            for bfo in get_prefetched_bfos(recids, ln, search_pattern, user_info)]
+
+
+def main():
+    """
+    Compiles the plans of the format templates, and checks that they
+    format the given records as the engine does.
+    """
+    parser = OptionParser(usage="%prog [--check recid,...] [template ...]")
+    parser.add_option("-c", "--check", dest="check", default="",
+                      help="comma-separated records to format with both")
+    parser.add_option("-l", "--ln", dest="ln", default="en",
+                      help="language of the output")
+    (options, filenames) = parser.parse_args()
+    if not filenames:
+        filenames = CFG_FORMAT_TEMPLATE_PLANS_PRELOAD
+
+    failures = 0
+    for filename in filenames:
+        plan = get_format_template_plan(filename, options.ln)
+        print "%s: %s chunks, %s elements" % (filename, len(plan),
+                                              len([chunk for chunk in plan if isinstance(chunk, tuple)]))
+        for recid in [int(recid) for recid in options.check.split(',') if recid.strip()]:
+            expected = format_with_format_template(filename, BibFormatObject(recid, ln=options.ln))
+            output = format_with_format_template_plan(filename, BibFormatObject(recid, ln=options.ln))
+            if output != expected:
+                print "  record %s: different output" % recid
+                failures += 1
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Cache of the HTML fragments produced for the records (output of the
+format elements, formatted records).
+
+A fragment is cached for the revision of the record it was produced
+from, so that it is not used anymore once the record is modified. The
+fragments are kept in memory (least recently used dropped first), and
+optionally in files in CFG_FRAGMENT_CACHE_DIR, shared by the processes.
+
+A format element opts in with the cached_format_element decorator:
+
+    @cached_format_element('BFE_CERN_MOVIE', bibdocs=True)
+    def format_element(bfo, display_as="embed", ...):
+        ...
+
+Its output is then cached per parameters, record revision, language,
+output format and class of user (see get_user_class), and per revision of the documents
+attached to the record if the element displays them (bibdocs=True).
+
+Only what is a function of the record can be cached. When an element
+produces an output that depends on something else (the existence of
+files on the MediaArchive, other records, their restrictions...), it
+calls set_fragment_uncacheable so that this output is not cached.
+"""
+
+import inspect
+import os
+import threading
+import time
+import zlib
+from hashlib import md5
+
+from invenio.config import CFG_CACHEDIR
+from invenio.dbquery import serialize_via_marshal, deserialize_via_marshal
+from invenio.cache_utils import TTLCache, get_record_revision, get_record_revisions, \
+     get_bibdocs_revision, get_bibdocs_revisions
+from invenio.media_utils import get_request_cache, is_cern_ip
+
+CFG_FRAGMENT_CACHE_ENABLED = True
+# Number of fragments kept in memory, and for how long (in seconds)
+CFG_FRAGMENT_CACHE_SIZE = 10000
+CFG_FRAGMENT_CACHE_TTL = 86400
+# If True, the fragments are also kept in files in CFG_FRAGMENT_CACHE_DIR
+CFG_FRAGMENT_CACHE_DISK_ENABLED = False
+CFG_FRAGMENT_CACHE_DIR = os.path.join(CFG_CACHEDIR, 'fragment_cache')
+
+_memory_cache = TTLCache(max_size=CFG_FRAGMENT_CACHE_SIZE, ttl=CFG_FRAGMENT_CACHE_TTL)
+_disk_stats = {'hits': 0, 'misses': 0}
+_disk_stats_lock = threading.Lock()
+
+
+def get_user_class(bfo):
+    """
+    Returns the class of the user the record is formatted for, i.e. what
+    the output of the elements depends on: 'guest' or 'guest-cern' (guest
+    at CERN). Returns None for logged-in users, whose output depends on
+    their own rights and must not be cached.
+    """
+    user_info = getattr(bfo, 'user_info', None) or {}
+    if str(user_info.get('guest', '1')) != '1':
+        return None
+    if is_cern_ip(user_info.get('remote_ip')):
+        return 'guest-cern'
+    return 'guest'
+
+
+def get_cached_record_revision(bfo):
+    """
+    Returns the revision of the record of bfo, read only once while
+    formatting the record (see cache_utils.get_record_revision)
+    """
+    cache = get_request_cache(bfo, 'record_revision')
+    if bfo.recID not in cache:
+        cache[bfo.recID] = get_record_revision(bfo.recID)
+    return cache[bfo.recID]
+
+
+def get_cached_bibdocs_revision(bfo):
+    """
+    Returns the revision of the documents attached to the record of bfo,
+    read only once while formatting the record (see
+    cache_utils.get_bibdocs_revision)
+    """
+    cache = get_request_cache(bfo, 'bibdocs_revision')
+    if bfo.recID not in cache:
+        cache[bfo.recID] = get_bibdocs_revision(bfo.recID)
+    return cache[bfo.recID]
+
+
+def set_fragment_uncacheable(bfo):
+    """
+    Marks the output the element is producing for the record of bfo as
+    not cacheable, because it does not depend only on the record (e.g.
+    files checked on the MediaArchive, other records)
+    """
+    get_request_cache(bfo, 'fragment_cache')['uncacheable'] = True
+
+
+def is_fragment_uncacheable(bfo):
+    """
+    Returns True if the output produced for the record of bfo was marked
+    as not cacheable (see set_fragment_uncacheable)
+    """
+    return get_request_cache(bfo, 'fragment_cache').get('uncacheable', False)
+
+
+def _get_fragment_path(key):
+    """
+    Returns the path of the file of the fragment in the disk cache
+    """
+    digest = md5(repr(key)).hexdigest()
+    return os.path.join(CFG_FRAGMENT_CACHE_DIR, digest[:2], digest)
+
+
+def _count_disk_access(hit):
+    """Counts a hit or a miss of the disk cache"""
+    _disk_stats_lock.acquire()
+    try:
+        _disk_stats[hit and 'hits' or 'misses'] += 1
+    finally:
+        _disk_stats_lock.release()
+
+
+def get_fragment(key):
+    """
+    Returns the fragment cached for key, or None
+    """
+    fragment = _memory_cache.get(key)
+    if fragment is not None or not CFG_FRAGMENT_CACHE_DISK_ENABLED:
+        return fragment
+    path = _get_fragment_path(key)
+    try:
+        if time.time() - os.path.getmtime(path) < CFG_FRAGMENT_CACHE_TTL:
+            fragment_file = open(path, 'rb')
+            try:
+                (cached_key, fragment) = deserialize_via_marshal(fragment_file.read())
+            finally:
+                fragment_file.close()
+            if cached_key == repr(key):
+                _count_disk_access(True)
+                _memory_cache.set(key, fragment)
+                return fragment
+    except (OSError, IOError, EOFError, ValueError, TypeError, zlib.error):
+        pass
+    _count_disk_access(False)
+    return None
+
+
+def set_fragment(key, fragment):
+    """
+    Caches the fragment for key
+    """
+    _memory_cache.set(key, fragment)
+    if not CFG_FRAGMENT_CACHE_DISK_ENABLED:
+        return
+    path = _get_fragment_path(key)
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # Write to a temporary file first, so that the fragment is never
+        # read half written
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        fragment_file = open(tmp_path, 'wb')
+        try:
+            fragment_file.write(serialize_via_marshal((repr(key), fragment)))
+        finally:
+            fragment_file.close()
+        os.rename(tmp_path, path)
+    except (OSError, IOError):
+        pass
+
+
+def get_fragment_key(name, params, recid, revision, ln, user_class, output_format=None):
+    """
+    Returns the key of a fragment in the cache.
+
+    @param name: the name of the element (or of the kind of fragment)
+    @param params: dictionary of the parameters the fragment depends on
+    @param recid: the record the fragment was produced from
+    @param revision: the revision of the record
+    @param ln: the language of the fragment
+    @param user_class: the class of the user (see get_user_class)
+    @param output_format: the output format the fragment is produced for
+    """
+    return (name, tuple(sorted(params.items())), int(recid), revision, ln, user_class,
+            output_format)
+
+
+def get_cached_fragments(name, params, recids, ln, user_class, produce, bibdocs=False):
+    """
+    Returns the list of the fragments of the given records, produced by
+    produce(list of recids) -> list of (fragment, cacheable) couples for
+    the records whose fragment is not cached yet, or was produced from an
+    older revision of the record. The revisions of the records (and of
+    their documents if bibdocs is True) are read in one query.
+    """
+    revisions = get_record_revisions(recids)
+    if bibdocs:
+        bibdocs_revisions = get_bibdocs_revisions(recids)
+        revisions = dict([(recid, (revision, bibdocs_revisions.get(recid)))
+                          for (recid, revision) in revisions.iteritems()])
+    fragments = {}
+    missing = []
+    for recid in recids:
+        revision = revisions.get(int(recid))
+        if revision is not None:
+            fragment = get_fragment(get_fragment_key(name, params, recid, revision,
+                                                     ln, user_class))
+            if fragment is not None:
+                fragments[recid] = fragment
+                continue
+        if recid not in missing:
+            missing.append(recid)
+    for (recid, (fragment, cacheable)) in zip(missing, produce(missing)):
+        fragments[recid] = fragment
+        revision = revisions.get(int(recid))
+        if revision is not None and cacheable:
+            set_fragment(get_fragment_key(name, params, recid, revision, ln, user_class),
+                         fragment)
+    return [fragments[recid] for recid in recids]
+
+
+def cached_format_element(name, user_class=get_user_class, bibdocs=False):
+    """
+    Decorator of the format_element function of an element, that caches
+    its output (see module documentation).
+
+    The decorated function keeps the same arguments, since BibFormat
+    reads the parameters of the element from them.
+
+    @param name: the name of the element
+    @param user_class: function returning the class of the user the
+                       record is formatted for (see get_user_class)
+    @param bibdocs: if True, the output also depends on the documents
+                    attached to the record (see get_cached_bibdocs_revision)
+    """
+    def decorator(format_element):
+        (args, varargs, varkw, dummy) = inspect.getargspec(format_element)
+        if varargs or varkw or not args or args[0] != 'bfo':
+            # Cannot build a function with the same arguments
+            return format_element
+
+        def format_element_with_cache(params):
+            "Returns the output of the element, from the cache if possible"
+            bfo = params.pop('bfo')
+            if not CFG_FRAGMENT_CACHE_ENABLED:
+                return format_element(bfo, **params)
+            revision = get_cached_record_revision(bfo)
+            bfo_user_class = user_class(bfo)
+            if revision is None or bfo_user_class is None:
+                return format_element(bfo, **params)
+            if bibdocs:
+                revision = (revision, get_cached_bibdocs_revision(bfo))
+            key = get_fragment_key(name, params, bfo.recID, revision, bfo.lang, bfo_user_class,
+                                   (bfo.output_format or '').lower())
+            try:
+                hash(key)
+            except TypeError:
+                # Parameters that are not strings
+                return format_element(bfo, **params)
+            output = get_fragment(key)
+            if output is None:
+                # The element may be called again while it formats the
+                # record (e.g. for the assets of a TOC)
+                state = get_request_cache(bfo, 'fragment_cache')
+                outer_uncacheable = state.get('uncacheable', False)
+                state['uncacheable'] = False
+                try:
+                    output = format_element(bfo, **params)
+                    uncacheable = state['uncacheable']
+                finally:
+                    state['uncacheable'] = outer_uncacheable or state['uncacheable']
+                if isinstance(output, basestring) and not uncacheable:
+                    set_fragment(key, output)
+            return output
+
+        source = "def %s(%s):\n    return _format_element_with_cache({%s})\n" % \
+                 (format_element.__name__, ', '.join(args),
+                  ', '.join(["'%s': %s" % (arg, arg) for arg in args]))
+        namespace = {'_format_element_with_cache': format_element_with_cache}
+        exec source in namespace
+        wrapper = namespace[format_element.__name__]
+        wrapper.func_defaults = format_element.func_defaults
+        wrapper.__doc__ = format_element.__doc__
+        wrapper.__module__ = format_element.__module__
+        wrapper.uncached = format_element
+        return wrapper
+    return decorator
+
+
+def get_fragment_cache_stats():
+    """
+    Returns a dictionary with the number of hits, misses and evictions of
+    the memory cache, and the number of hits and misses of the disk cache
+    """
+    stats = _memory_cache.get_stats()
+    stats['disk_hits'] = _disk_stats['hits']
+    stats['disk_misses'] = _disk_stats['misses']
+    return stats
+
+
+def clear_fragment_cache():
+    """Removes the fragments from the memory cache"""
+    _memory_cache.clear()
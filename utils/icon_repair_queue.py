@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Queue of the photo records whose icons must be added to the metadata.
+
+When a photo record has no icon in its metadata, bfe_CERN_photo_thumbnails
+guesses the URL of the icon on the MediaArchive from the master path, and
+enqueues the repair of the record instead of updating its metadata while
+formatting it. The queue is a spool directory with one file per repair,
+named after its info.xml URL, so that a repair is only enqueued once.
+
+The repairs are processed by running this module, e.g. every few
+minutes from cron:
+
+    $ python icon_repair_queue.py
+    $ python icon_repair_queue.py --threads=4
+"""
+
+import os
+import sys
+import time
+from hashlib import md5
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+
+from invenio.config import CFG_CACHEDIR
+from invenio.errorlib import register_exception
+from invenio.media_prober import get_missing_urls
+
+CFG_ICON_REPAIR_QUEUE_DIR = os.path.join(CFG_CACHEDIR, 'icon_repair_queue')
+# Number of threads processing the repairs
+CFG_ICON_REPAIR_QUEUE_THREADS = 4
+# Time (in seconds) during which a processed repair is not enqueued again
+CFG_ICON_REPAIR_QUEUE_RETRY_DELAY = 86400
+
+
+def _get_job_path(info_xml_url, extension):
+    """
+    Returns the path of the file of the repair in the queue
+    """
+    return os.path.join(CFG_ICON_REPAIR_QUEUE_DIR,
+                        '%s.%s' % (md5(info_xml_url).hexdigest(), extension))
+
+
+def enqueue_icon_repair(info_xml_url, icon_url):
+    """
+    Enqueues the update of the metadata of a record with the slaves
+    described in info_xml_url, once icon_url has been checked to exist.
+    Returns True if the repair was enqueued, False if it was already
+    (recently) enqueued or if the queue cannot be written.
+
+    Does not access the network, so that it can be called while
+    formatting records.
+    """
+    done_path = _get_job_path(info_xml_url, 'done')
+    try:
+        if time.time() - os.path.getmtime(done_path) < CFG_ICON_REPAIR_QUEUE_RETRY_DELAY:
+            return False
+    except OSError:
+        pass
+    try:
+        if not os.path.exists(CFG_ICON_REPAIR_QUEUE_DIR):
+            os.makedirs(CFG_ICON_REPAIR_QUEUE_DIR)
+        # O_EXCL: fails if the repair is already in the queue
+        job_file = os.open(_get_job_path(info_xml_url, 'job'),
+                           os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+    except OSError:
+        return False
+    try:
+        os.write(job_file, '%s\n%s\n' % (info_xml_url, icon_url))
+    finally:
+        os.close(job_file)
+    return True
+
+
+def get_pending_repairs():
+    """
+    Returns the paths of the files of the repairs in the queue
+    """
+    try:
+        filenames = os.listdir(CFG_ICON_REPAIR_QUEUE_DIR)
+    except OSError:
+        return []
+    return [os.path.join(CFG_ICON_REPAIR_QUEUE_DIR, filename)
+            for filename in sorted(filenames) if filename.endswith('.job')]
+
+
+def process_icon_repair(job_path):
+    """
+    Processes the repair stored in job_path: if its icon exists, updates
+    the metadata of the record. Returns True if the metadata was updated.
+    """
+    # Imported here, since only the worker needs it
+    from invenio.mediaarchive_utils import _perform_request_add_slave_url
+
+    # Take the job, so that concurrent workers do not process it too
+    running_path = '%s.%s.running' % (job_path[:-len('.job')], os.getpid())
+    try:
+        os.rename(job_path, running_path)
+    except OSError:
+        return False
+    try:
+        job_file = open(running_path)
+        try:
+            (info_xml_url, icon_url) = job_file.read().split('\n')[:2]
+        finally:
+            job_file.close()
+        # Only a 404 means that the icon has not been created yet
+        updated = icon_url not in get_missing_urls([icon_url], budget=60)
+        if updated:
+            _perform_request_add_slave_url(info_xml_url)
+    finally:
+        # Do not enqueue it again for some time, whatever happened
+        os.rename(running_path, job_path[:-len('.job')] + '.done')
+    return updated
+
+
+def purge_processed_repairs():
+    """
+    Removes the processed repairs older than the retry delay, so that
+    they can be enqueued again
+    """
+    try:
+        filenames = os.listdir(CFG_ICON_REPAIR_QUEUE_DIR)
+    except OSError:
+        return
+    for filename in filenames:
+        if filename.endswith('.done'):
+            path = os.path.join(CFG_ICON_REPAIR_QUEUE_DIR, filename)
+            try:
+                if time.time() - os.path.getmtime(path) >= CFG_ICON_REPAIR_QUEUE_RETRY_DELAY:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def process_icon_repairs(threads=CFG_ICON_REPAIR_QUEUE_THREADS):
+    """
+    Processes all the repairs in the queue, with a pool of threads.
+    Returns the number of repairs processed and the number of errors.
+    """
+    def process(job_path):
+        """Processes one repair, returns False on errors"""
+        try:
+            process_icon_repair(job_path)
+        except Exception:
+            register_exception(alert_admin=False,
+                               prefix="Could not repair the icons of %s" % job_path)
+            return False
+        return True
+
+    purge_processed_repairs()
+    job_paths = get_pending_repairs()
+    if not job_paths:
+        return (0, 0)
+    pool = ThreadPool(threads)
+    try:
+        results = pool.map(process, job_paths)
+    finally:
+        pool.close()
+        pool.join()
+    return (len(results), results.count(False))
+
+
+def main():
+    """
+    Processes the repairs in the queue.
+    """
+    parser = OptionParser(usage="%prog [--threads=N]")
+    parser.add_option("-t", "--threads", dest="threads", type="int",
+                      default=CFG_ICON_REPAIR_QUEUE_THREADS,
+                      help="number of repairs processed concurrently")
+    (options, dummy) = parser.parse_args()
+
+    (nb_repairs, nb_errors) = process_icon_repairs(options.threads)
+    print "%s repairs processed, %s errors" % (nb_repairs, nb_errors)
+    if nb_errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Index of the identifiers of the records (report numbers, Aleph system
+numbers, ...), to find the records they identify without searching.
+
+Each kind of identifier has a table: a file of sorted 'identifier TAB
+recid' lines, which is memory-mapped and looked up by binary search.
+The identifiers are compared case-insensitively, as the search does.
+
+An identifier that is not in its table is searched for, since its
+record may have been created since the table was updated. The tables
+are updated with the records modified since the previous run, e.g.
+every few minutes from cron:
+
+    $ python identifier_index.py
+    $ python identifier_index.py --all
+"""
+
+import mmap
+import os
+import threading
+import time
+from optparse import OptionParser
+
+from invenio.config import CFG_CACHEDIR
+from invenio.dbquery import run_sql
+from invenio.search_engine import get_field_tags
+
+CFG_IDENTIFIER_INDEX_DIR = os.path.join(CFG_CACHEDIR, 'identifier_index')
+CFG_IDENTIFIER_INDEX_LAST_RUN_FILE = os.path.join(CFG_IDENTIFIER_INDEX_DIR, 'last_run')
+# Time (in seconds) between two checks for new tables
+CFG_IDENTIFIER_INDEX_CHECK_INTERVAL = 60
+
+# The tables, and the MARC tags (or the logical fields of the search)
+# of their identifiers
+CFG_IDENTIFIER_INDEX_TABLES = {'037__a': ['037__a'],
+                               '970__a': ['970__a'],
+                               'reportnumber': 'reportnumber',
+                               'sysno': 'sysno'}
+
+# The memory-mapped tables: name -> [time of the last check, mtime, mmap]
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def _get_table_path(name):
+    """
+    Returns the path of the file of the table
+    """
+    return os.path.join(CFG_IDENTIFIER_INDEX_DIR, '%s.index' % name)
+
+
+def normalize_identifier(identifier):
+    """
+    Returns the identifier as stored in the tables
+    """
+    return ' '.join(str(identifier).replace('"', ' ').split()).lower()
+
+
+def _get_table(name):
+    """
+    Returns the memory-mapped table, mapped again when its file changes,
+    or None if it has not been built
+    """
+    _tables_lock.acquire()
+    try:
+        now = time.time()
+        table = _tables.setdefault(name, [0, None, None])
+        if now - table[0] >= CFG_IDENTIFIER_INDEX_CHECK_INTERVAL:
+            table[0] = now
+            try:
+                mtime = os.path.getmtime(_get_table_path(name))
+            except OSError:
+                mtime = None
+            if mtime != table[1]:
+                table[1] = mtime
+                table[2] = None
+                if mtime is not None:
+                    table_file = open(_get_table_path(name), 'rb')
+                    try:
+                        if os.fstat(table_file.fileno()).st_size:
+                            table[2] = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+                        else:
+                            table[2] = ''
+                    finally:
+                        table_file.close()
+        return table[2]
+    finally:
+        _tables_lock.release()
+
+
+def _lookup(table, key):
+    """
+    Returns the recids of the key in the table (mmap of sorted lines)
+    """
+    # Find the first line whose key is not lower than key
+    low = 0
+    high = len(table)
+    while low < high:
+        middle = (low + high) // 2
+        start = table.rfind('\n', 0, middle) + 1
+        if table[start:table.find('\t', start)] < key:
+            low = table.find('\n', start) + 1
+        else:
+            high = start
+    recids = []
+    prefix = key + '\t'
+    while table[low:low + len(prefix)] == prefix:
+        end = table.find('\n', low)
+        recids.append(int(table[low + len(prefix):end]))
+        low = end + 1
+    return recids
+
+
+def get_recids_for_identifiers(name, identifiers):
+    """
+    Returns a dictionary with the given identifiers as keys and the
+    sorted list of the recids they identify as values, or None if the
+    table has not been built.
+
+    The value of an identifier that is not in the table is None rather
+    than an empty list: the record may have been created or modified
+    since the table was updated, so the caller must search for it.
+
+    @param name: the name of the table (see CFG_IDENTIFIER_INDEX_TABLES)
+    @param identifiers: the identifiers to look up
+    """
+    table = _get_table(name)
+    if table is None:
+        return None
+    out = {}
+    for identifier in identifiers:
+        if identifier not in out:
+            out[identifier] = _lookup(table, normalize_identifier(identifier)) or None
+    return out
+
+
+def get_recids_for_identifier(name, identifier):
+    """
+    Returns the sorted list of the recids identified by identifier, or
+    None if the table has not been built or does not contain the
+    identifier (see get_recids_for_identifiers)
+    """
+    out = get_recids_for_identifiers(name, [identifier])
+    if out is None:
+        return None
+    return out[identifier]
+
+
+def get_identifiers(name, recids=None):
+    """
+    Returns the (identifier, recid) couples of the table, for the given
+    records only if any, read from the database
+    """
+    tags = CFG_IDENTIFIER_INDEX_TABLES[name]
+    if isinstance(tags, str):
+        tags = get_field_tags(tags)
+    deleted = set([row[0] for row in run_sql(
+        "SELECT bb.id_bibrec FROM bibrec_bib98x bb, bib98x b "
+        "WHERE bb.id_bibxxx=b.id AND b.tag='980__c' AND b.value='DELETED'")])
+    couples = set()
+    for tag in tags:
+        table = 'bib%sx' % tag[:2]
+        query = "SELECT bb.id_bibrec, b.value FROM bibrec_%s bb, %s b " \
+                "WHERE bb.id_bibxxx=b.id AND b.tag LIKE %%s" % (table, table)
+        if recids is None:
+            rows = run_sql(query, (tag, ))
+        else:
+            rows = []
+            recids = list(recids)
+            for i in xrange(0, len(recids), 1000):
+                chunk = recids[i:i + 1000]
+                rows.extend(run_sql(query + " AND bb.id_bibrec IN (%s)" % ','.join(['%s'] * len(chunk)),
+                                    tuple([tag] + chunk)))
+        for (recid, value) in rows:
+            identifier = normalize_identifier(value)
+            if identifier and recid not in deleted:
+                couples.add((identifier, int(recid)))
+    return couples
+
+
+def build_identifier_table(name, recids=None):
+    """
+    Builds the table, or updates it with the given records only
+    """
+    path = _get_table_path(name)
+    couples = get_identifiers(name, recids)
+    if recids is not None:
+        # Keep the identifiers of the other records
+        recids = set([int(recid) for recid in recids])
+        try:
+            table_file = open(path, 'rb')
+            try:
+                for line in table_file:
+                    (identifier, recid) = line.rstrip('\n').split('\t')
+                    if int(recid) not in recids:
+                        couples.add((identifier, int(recid)))
+            finally:
+                table_file.close()
+        except IOError:
+            pass
+
+    if not os.path.exists(CFG_IDENTIFIER_INDEX_DIR):
+        os.makedirs(CFG_IDENTIFIER_INDEX_DIR)
+    # Write to a temporary file first, so that the table is never read
+    # half written
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    table_file = open(tmp_path, 'wb')
+    try:
+        for (identifier, recid) in sorted(couples):
+            table_file.write('%s\t%s\n' % (identifier, recid))
+    finally:
+        table_file.close()
+    os.rename(tmp_path, path)
+    return len(couples)
+
+
+def main():
+    """
+    Updates the tables with the records modified since the previous run,
+    or builds them from all the records.
+    """
+    parser = OptionParser(usage="%prog [--all]")
+    parser.add_option("-a", "--all", dest="all", action="store_true", default=False,
+                      help="build the tables from all the records")
+    (options, dummy) = parser.parse_args()
+
+    start = time.strftime('%Y-%m-%d %H:%M:%S')
+    recids = None
+    if not options.all:
+        try:
+            since = open(CFG_IDENTIFIER_INDEX_LAST_RUN_FILE).read().strip()
+            recids = [row[0] for row in run_sql("SELECT id FROM bibrec WHERE modification_date >= %s",
+                                                (since, ))]
+        except IOError:
+            pass
+    for name in sorted(CFG_IDENTIFIER_INDEX_TABLES):
+        if recids is not None and not os.path.exists(_get_table_path(name)):
+            nb_identifiers = build_identifier_table(name)
+        else:
+            nb_identifiers = build_identifier_table(name, recids)
+        print "%s: %s identifiers" % (name, nb_identifiers)
+
+    last_run_file = open(CFG_IDENTIFIER_INDEX_LAST_RUN_FILE, 'w')
+    last_run_file.write(start)
+    last_run_file.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Media manifests of the records.
+
+The manifest of a record contains its media, as returned by get_media
+(including the resolution of the Indico paths) and by the get_media of
+bfe_CERN_photo_resources, together with the values derived from them
+(ordered names, best slave per width, posterframe). It is built when the
+record is uploaded or modified, and stored in a file keyed by the recid
+and the revision of the record, so that the format elements only need
+to parse the metadata when the manifest is missing or stale.
+
+The manifests are built by running this module after bibupload, e.g.
+every few minutes from cron:
+
+    $ python media_manifest.py
+    $ python media_manifest.py --recid=1234 --recid=1235
+    $ python media_manifest.py --since='2013-10-24 12:00:00'
+
+The media of the records from Indico are looked for on the MediaArchive
+when their metadata does not mention any (see media_utils.get_media,
+parameter 'resolve_movie_path'). Since the files can appear there at any
+time, the manifests of all these records should also be rebuilt from
+time to time, e.g. daily:
+
+    $ python media_manifest.py --indico --threads=8
+"""
+
+import os
+import sys
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+
+from invenio.config import CFG_CACHEDIR
+from invenio.dbquery import run_sql, serialize_via_marshal, \
+     deserialize_via_marshal
+from invenio.errorlib import register_exception
+from invenio.bibformat_engine import BibFormatObject
+from invenio.cache_utils import get_record_revision, get_record_revisions
+from invenio.media_utils import MediaSet, get_media, get_request_cache
+
+CFG_MEDIA_MANIFEST_VERSION = 1
+CFG_MEDIA_MANIFEST_DIR = os.path.join(CFG_CACHEDIR, 'media_manifest')
+CFG_MEDIA_MANIFEST_LAST_RUN_FILE = os.path.join(CFG_MEDIA_MANIFEST_DIR, 'last_run')
+# Widths of the player, for which the best slave is precomputed
+CFG_MEDIA_MANIFEST_PLAYER_WIDTHS = (640, )
+
+
+def get_media_manifest_path(recid):
+    """
+    Returns the path of the manifest file of the record
+    """
+    return os.path.join(CFG_MEDIA_MANIFEST_DIR, str(int(recid) / 1000),
+                        '%s.manifest' % recid)
+
+
+def get_media_manifest(recid, revision=None):
+    """
+    Returns the manifest of the record, or None if the record has no
+    manifest or if it was built for another revision of the record.
+
+    @param recid: the record id
+    @param revision: the current revision of the record, if already known
+    """
+    if revision is None:
+        revision = get_record_revision(recid)
+        if revision is None:
+            return None
+    try:
+        manifest_file = open(get_media_manifest_path(recid), 'rb')
+        try:
+            manifest = deserialize_via_marshal(manifest_file.read())
+        finally:
+            manifest_file.close()
+    except (IOError, EOFError, ValueError, TypeError, zlib.error):
+        return None
+    if manifest.get('version') != CFG_MEDIA_MANIFEST_VERSION or \
+           manifest.get('revision') != revision:
+        return None
+    return manifest
+
+
+def get_cached_media_manifest(bfo):
+    """
+    Same as get_media_manifest, for the record of bfo, but read only
+    once while formatting the record (see media_utils.get_request_cache)
+    """
+    cache = get_request_cache(bfo, 'media_manifest')
+    if bfo.recID not in cache:
+        cache[bfo.recID] = get_media_manifest(bfo.recID)
+    return cache[bfo.recID]
+
+
+def prefetch_media_manifests(bfos, revisions=None):
+    """
+    Reads the manifests of the records of the given BibFormatObjects,
+    getting the revisions of all the records in one query (unless they
+    are given), so that get_cached_media_manifest does not read them one
+    by one.
+
+    @param revisions: dictionary record id (int) -> revision
+    """
+    if revisions is None:
+        revisions = get_record_revisions([bfo.recID for bfo in bfos])
+    for bfo in bfos:
+        cache = get_request_cache(bfo, 'media_manifest')
+        if bfo.recID not in cache:
+            # The recID of a BibFormatObject built from MARCXML is read
+            # from its 001 field, as a string
+            revision = revisions.get(int(bfo.recID))
+            if revision is None:
+                cache[bfo.recID] = None
+            else:
+                cache[bfo.recID] = get_media_manifest(bfo.recID, revision)
+
+
+def get_manifest_media(bfo, resolve_movie_path='no'):
+    """
+    Returns the MediaSet of the record, as get_media(bfo,
+    resolve_movie_path=resolve_movie_path) with the default tags would,
+    or None if the manifest of the record is missing or stale.
+
+    With resolve_movie_path='yes', None is also returned when the
+    metadata of the record already mentions some media, in which case
+    they are the same as with resolve_movie_path='no'.
+    """
+    manifest = get_cached_media_manifest(bfo)
+    if manifest is None or resolve_movie_path not in manifest['media']:
+        return None
+    (media, derived) = manifest['media'][resolve_movie_path]
+    return MediaSet.from_dict(media, derived)
+
+
+def get_manifest_photo_media(bfo):
+    """
+    Returns the photos of the record, as the get_photo_media of
+    bfe_CERN_photo_resources without checking their existence, or None
+    if the manifest of the record is missing or stale.
+
+    WARNING: the returned structure is shared, it must not be modified.
+    """
+    manifest = get_cached_media_manifest(bfo)
+    if manifest is None:
+        return None
+    return manifest['photo_media']
+
+
+def _serialize_media(media):
+    """
+    Returns the media and the values derived from them, as they are
+    stored in the manifest
+    """
+    ordered_names = media.get_ordered_names()
+    for name in ordered_names['slave']:
+        for file_type in ('mp4', 'flv'):
+            for width in CFG_MEDIA_MANIFEST_PLAYER_WIDTHS:
+                media.get_best_path(name, file_type, width)
+        media.get_posterframe(name)
+    return (media.to_dict(), media.derived)
+
+
+def build_media_manifest(recid):
+    """
+    Computes the manifest of the record and stores it.
+    """
+    # Imported here, since the format elements need this module
+    from invenio.bibformat_elements.bfe_CERN_photo_resources import get_photo_media
+
+    revision = get_record_revision(recid)
+    if revision is None:
+        return
+    bfo = BibFormatObject(recid)
+    manifest = {'version': CFG_MEDIA_MANIFEST_VERSION,
+                'recid': recid,
+                'revision': revision,
+                'media': {},
+                'photo_media': get_photo_media(bfo, check_existence=False)}
+
+    media = get_media(bfo)
+    manifest['media']['no'] = _serialize_media(media)
+    if not media['slave'] and not media['thumbnail'] and not media['posterframe']:
+        manifest['media']['yes'] = _serialize_media(get_media(bfo, resolve_movie_path='yes'))
+
+    manifest_path = get_media_manifest_path(recid)
+    if not os.path.exists(os.path.dirname(manifest_path)):
+        os.makedirs(os.path.dirname(manifest_path))
+    # Write to a temporary file first, so that the manifest is never
+    # read half written
+    tmp_path = '%s.%s.tmp' % (manifest_path, os.getpid())
+    manifest_file = open(tmp_path, 'wb')
+    try:
+        manifest_file.write(serialize_via_marshal(manifest))
+    finally:
+        manifest_file.close()
+    os.rename(tmp_path, manifest_path)
+
+
+def get_recids_modified_since(since):
+    """
+    Returns the ids of the records modified since given date
+    ('YYYY-MM-DD HH:MM:SS')
+    """
+    return [row[0] for row in run_sql("SELECT id FROM bibrec WHERE modification_date >= %s",
+                                      (since, ))]
+
+
+def get_indico_recids():
+    """
+    Returns the ids of the records from Indico, whose media are looked
+    for on the MediaArchive when their metadata does not mention any
+    """
+    return [row[0] for row in run_sql("SELECT DISTINCT bb.id_bibrec FROM bibrec_bib97x bb, bib97x b "
+                                      "WHERE bb.id_bibxxx=b.id AND b.tag='970__a' "
+                                      "AND b.value LIKE 'INDICO.%%'")]
+
+
+def _build_media_manifest(recid):
+    """
+    Same as build_media_manifest, but returns False instead of raising
+    an exception if the manifest could not be built
+    """
+    try:
+        build_media_manifest(recid)
+    except Exception:
+        register_exception(alert_admin=False,
+                           prefix="Could not build the media manifest of record %s" % recid)
+        return False
+    return True
+
+
+def build_media_manifests(recids, threads=1):
+    """
+    Builds the manifests of the given records, with threads records
+    built concurrently. Returns the number of records whose manifest
+    could not be built.
+    """
+    if threads <= 1 or len(recids) <= 1:
+        results = [_build_media_manifest(recid) for recid in recids]
+    else:
+        pool = ThreadPool(threads)
+        try:
+            results = pool.map(_build_media_manifest, recids, chunksize=10)
+        finally:
+            pool.close()
+            pool.join()
+    return results.count(False)
+
+
+def main():
+    """
+    Builds the media manifests of the records given on the command line,
+    or of the records modified since the previous run.
+    """
+    parser = OptionParser(usage="%prog [--recid=RECID ...] [--since='YYYY-MM-DD HH:MM:SS'] "
+                          "[--indico] [--threads=N]")
+    parser.add_option("-r", "--recid", dest="recids", action="append", type="int",
+                      default=[], help="build the manifest of this record")
+    parser.add_option("-s", "--since", dest="since",
+                      help="build the manifests of the records modified since this date "
+                      "(default: since the previous run)")
+    parser.add_option("-i", "--indico", dest="indico", action="store_true", default=False,
+                      help="build the manifests of all the records from Indico")
+    parser.add_option("-t", "--threads", dest="threads", type="int", default=1,
+                      help="number of manifests built concurrently")
+    (options, dummy) = parser.parse_args()
+
+    start = time.strftime('%Y-%m-%d %H:%M:%S')
+    recids = options.recids
+    if options.indico:
+        recids = recids + get_indico_recids()
+    elif not recids:
+        since = options.since
+        if since is None:
+            try:
+                since = open(CFG_MEDIA_MANIFEST_LAST_RUN_FILE).read().strip()
+            except IOError:
+                since = '0000-00-00 00:00:00'
+        recids = get_recids_modified_since(since)
+
+    nb_errors = build_media_manifests(recids, options.threads)
+    print "%s manifests built, %s errors" % (len(recids) - nb_errors, nb_errors)
+
+    if not options.recids and not options.since and not options.indico:
+        if not os.path.exists(CFG_MEDIA_MANIFEST_DIR):
+            os.makedirs(CFG_MEDIA_MANIFEST_DIR)
+        last_run_file = open(CFG_MEDIA_MANIFEST_LAST_RUN_FILE, 'w')
+        last_run_file.write(start)
+        last_run_file.close()
+    if nb_errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
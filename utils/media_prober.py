@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Checks the media files on the MediaArchive (mediastream.cern.ch).
+
+The files are probed with HEAD requests, over keep-alive connections
+kept per host, and the results are cached for some time, so that
+formatting the same records again does not probe the same files again.
+"""
+
+import httplib
+import socket
+import threading
+import time
+from collections import namedtuple
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from urlparse import urlsplit, urljoin
+
+from invenio.config import CFG_ETCDIR
+from invenio.cache_utils import TTLCache
+
+CFG_MEDIA_PROBER_CREDENTIALS_FILE = CFG_ETCDIR + "/webaccess/cern_nice_soap_credentials.txt"
+# Timeout of the connections to the MediaArchive, in seconds
+CFG_MEDIA_PROBER_TIMEOUT = 5
+# Number of idle connections kept per host
+CFG_MEDIA_PROBER_MAX_IDLE_CONNECTIONS = 4
+CFG_MEDIA_PROBER_MAX_REDIRECTS = 5
+# Number of probed URLs kept in the cache, and for how long (in
+# seconds) when the file was found and when it was not
+CFG_MEDIA_PROBER_CACHE_SIZE = 10000
+CFG_MEDIA_PROBER_POSITIVE_TTL = 3600
+CFG_MEDIA_PROBER_NEGATIVE_TTL = 300
+# Number of threads probing URLs concurrently (see probe_urls), and the
+# maximum time spent waiting for them, in seconds
+CFG_MEDIA_PROBER_THREADS = 8
+CFG_MEDIA_PROBER_LATENCY_BUDGET = 3
+
+# The answer of the server to a probe. A status of None means that the
+# server could not be reached.
+ProbeResult = namedtuple('ProbeResult', ('url', 'status', 'content_type', 'content_length'))
+
+
+class ConnectionPool(object):
+    """
+    Keeps the HTTP(S) connections to the hosts open between requests.
+    Thread-safe: a connection is used by one thread at a time.
+    """
+
+    def __init__(self, max_idle=CFG_MEDIA_PROBER_MAX_IDLE_CONNECTIONS,
+                 timeout=CFG_MEDIA_PROBER_TIMEOUT):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _get_connection(self, scheme, host):
+        """
+        Returns (connection, reused): an idle connection to host if
+        there is one, or a new one
+        """
+        self._lock.acquire()
+        try:
+            connections = self._idle.get((scheme, host))
+            if connections:
+                return (connections.pop(), True)
+        finally:
+            self._lock.release()
+        if scheme == 'https':
+            return (httplib.HTTPSConnection(host, timeout=self.timeout), False)
+        return (httplib.HTTPConnection(host, timeout=self.timeout), False)
+
+    def _release_connection(self, scheme, host, connection):
+        """Keeps the connection for later requests, or closes it"""
+        self._lock.acquire()
+        try:
+            connections = self._idle.setdefault((scheme, host), [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        finally:
+            self._lock.release()
+        connection.close()
+
+    def request(self, method, scheme, host, path, headers=None):
+        """
+        Sends the request and returns the response (whose body has been
+        read for HEAD requests only). Raises httplib.HTTPException or
+        socket.error if the host cannot be reached.
+        """
+        while True:
+            (connection, reused) = self._get_connection(scheme, host)
+            try:
+                connection.request(method, path, headers=headers or {})
+                response = connection.getresponse()
+                if method == 'HEAD':
+                    response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if reused:
+                    # The server might have closed the idle connection:
+                    # try again with another one
+                    continue
+                raise
+            if method == 'HEAD' and not response.will_close:
+                self._release_connection(scheme, host, connection)
+            else:
+                # Do not read the whole file: drop the connection
+                connection.close()
+            return response
+
+    def close(self):
+        """Closes all the idle connections"""
+        self._lock.acquire()
+        try:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+
+_connection_pool = ConnectionPool()
+_probe_cache = TTLCache(max_size=CFG_MEDIA_PROBER_CACHE_SIZE,
+                        ttl=CFG_MEDIA_PROBER_POSITIVE_TTL)
+_credentials = []
+_credentials_lock = threading.Lock()
+_thread_pool = []
+_thread_pool_lock = threading.Lock()
+
+
+def get_credentials():
+    """
+    Returns the credentials ('Basic' authorization) used to access the
+    restricted files, read only once, or None if they are not available
+    """
+    _credentials_lock.acquire()
+    try:
+        if not _credentials:
+            try:
+                credentials_file = open(CFG_MEDIA_PROBER_CREDENTIALS_FILE, "r")
+                try:
+                    _credentials.append(credentials_file.read().strip())
+                finally:
+                    credentials_file.close()
+            except IOError:
+                return None
+        return _credentials[0]
+    finally:
+        _credentials_lock.release()
+
+
+def _probe(url, authenticate, follow_redirects):
+    """Probes url, without using the cache (see probe_url)"""
+    headers = {"Accept": "*/*"}
+    if authenticate:
+        credentials = get_credentials()
+        if credentials is None:
+            return ProbeResult(url, None, None, None)
+        headers["Authorization"] = "Basic " + credentials
+
+    for dummy_redirect in range(CFG_MEDIA_PROBER_MAX_REDIRECTS + 1):
+        (scheme, host, path, query, dummy) = urlsplit(url.replace(' ', '%20'))
+        if authenticate:
+            # Never send the credentials in clear
+            scheme = 'https'
+        if query:
+            path += '?' + query
+        try:
+            response = _connection_pool.request('HEAD', scheme, host, path or '/', headers)
+            if response.status in (405, 501):
+                # HEAD is not supported
+                response = _connection_pool.request('GET', scheme, host, path or '/', headers)
+        except (httplib.HTTPException, socket.error):
+            return ProbeResult(url, None, None, None)
+        location = response.getheader('location')
+        if follow_redirects and response.status in (301, 302, 303, 307) and location:
+            url = urljoin(url, location)
+            continue
+        content_length = response.getheader('content-length')
+        if content_length is not None:
+            try:
+                content_length = int(content_length)
+            except ValueError:
+                content_length = None
+        return ProbeResult(url, response.status, response.getheader('content-type'),
+                           content_length)
+    return ProbeResult(url, None, None, None)
+
+
+def probe_url(url, authenticate=False, follow_redirects=True):
+    """
+    Returns the ProbeResult of a HEAD request to url, from the cache if
+    it was probed recently.
+
+    @param url: the URL to probe
+    @param authenticate: if True, send the credentials of CDS (over HTTPS)
+    @param follow_redirects: if True, return the result of the last URL
+                             the server redirected to
+    """
+    result = _probe_cache.get((url, authenticate, follow_redirects))
+    if result is None:
+        result = _probe_and_cache(url, authenticate, follow_redirects)
+    return result
+
+
+def _probe_and_cache(url, authenticate, follow_redirects):
+    """Probes url and caches the result, once it is known not to be cached"""
+    result = _probe(url, authenticate, follow_redirects)
+    if result.status == 200:
+        ttl = CFG_MEDIA_PROBER_POSITIVE_TTL
+    else:
+        ttl = CFG_MEDIA_PROBER_NEGATIVE_TTL
+    _probe_cache.set((url, authenticate, follow_redirects), result, ttl)
+    return result
+
+
+def _get_thread_pool():
+    """Returns the pool of threads used by probe_urls, created once"""
+    _thread_pool_lock.acquire()
+    try:
+        if not _thread_pool:
+            _thread_pool.append(ThreadPool(CFG_MEDIA_PROBER_THREADS))
+        return _thread_pool[0]
+    finally:
+        _thread_pool_lock.release()
+
+
+def probe_urls(urls, authenticate=False, follow_redirects=True,
+               budget=CFG_MEDIA_PROBER_LATENCY_BUDGET):
+    """
+    Same as probe_url for several URLs, probed concurrently. Returns a
+    dictionary with the URLs as keys and their ProbeResult as values.
+
+    The URLs that could not be probed within budget seconds get a
+    ProbeResult whose status is None (their probes go on in the
+    background and are cached once done).
+    """
+    results = {}
+    pending = []
+    for url in urls:
+        if url in results:
+            continue
+        result = _probe_cache.get((url, authenticate, follow_redirects))
+        if result is None:
+            pending.append(url)
+        results[url] = result
+
+    if pending:
+        pool = _get_thread_pool()
+        # The misses were counted above: probe without looking the cache up again
+        async_results = [(url, pool.apply_async(_probe_and_cache, (url, authenticate, follow_redirects)))
+                         for url in pending]
+        deadline = time.time() + budget
+        for (url, async_result) in async_results:
+            try:
+                results[url] = async_result.get(max(0, deadline - time.time()))
+            except TimeoutError:
+                results[url] = ProbeResult(url, None, None, None)
+    return results
+
+
+def url_exists(url):
+    """
+    Returns True if a file (i.e. not an HTML page) can be found at url,
+    using the credentials of CDS if the file is restricted.
+    """
+    result = probe_url(url)
+    if result.status is not None and 200 <= result.status < 300:
+        return (result.content_type or 'text/html') != 'text/html'
+    if result.status == 401:
+        # Authentication is necessary to access this resource
+        return probe_url(url, authenticate=True, follow_redirects=False).status == 200
+    return False
+
+
+def get_missing_urls(urls, budget=CFG_MEDIA_PROBER_LATENCY_BUDGET):
+    """
+    Returns the set of the given URLs for which the server answered that
+    there is no such file (404), checking them concurrently (see
+    probe_urls).
+
+    As with 'wget --spider', the URLs that could not be checked (not
+    HTTP URLs, unreachable servers, restricted files, ...) are not
+    considered as missing.
+    """
+    http_urls = [url for url in urls if url.startswith('http://') or url.startswith('https://')]
+    results = probe_urls(http_urls, budget=budget)
+    return set([url for (url, result) in results.iteritems() if result.status == 404])
+
+
+def get_probe_cache_stats():
+    """Returns the statistics of the cache of the probed URLs"""
+    return _probe_cache.get_stats()
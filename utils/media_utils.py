@@ -21,14 +21,12 @@
 Utils functions for media files.
 """
 
-import httplib
-from urllib2 import urlopen, HTTPError
 import re
+from collections import namedtuple
 
-from invenio.config import CFG_ETCDIR, CFG_SITE_URL
+from invenio.config import CFG_SITE_URL
 from invenio.bibdocfile import BibRecDocs
 from invenio.search_engine import \
-        perform_request_search, \
         search_pattern, \
         get_fieldvalues, \
         get_record, \
@@ -38,6 +36,9 @@ from invenio.bibrecord import record_get_field_instances, \
                               record_get_field_values
 from invenio.jsonutils import json, CFG_JSON_AVAILABLE
 from invenio.webbasket_dblayer import get_basket_content
+from invenio.media_prober import url_exists, probe_urls
+from invenio.cache_utils import TTLCache, is_record_in_collection
+from invenio.identifier_index import get_recids_for_identifier
 
 MEDIAARCHIVE_PATH = '/MediaArchive/'
 CFG_VIDEO_STREAMER_URL = "rtmp://wowzalb.cern.ch/vod"
@@ -49,6 +50,216 @@ CFG_MA_CAPTION_SUBFIELD_CONTENT = 'z'
 
 TOC_RELATIONSHIP_FIELD = ('774', '773', )
 
+# The information about the high-res files, per master path (see
+# get_high_res_infos)
+_high_res_info_cache = TTLCache(max_size=1000, ttl=3600)
+
+# Where the media of the records should be on the MediaArchive, when
+# the metadata does not mention them (see resolve_movie_paths)
+CFG_MEDIA_RESOLUTION_BASE_PATH = 'https://mediastream.cern.ch/MediaArchive/Video/Public/' \
+                                 '%(folder)s/%(year)s/%(key)s/%(key)s-%(filename)s'
+# Time (in seconds) during which the media found there are remembered,
+# and during which not finding any is remembered
+CFG_MEDIA_RESOLUTION_POSITIVE_TTL = 86400
+CFG_MEDIA_RESOLUTION_NEGATIVE_TTL = 3600
+
+# The IP addresses of CERN (see is_cern_ip)
+CFG_CERN_IP_PREFIXES = ('137.138', '128.141', '128.142', '192.91', '194.12', '192.16')
+_movie_path_resolution_cache = TTLCache(max_size=10000, ttl=CFG_MEDIA_RESOLUTION_POSITIVE_TTL)
+
+MEDIA_TYPES = ['slave', 'master', 'posterframe', 'thumbnail', 'subtitle']
+
+MEDIA_FILE_FIELDS = ('path', 'filename', 'name', 'file_type', 'label',
+                     'dimension', 'order', 'video_bitrate', 'fps',
+                     'audio_canal', 'audio_bitrate', 'audio_frequency',
+                     'percent', 'language')
+
+
+class MediaFile(object):
+    """
+    The information about one media file of a record (see get_media).
+
+    The fields that do not apply to the type of the file (e.g. 'percent'
+    for a slave) are not set. For compatibility with the dictionaries
+    previously returned by get_media, the fields can also be read as
+    keys: media_file['path'], media_file.get('percent', 0), etc.
+    """
+    __slots__ = MEDIA_FILE_FIELDS
+
+    def __getitem__(self, key):
+        if key in MEDIA_FILE_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in MEDIA_FILE_FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in MEDIA_FILE_FIELDS and hasattr(self, key)
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key in MEDIA_FILE_FIELDS if hasattr(self, key)]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def to_dict(self):
+        """Returns the fields that are set, as a dictionary"""
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (MediaFile, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return 'MediaFile(%r)' % self.to_dict()
+
+
+class MediaSet(dict):
+    """
+    The media of a record, as returned by get_media.
+
+    This is the dictionary described in get_media (media type, then name
+    of the media, then format/percent/language, then list of files),
+    where each file is a MediaFile, with a few accessors to query it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        for media_type in MEDIA_TYPES:
+            self.setdefault(media_type, {})
+        # The values computed from the media (see _get_derived_value)
+        self.derived = {}
+
+    def to_dict(self):
+        """
+        Returns the media as nested dictionaries and lists only (e.g. to
+        be serialized), see from_dict
+        """
+        out = {}
+        for (media_type, names) in self.iteritems():
+            out[media_type] = {}
+            for (name, media) in names.iteritems():
+                out[media_type][name] = {}
+                for (key, media_files) in media.iteritems():
+                    out[media_type][name][key] = [media_file.to_dict() for media_file in media_files]
+        return out
+
+    def from_dict(cls, media_dict, derived=None):
+        """
+        Returns the MediaSet of the dictionaries returned by to_dict,
+        with the given derived values (see _get_derived_value)
+        """
+        out = cls()
+        for (media_type, names) in media_dict.iteritems():
+            out[media_type] = {}
+            for (name, media) in names.iteritems():
+                out[media_type][name] = {}
+                for (key, media_files) in media.iteritems():
+                    out[media_type][name][key] = []
+                    for fields in media_files:
+                        media_file = MediaFile()
+                        for (field, value) in fields.iteritems():
+                            setattr(media_file, field, value)
+                        out[media_type][name][key].append(media_file)
+        if derived:
+            out.derived.update(derived)
+        return out
+    from_dict = classmethod(from_dict)
+
+    def _get_derived_value(self, key, function, *args):
+        """
+        Returns function(*args), computed only once for given key.
+        These values are also stored in the media manifests, so that
+        they do not need to be computed when formatting the record.
+        """
+        if key not in self.derived:
+            self.derived[key] = function(*args)
+        return self.derived[key]
+
+    def get_ordered_names(self):
+        """Same as get_ordered_media_names(self)"""
+        return self._get_derived_value(('ordered_names', ),
+                                       get_ordered_media_names, self)
+
+    def get_best_path(self, name, file_type, width):
+        """
+        Same as select_best_path for the slaves of given name and format,
+        or '' if there is no such slave
+        """
+        return self._get_derived_value(('best_path', name, file_type, width),
+                                       self._select_best_path, name, file_type, width)
+
+    def _select_best_path(self, name, file_type, width):
+        slaves = self['slave'].get(name, {}).get(file_type, [])
+        if not slaves:
+            return ''
+        return select_best_path(slaves, width)
+
+    def get_posterframe(self, name, nth_percentage=5, nth_dimension=(640, 360)):
+        """Same as get_video_posterframe for the posterframes of given name"""
+        return self._get_derived_value(('posterframe', name, nth_percentage, nth_dimension),
+                                       get_video_posterframe,
+                                       self['posterframe'].get(name, ''),
+                                       nth_percentage, nth_dimension)
+
+    def add(self, media_type, key, media_file):
+        """
+        Adds media_file to the files of its name, for given media type
+        and key (format, percent or language)
+        """
+        media = self[media_type].setdefault(media_file.name, {})
+        media.setdefault(key, []).append(media_file)
+
+    def get_names(self, media_type):
+        """Returns the names of the media of given type"""
+        return self.get(media_type, {}).keys()
+
+    def get_files(self, media_type, name=None, key=None):
+        """
+        Returns the list of MediaFile of given type, optionally only the
+        ones of given name and/or key (format, percent or language)
+        """
+        media = self.get(media_type, {})
+        if name is not None:
+            media = {name: media.get(name, {})}
+        files = []
+        for media_files in media.itervalues():
+            if key is None:
+                for same_key_files in media_files.itervalues():
+                    files.extend(same_key_files)
+            else:
+                files.extend(media_files.get(key, []))
+        return files
+
+    def get_files_by_width(self, media_type, width, name=None, key=None):
+        """
+        Returns the list of MediaFile of given type (and optionally name
+        and key) that are width pixels wide
+        """
+        return [media_file for media_file in self.get_files(media_type, name, key)
+                if media_file.dimension[0] == width]
+
 def get_media(bfo, tag="8567_", path_code='u', internal_note_code='y',
               label_code='x', resolve_movie_path='no'):
     """
@@ -68,9 +279,10 @@ def get_media(bfo, tag="8567_", path_code='u', internal_note_code='y',
     present, since retrieving the video slave path is quite heavy
     process
 
-    The returned structure is a dictionary with keys 'slave', 'master', 'thumbnail'
+    The returned structure is a MediaSet: a dictionary with keys 'slave', 'master', 'thumbnail'
     and 'posterframe' at first level, a dictionary at second
-    level and third, and a list of dictionaries at fourth level.
+    level and third, and a list of MediaFile at fourth level (shown
+    below as dictionaries, which is how they can also be read).
 
     {'slave': [(name, {'file_type': [{'path': 'http://mediaarchive.cern.ch/Med...video1.avi',
                                     'filename': 'video1.avi',
@@ -100,12 +312,8 @@ def get_media(bfo, tag="8567_", path_code='u', internal_note_code='y',
     MEDIAARCHIVE_OLD_BASE_PATH = 'http://mediaarchive.cern.ch'
     MEDIAARCHIVE_BASE_PATH = 'https://mediastream.cern.ch'
     VIDEO_FORMATS = ['mov', 'wmv', 'rm', 'ram', 'mpg', 'mpeg', 'avi', 'mp4']
-    MEDIA_TYPES = ['slave', 'master', 'posterframe', 'thumbnail', 'subtitle']
-
-    out = {}
-    for media in MEDIA_TYPES:
-        out[media] = {}
 
+    out = MediaSet()
     files = bfo.fields(tag)
     for media in files:
         path = media.get(path_code, None)
@@ -141,73 +349,179 @@ def get_media(bfo, tag="8567_", path_code='u', internal_note_code='y',
     if resolve_movie_path == 'yes' and \
           not out['slave'] and not out['thumbnail'] and not out['posterframe']:
         # If we still did not found anything, try to resolve path
-        BASE_PATH = '%s/MediaArchive/Video/Public/%%(folder)s/%%(year)s/%%(key)s/%%(key)s-%%(filename)s' % MEDIAARCHIVE_BASE_PATH
-        RESOLVE_CONFIG = {'INDICO': { 'folder': 'Conferences',
-                                         'key': bfo.field('970__a').split('.', 1)[-1],
-                                        'year': bfo.field('260__c'),
-                                   'condition': bfo.field('970__a').startswith("INDICO."),
-                                       'media': {      'slave': ['0600-kbps-maxH-360-25-fps-audio-128-kbps-48-kHz-stereo.mp4'],
-                                                 'posterframe': ['posterframe-480x360-at-10-percent.jpg'],
-                                                   'thumbnail': ['thumbnail-80x60-at-10-percent.jpg']
-                                                }
-                                    }
-                         }
+        _resolve_movie_path(bfo, out)
+
+    return out
+
+
+def _resolve_movie_path(bfo, out):
+    """
+    Tries to find the media of the record where they should be on the
+    MediaArchive, even if the metadata does not mention them, and adds
+    them to out (see get_media, parameter 'resolve_movie_path')
+    """
+    RESOLVE_CONFIG = {'INDICO': { 'folder': 'Conferences',
+                                     'key': bfo.field('970__a').split('.', 1)[-1],
+                                    'year': bfo.field('260__c'),
+                               'condition': bfo.field('970__a').startswith("INDICO."),
+                                   'media': {      'slave': ['0600-kbps-maxH-360-25-fps-audio-128-kbps-48-kHz-stereo.mp4'],
+                                             'posterframe': ['posterframe-480x360-at-10-percent.jpg'],
+                                               'thumbnail': ['thumbnail-80x60-at-10-percent.jpg']
+                                            }
+                                }
+                     }
+
+    for item in RESOLVE_CONFIG:
+        if RESOLVE_CONFIG[item]['condition']:
+            path_dict = {'folder': RESOLVE_CONFIG[item].get('folder', ''),
+                           'year': RESOLVE_CONFIG[item].get('year', ''),
+                            'key': RESOLVE_CONFIG[item].get('key', '')}
+            for (media_type, path) in resolve_movie_paths(path_dict, RESOLVE_CONFIG[item]['media']):
+                _construct_info_dict(None, path, '', path, media_type, out)
 
-        for item in RESOLVE_CONFIG:
-            if RESOLVE_CONFIG[item]['condition']:
-                path_dict = {'folder': RESOLVE_CONFIG[item].get('folder', ''),
-                               'year': RESOLVE_CONFIG[item].get('year', ''),
-                                'key': RESOLVE_CONFIG[item].get('key', '')}
-                for media_type in RESOLVE_CONFIG[item]['media']:
-                    for filename in RESOLVE_CONFIG[item]['media'][media_type]:
-                        path_dict.update({'filename': filename})
-                        path = BASE_PATH % path_dict
-                        if file_exists(path):
-                            _construct_info_dict(None, path, '', path, media_type, out)
 
+def resolve_movie_paths(path_dict, media):
+    """
+    Returns the list of (media_type, path) of the given media files that
+    exist where they should be on the MediaArchive.
+
+    The files are checked concurrently, and the result is cached per
+    folder, key and year, for CFG_MEDIA_RESOLUTION_POSITIVE_TTL seconds
+    if some files were found and CFG_MEDIA_RESOLUTION_NEGATIVE_TTL
+    seconds otherwise.
+
+    @param path_dict: the 'folder', 'year' and 'key' of the files
+    @param media: dictionary with the media types as keys and the list
+                  of the names of the files as values
+    """
+    cache_key = (path_dict['folder'], path_dict['key'], path_dict['year'],
+                 tuple([(media_type, tuple(filenames)) for (media_type, filenames) in media.iteritems()]))
+    found = _movie_path_resolution_cache.get(cache_key)
+    if found is not None:
+        return found
+
+    candidates = []
+    for media_type in media:
+        for filename in media[media_type]:
+            path = CFG_MEDIA_RESOLUTION_BASE_PATH % dict(path_dict, filename=filename)
+            candidates.append((media_type, path))
+    results = probe_urls([path for (dummy, path) in candidates])
+    complete = True
+    found = []
+    for (media_type, path) in candidates:
+        if results[path].status is None:
+            # Not probed in time
+            complete = False
+        elif file_exists(path):
+            found.append((media_type, path))
+    if complete:
+        if found:
+            _movie_path_resolution_cache.set(cache_key, found)
+        else:
+            _movie_path_resolution_cache.set(cache_key, found, CFG_MEDIA_RESOLUTION_NEGATIVE_TTL)
+    return found
+
+
+def is_cern_ip(remote_ip):
+    """
+    Returns True if the given IP address belongs to CERN
+    """
+    return (remote_ip or '').startswith(CFG_CERN_IP_PREFIXES)
+
+
+def get_request_cache(bfo, name):
+    """
+    Returns a dictionary attached to the given BibFormatObject, that can
+    be used to memoize values for as long as the object lives.
+
+    BibFormat uses the same BibFormatObject for all the elements of a
+    format template, so that the values stored here are shared by all
+    the elements called while formatting the record, and dropped once
+    the record has been formatted.
+
+    @param bfo: the BibFormatObject of the record being formatted
+    @param name: the name of the cache (one dictionary per name)
+    """
+    caches = bfo.__dict__.setdefault('_cds_request_cache', {})
+    return caches.setdefault(name, {})
+
+
+def get_cached_media(bfo, tag="8567_", path_code='u', internal_note_code='y',
+                     label_code='x', resolve_movie_path='no'):
+    """
+    Same as get_media, but the structure is computed only once per
+    record and per set of parameters while formatting the record (see
+    get_request_cache), so that the format elements that display the
+    media of the same record do not parse the metadata and probe the
+    MediaArchive again.
+
+    The media of the record are read from its media manifest when it
+    is up to date (see media_manifest), instead of being computed.
+
+    WARNING: the returned structure is shared, it must not be modified.
+    """
+    cache = get_request_cache(bfo, 'media')
+    key = (bfo.recID, tag, path_code, internal_note_code, label_code, resolve_movie_path)
+    if key in cache:
+        return cache[key]
+
+    out = None
+    if (tag, path_code, internal_note_code, label_code) == ('8567_', 'u', 'y', 'x'):
+        from invenio.media_manifest import get_manifest_media
+        out = get_manifest_media(bfo, resolve_movie_path)
+
+    if out is None:
+        if resolve_movie_path == 'yes':
+            # Resolving the path is only needed when the metadata gives
+            # nothing, so reuse the structure built from the metadata
+            out = get_cached_media(bfo, tag, path_code, internal_note_code,
+                                   label_code, resolve_movie_path='no')
+            if not out['slave'] and not out['thumbnail'] and not out['posterframe']:
+                out = MediaSet([(media_type, dict(media)) for (media_type, media) in out.iteritems()])
+                _resolve_movie_path(bfo, out)
+        else:
+            out = get_media(bfo, tag, path_code, internal_note_code, label_code,
+                            resolve_movie_path)
+    cache[key] = out
     return out
 
 
 def _construct_info_dict(media, path, label, internal_note, media_type, out):
     """
-    Constructs and adds to out a dictionary with full metadata about the media file
+    Constructs and adds to out a MediaFile with full metadata about the media file
     Parameters:
         @param media: the MARC of the resource from the metadata
         @param path:  the URL of the resource
         @param label: the label extracted from MARC metadata
         @param internal_note: the internal note extracted from MARC metadata
         @param media_type: one of the types listed in MEDIA_TYPES
-        @param out: the general media dictionary of this record, to be updated
-    """
-    info = {}
-    info['path'] = path
-    info['filename'] = get_filename(path)
-    info['name'] = get_name(path)
-    info['file_type'] = get_format(path)
-    info['label'] = label
-    info['dimension'] = get_dimension(internal_note, path)
+        @param out: the MediaSet of this record, to be updated
+    """
+    info = MediaFile()
+    info.path = path
+    info.filename = get_filename(path)
+    info.name = get_name(path)
+    info.file_type = get_format(path)
+    info.label = label
+    note_info = parse_media_note(internal_note, path)
+    info.dimension = note_info.dimension
     if media:
-        info['order'] = get_order(media.get('8', ''), path)
+        info.order = get_order(media.get('8', ''), path)
 
     if media_type in ['slave', 'master']:
-        info['video_bitrate'] = get_video_bitrate(internal_note)
-        info['fps'] = get_framerate(internal_note)
-        info['audio_canal'] = get_nb_audio_canal(internal_note)
-        info['audio_bitrate'] = get_audio_bitrate(internal_note)
-        info['audio_frequency'] = get_audio_frequency(internal_note)
-        key = info['file_type']
+        info.video_bitrate = note_info.video_bitrate
+        info.fps = note_info.fps
+        info.audio_canal = note_info.audio_canal
+        info.audio_bitrate = note_info.audio_bitrate
+        info.audio_frequency = note_info.audio_frequency
+        key = info.file_type
     elif media_type in ['thumbnail', 'posterframe']:
-        info['percent'] = get_percentage(internal_note)
-        key = info['percent']
+        info.percent = note_info.percent
+        key = info.percent
     elif media_type in ['subtitle']:
-        info['language'] = get_language(internal_note)
-        key = info['language']
-    name = info['name']
-    if name not in out[media_type]:
-        out[media_type][name] = {}
-    if key not in out[media_type][name]:
-        out[media_type][name][key] = []
-    out[media_type][name][key].append(info)
+        info.language = get_language(internal_note)
+        key = info.language
+    out.add(media_type, key, info)
 
 
 def get_ordered_media_names(media):
@@ -239,14 +553,14 @@ def select_best_path(slave_list, width):
     """Return the video with highes bitrate for width, and the bitrate"""
     possible_paths = []
     for item in slave_list:
-        if item['dimension'][0] == width:
-            possible_paths.append((item['path'], item.get('video_bitrate', 0)))
+        if item.dimension[0] == width:
+            possible_paths.append((item.path, item.video_bitrate))
     if possible_paths:
         possible_paths.sort(key=lambda tup:tup[1])
         return possible_paths[-1][0]
     if len(slave_list) == 2: #hack for rushes
-        return slave_list[-1]['path']
-    return slave_list[0]['path']
+        return slave_list[-1].path
+    return slave_list[0].path
 
 def select_best_bitrate(media):
     """Return the video path  with the best bitrate"""
@@ -262,11 +576,11 @@ def get_level_list(slaves, rtmp=False):
     res = []
     settings = {} #meant to keep width: max bitrate
     for slave in slaves:
-        width = slave.get('dimension', (0, 0))[0]
+        width = slave.dimension[0]
         if width > 0:
             if width not in settings:
                 settings[width] = []
-            settings[width].append(slave.get('video_bitrate', 0))
+            settings[width].append(slave.video_bitrate)
     for item in settings:
         settings[item] = max(settings[item])
     if not settings:
@@ -275,12 +589,12 @@ def get_level_list(slaves, rtmp=False):
     max_bitrate = max(settings.values())
     for slave in slaves:
         res_item = {}
-        res_item['bitrate'] = slave.get('video_bitrate', 0)
-        res_item['width'] = slave.get('dimension', (0, 0))[0]
+        res_item['bitrate'] = slave.video_bitrate
+        res_item['width'] = slave.dimension[0]
         if not rtmp:
-            res_item['file'] = slave['path']
+            res_item['file'] = slave.path
         else:
-            res_item['file'] = slave['path'].split(MEDIAARCHIVE_PATH)[1]
+            res_item['file'] = slave.path.split(MEDIAARCHIVE_PATH)[1]
         if res_item['bitrate'] > 0 and res_item['width'] > 0 and res_item['file']:
             res.append(res_item)
             for item in settings:
@@ -290,10 +604,48 @@ def get_level_list(slaves, rtmp=False):
                     res.append({'bitrate': res_item['bitrate'], 'width': item, 'file': res_item['file']})
     return res
 
+def get_video_posterframe(media_posterframes, nth_percentage, nth_dimension):
+    """Return the path to the posterframe that has the NiceToHave_percentage
+       and NiceToHave_dimension
+       If no posterframe is found for nth_dimension, we take the first
+       available from nth_percentage;
+       If nth_percentage is not available, we take the first posterframe with
+       nth_dimension;
+       If none of the above, we take the first posterframe available.
+       """
+    if not media_posterframes:
+        return ''
+
+    #try to return the posterframe, at the nth_percentage and nth_dimension
+    if nth_percentage in media_posterframes:
+        for item in media_posterframes[nth_percentage]:
+            if item.get('dimension', '') == nth_dimension and item.get('path', ''):
+                return item['path']
+        #there is no posterframe with nth_dimension, return another one
+        for item in media_posterframes[nth_percentage]:
+            if item.get('path', ''):
+                return item['path']
+
+
+    #none of the above worked, return the first posterframe with nth_dimension
+    for percentage in media_posterframes:
+        for item in media_posterframes[percentage]:
+            if item.get('dimension', '') == nth_dimension and item.get('path', ''):
+                return item['path']
+
+    # nothing worked so far, return the first posterframe
+    for percentage in media_posterframes:
+        for item in media_posterframes[percentage]:
+            if item.get('path', ''):
+                return item['path']
+
+    return ''
+
+
 def front_code_to_embed_video(bfo, width='', height=''):
     '''Returns a dictionary containing the code to embed all videos asociated with a record'''
     embed_front = {}
-    multimedia = get_media(bfo)
+    multimedia = get_cached_media(bfo)
     #retrive the masters
     masters_dict = multimedia.get('master', {})
     slave_dict = multimedia.get('slave', {})
@@ -314,12 +666,10 @@ def front_code_to_embed_video(bfo, width='', height=''):
             'General Talks', 'Summer Student Lectures',
             'Academic Training Lectures'
         ]
-        record_in_collection = perform_request_search(
-            p="recid:{0}".format(bfo.recID), c=collection_list
-        )
+        record_in_collection = is_record_in_collection(bfo.recID, collection_list)
+        record_in_videos = is_record_in_collection(bfo.recID, "Videos")
         for rep_number in report_numbers:
-            if rep_number.startswith('CERN-VIDEO-C') or \
-                    perform_request_search(p="recid:{0}".format(bfo.recID), c="Videos", cc="Videos"):
+            if rep_number.startswith('CERN-VIDEO-C') or record_in_videos:
                 embed_front[rep_number] = \
                     """<iframe width="%s" height="%s" frameborder="0" src="%s" allowfullscreen></iframe>""" \
                     % (width, height, generate_embedding_url(rep_number))
@@ -369,116 +719,60 @@ def get_high_res_info(master_path, extensions=None):
     Returned value is a dictionary with keys as available extensions,
     and values as tuple (size (int) in Bytes, master_path (string))
     """
-    if not extensions:
-        extensions = ['mov', 'mov.zip', 'avi', 'mpg', 'mp4']
-    info = {}
-    domain = master_path.split('/')[2]
-    master_path_extension = master_path.split('.')[-1]
-    master_path_without_extension = '.'.join(master_path.split('.')[:-1])
+    return get_high_res_infos([master_path], extensions)[master_path]
 
-    master_path = master_path.replace(' ', "%20") #HTTPSConnection does not support spaces
-    try:
-        fd = open(CFG_ETCDIR +"/webaccess/cern_nice_soap_credentials.txt" ,"r")
-        cern_nice_soap_auth = fd.read()
-        fd.close()
-    except ValueError:
-        return {}
 
-    _headers = {"Accept": "*/*",
-                "Authorization": "Basic " + cern_nice_soap_auth.strip()}
-
-    conn = httplib.HTTPSConnection(domain)
-    # Original master path
-    try:
-        ## Request a connection
-        conn.request("GET",
-                     '/' + master_path.split('/', 3)[3],
-                     headers = _headers)
-        ## Get a response object:
-        response = conn.getresponse()
-        if response.status == 200:
-            ## Get content-length:
-            content_length = int(response.getheader('content-length'))
-            info[master_path_extension] = (content_length,
-                                           master_path)
-    except:
-        # Cannot connect
-        pass
-    ## Close the connection:
-    conn.close()
+def get_high_res_infos(master_paths, extensions=None):
+    """
+    Same as get_high_res_info, for several master paths at once: all
+    the files are probed concurrently with HEAD requests (see
+    media_prober.probe_urls), and the information is cached per master
+    path for some time.
 
-    # Other formats
-    for extension in extensions:
-        if master_path_extension != extension:
-            try:
-                this_master_path = "%s.%s" % (master_path_without_extension, extension)
-                conn = httplib.HTTPSConnection(domain)
-                ## Request a connection
-                conn.request("GET",
-                             '/' + this_master_path.split('/', 3)[3],
-                             headers = _headers)
-                ## Get a response object:
-                response = conn.getresponse()
-                if response.status == 200:
-                    ## Get content-length:
-                    content_length = int(response.getheader('content-length'))
-                    info[extension] = (content_length,
-                                       this_master_path)
-            except:
-                # Cannot connect
-                pass
-            ## Close the connection:
-            conn.close()
-    return info
+    Returns a dictionary with the master paths as keys, and their
+    information (see get_high_res_info) as values.
+    """
+    if not extensions:
+        extensions = ['mov', 'mov.zip', 'avi', 'mpg', 'mp4']
+    out = {}
+    candidates = {} # master path -> list of (extension, path)
+    for master_path in master_paths:
+        info = _high_res_info_cache.get((master_path, tuple(extensions)))
+        if info is not None:
+            out[master_path] = info
+            continue
+        master_path_extension = master_path.split('.')[-1]
+        master_path_without_extension = '.'.join(master_path.split('.')[:-1])
+        candidates[master_path] = [(master_path_extension, master_path.replace(' ', "%20"))]
+        for extension in extensions:
+            if master_path_extension != extension:
+                candidates[master_path].append((extension, "%s.%s" % (master_path_without_extension, extension)))
+
+    results = probe_urls([path for paths in candidates.values() for (dummy, path) in paths],
+                         authenticate=True, follow_redirects=False)
+    for (master_path, paths) in candidates.iteritems():
+        info = {}
+        complete = True
+        for (extension, path) in paths:
+            result = results[path]
+            if result.status is None:
+                # Not probed in time
+                complete = False
+            elif result.status == 200 and result.content_length is not None:
+                info[extension] = (result.content_length, path)
+        if complete:
+            _high_res_info_cache.set((master_path, tuple(extensions)), info)
+        out[master_path] = info
+    return out
 
 
 def file_exists(url):
     """
     Returns True if resource could be found at url. Else returns false
-    """
-    try:
-        req = urlopen(url)
-        if req.info().get('content-type', 'text/html') != 'text/html':
-            return True
-        else:
-            return False
-    except HTTPError, e:
-        if e.code == 401:
-            # Authentication is necessary to access this resouce
-            domain = url.split('/')[2]
-            try:
-                fd = open(CFG_ETCDIR + "/webaccess/cern_nice_soap_credentials.txt" ,"r")
-                cern_nice_soap_auth = fd.read()
-                fd.close()
-            except ValueError, e:
-                return {}
-
-            _headers = {"Accept": "*/*",
-                        "Authorization": "Basic " + cern_nice_soap_auth}
 
-            conn = httplib.HTTPSConnection(domain)
-            try:
-                ## Request a connection
-                conn.request("GET",
-                             '/' + url.split('/', 3)[3],
-                             headers = _headers)
-                ## Get a response object:
-                response = conn.getresponse()
-                if response.status == 200:
-                    conn.close()
-                    return True
-            except:
-                # Cannot connect
-                pass
-
-            ## Close the connection:
-            if conn:
-                conn.close()
-
-            return False
-
-    except IOError:
-        return False
+    The result is cached for some time, see media_prober.url_exists
+    """
+    return url_exists(url)
 
 
 def format_size(size):
@@ -516,6 +810,21 @@ def get_photolab_image_caption(record, imageID):
             return current_values.get(CFG_MA_CAPTION_SUBFIELD_CONTENT, '')
     return ''
 
+def get_photolab_image_captions(record):
+    """
+    Get the captions of all the images of the record, as a dictionary
+    image id -> caption, to look up many images without reading the
+    caption fields for each one. As get_photolab_image_caption, the
+    first caption of an image is kept.
+    """
+    captions = {}
+    for element in record_get_field_instances(record, tag=CFG_MA_CAPTION_TAG):
+        current_values = dict(element[0])
+        imageID = current_values.get(CFG_MA_CAPTION_SUBFIELD_ID, -1)
+        if imageID not in captions:
+            captions[imageID] = current_values.get(CFG_MA_CAPTION_SUBFIELD_CONTENT, '')
+    return captions
+
 ## Sorting Alphanumerically
 def chunkify(alphanumstr):
     """return a list of numbers and non-numeric substrings of +alphanumstr+
@@ -542,6 +851,13 @@ def alphanum(a, b):
 
 
 #Parse Metadata Functions#
+DIMENSION_PATTERN = re.compile('(?P<width>\d+)\s*x\s*(?P<height>\d+)', re.IGNORECASE)
+VIDEO_BITRATE_PATTERN = re.compile('(?P<rate>\d+)(\s|-)*kbps', re.IGNORECASE)
+AUDIO_BITRATE_PATTERN = re.compile('audio\s*(?P<rate>\d+)\s*kbps', re.IGNORECASE)
+AUDIO_FREQUENCY_PATTERN = re.compile('(?P<freq>\d+)(\s|-)*khz', re.IGNORECASE)
+FRAMERATE_PATTERN = re.compile('(?P<frequency>\d+)(\s|-)*fps', re.IGNORECASE)
+PERCENTAGE_PATTERN = re.compile('(?P<percent>\d+)(\s|-)*percent', re.IGNORECASE)
+
 def get_format(path):
     """
     Returns the file extension of the media
@@ -620,8 +936,7 @@ def get_dimension(internal_note, path=""):
 
     Try to find dimension in internal note and path, if specified.
     """
-    pattern = re.compile('(?P<width>\d+)\s*x\s*(?P<height>\d+)', re.IGNORECASE)
-    match = pattern.search(internal_note+path)
+    match = DIMENSION_PATTERN.search(internal_note+path)
     if match:
         width = match.group('width')
         height = match.group('height')
@@ -700,8 +1015,7 @@ def get_video_bitrate(internal_note):
     Return the video bitrate as int.
     Return None if not identified
     """
-    pattern = re.compile('(?P<rate>\d+)(\s|-)*kbps', re.IGNORECASE)
-    match = pattern.search(internal_note)
+    match = VIDEO_BITRATE_PATTERN.search(internal_note)
     if match:
         rate = match.group('rate')
         if rate.isdigit():
@@ -715,8 +1029,7 @@ def get_audio_bitrate(internal_note):
     Return the audio bitrate as int.
     Return None if not identified
     """
-    pattern = re.compile('audio\s*(?P<rate>\d+)\s*kbps', re.IGNORECASE)
-    match = pattern.search(internal_note)
+    match = AUDIO_BITRATE_PATTERN.search(internal_note)
     if match is not None:
         return match.group('rate')
     else:
@@ -728,8 +1041,7 @@ def get_audio_frequency(internal_note):
     Return the audio frequency as int, in kHz
     Return None if not identified
     """
-    pattern = re.compile('(?P<freq>\d+)(\s|-)*khz', re.IGNORECASE)
-    match = pattern.search(internal_note)
+    match = AUDIO_FREQUENCY_PATTERN.search(internal_note)
     if match is not None:
         freq = match.group('freq')
         if freq.isdigit():
@@ -743,8 +1055,7 @@ def get_framerate(internal_note):
     Return the number of fps as int.
     Return None if not identified
     """
-    pattern = re.compile('(?P<frequency>\d+)(\s|-)*fps', re.IGNORECASE)
-    match = pattern.search(internal_note)
+    match = FRAMERATE_PATTERN.search(internal_note)
     if match is not None:
         freq = match.group('frequency')
         if freq.isdigit():
@@ -772,55 +1083,201 @@ def get_percentage(internal_note):
     Returns the percentage of the video the image of taken
     Returns None if cannot be identified
     """
-    pattern = re.compile('(?P<percent>\d+)(\s|-)*percent', re.IGNORECASE)
-    match = pattern.search(internal_note)
+    match = PERCENTAGE_PATTERN.search(internal_note)
     if match:
         percent = match.group('percent')
         if percent.isdigit():
             return int(percent)
     return 0
+
+
+# Matches, in one scan, the numbers of an internal note together with
+# what the functions above look for around them: either the height
+# following the number (the dimension) or the unit following the number,
+# or the height if there is one. The numbers are consumed whole, which
+# is also where re.search finds them. "audio" is matched on its own so
+# that its bitrate is also seen as a video bitrate, like
+# get_video_bitrate does.
+MEDIA_NOTE_TOKENIZER = re.compile(r'''
+      (?P<number>\d+)
+      (?:\s*x\s*(?P<height>\d+))?
+      (?:(?:\s|-)*(?P<unit>kbps|fps|khz|percent))?
+    | audio(?=\s*(?P<audio_bitrate>\d+)\s*kbps)
+    ''', re.IGNORECASE | re.VERBOSE)
+
+MediaNoteInfo = namedtuple('MediaNoteInfo', ('dimension', 'video_bitrate', 'fps',
+                                             'audio_canal', 'audio_bitrate',
+                                             'audio_frequency', 'percent'))
+
+def parse_media_note(internal_note, path=""):
+    """
+    Returns a MediaNoteInfo with the dimension, video bitrate, framerate,
+    number of audio canals, audio bitrate, audio frequency and percentage
+    found in the internal note, scanning it only once.
+
+    The values are the same (and of the same types) as the ones returned
+    by get_dimension(internal_note, path), get_video_bitrate,
+    get_framerate, get_nb_audio_canal, get_audio_bitrate,
+    get_audio_frequency and get_percentage(internal_note).
+    """
+    dimension = None
+    audio_bitrate = None
+    units = {}
+    for number, height, unit, bitrate in MEDIA_NOTE_TOKENIZER.findall(internal_note):
+        if height:
+            if dimension is None:
+                dimension = (int(number), int(height))
+            number = height
+        if unit:
+            unit = unit.lower()
+            if unit not in units:
+                units[unit] = int(number)
+        elif bitrate and audio_bitrate is None:
+            audio_bitrate = bitrate
+
+    if dimension is None or \
+           (internal_note[-1:].isdigit() and path[:1].isdigit()):
+        # The dimension is also looked for in the path, and might
+        # continue there
+        dimension = get_dimension(internal_note, path)
+
+    return MediaNoteInfo(dimension,
+                         units.get('kbps'),
+                         units.get('fps'),
+                         get_nb_audio_canal(internal_note),
+                         audio_bitrate,
+                         units.get('khz'),
+                         units.get('percent', 0))
 #End Parse Metadata Functions#
 
 
-def generate_mediaexport_album(recid, resource_id, json_format=True):
+class MediaExportContext(object):
+    """
+    What generate_mediaexport reads about a record (fields, creation
+    date, bibdocs, captions, licence...), read once and kept to export
+    several media of the record, e.g. all the images of an album.
+    Everything is read the first time it is needed.
+    """
+
+    def __init__(self, recid, record=None):
+        self.recid = recid
+        if record is None:
+            record = get_record(recid)
+        self.record = record
+        self._field_values = {}
+        self._creation_date = None
+        self._toc_recid = None
+        self._toc_record = None
+        self._license_urls = {}
+        self._captions = None
+        self._bibrecdocs = None
+        self._bibdocs = None
+
+    def get_field_value(self, field):
+        """Returns the first value of the field, e.g. ('245', ' ', ' ', 'a')"""
+        values = self.get_field_values(field)
+        return values and values[0] or ''
+
+    def get_field_values(self, field):
+        """Returns the values of the field, e.g. ('653', '1', ' ', 'a')"""
+        if field not in self._field_values:
+            self._field_values[field] = record_get_field_values(self.record, *field)
+        return self._field_values[field]
+
+    def get_creation_date(self):
+        if self._creation_date is None:
+            self._creation_date = get_creation_date(self.recid)
+        return self._creation_date
+
+    def get_toc_recid(self):
+        """Returns the record of the TOC of the record (for video assets), or 0"""
+        if self._toc_recid is None:
+            self._toc_recid = 0
+            toc_repnum = self.get_field_value(('773', ' ', ' ', 'r'))
+            if toc_repnum:
+                try:
+                    toc_recids = get_recids_for_identifier('reportnumber', toc_repnum)
+                    if toc_recids is None:
+                        toc_recids = search_pattern(p='reportnumber:"%s"' %toc_repnum)
+                    self._toc_recid = toc_recids[0]
+                except IndexError:
+                    pass
+        return self._toc_recid
+
+    def get_toc_record(self):
+        if self._toc_record is None:
+            self._toc_record = get_record(self.get_toc_recid())
+        return self._toc_record
+
+    def get_license_url(self, license_desc):
+        """Returns the URL of the licence (LICENSE2URL knowledge base), or None"""
+        if license_desc not in self._license_urls:
+            from invenio.bibknowledge import get_kb_mapping
+            try:
+                self._license_urls[license_desc] = get_kb_mapping(kb_name='LICENSE2URL', key=license_desc)['value']
+            except KeyError:
+                self._license_urls[license_desc] = None
+        return self._license_urls[license_desc]
+
+    def get_captions(self):
+        """Returns the captions of the PhotoLab images (see get_photolab_image_captions)"""
+        if self._captions is None:
+            self._captions = get_photolab_image_captions(self.record)
+        return self._captions
+
+    def get_bibdocs(self):
+        """Returns the bibdocs of the record, deleted ones included, sorted by id"""
+        if self._bibdocs is None:
+            self._bibrecdocs = BibRecDocs(self.recid, deleted_too=True)
+            doc_numbers = [(bibdoc.get_id(), bibdoc) for bibdoc in self._bibrecdocs.list_bibdocs()]
+            doc_numbers.sort()
+            self._bibdocs = [bibdoc for (docid, bibdoc) in doc_numbers]
+        return self._bibdocs
+
+    def get_docname(self, bibdoc):
+        self.get_bibdocs()
+        return self._bibrecdocs.get_docname(bibdoc.get_id())
+
+
+def generate_mediaexport_album(recid, resource_id, json_format=True, record=None):
     """Return the report number of associate images.
 
     :param str recid: The record id.
     :param str resource_id: The report number.
     :param str json_format: If true, returns JSON dump, otherwise a dictionary
+    :param dict record: The record structure, if already read.
+
+    The record, its bibdocs, licence and captions are read once for all
+    the images (see MediaExportContext).
     """
     # Fileds that are required
     MEDIA_CONFIG = {
         'title_en': ('245', ' ', ' ', 'a'),
         'title_fr': ('246', ' ', '1', 'a'),
     }
-    bibarchive = BibRecDocs(recid)
-    bibarchive_with_deleted = BibRecDocs(recid, deleted_too=True)
-    bibdocs = bibarchive.list_bibdocs()
-    doc_numbers = [(bibdoc.get_id(), bibdoc.get_docname(), bibdoc) for bibdoc in bibarchive_with_deleted.list_bibdocs()]
-    doc_numbers.sort()
+    context = MediaExportContext(recid, record)
+    bibdocs = context.get_bibdocs()
     # Calculate the size
-    bibdoc_size = len(bibdocs)
-    # Get the record
-    record = get_record(recid)
+    bibdoc_size = len([bibdoc for bibdoc in bibdocs if not bibdoc.deleted_p()])
     # Build the response
     entry = {}
 
     for key in MEDIA_CONFIG:
-        entry[key] = record_get_field_value(record, *MEDIA_CONFIG[key])
+        entry[key] = context.get_field_value(MEDIA_CONFIG[key])
 
     entry['id'] = resource_id
     entry['record_id'] = str(recid)
-    entry['entry_date'] = get_creation_date(recid)
+    entry['entry_date'] = context.get_creation_date()
     entry['total'] = bibdoc_size
     entry['type'] = 'album'
     entry['images'] = []
 
     # Foreach doc create the corresponding report number
-    for (docid, docname, bibdoc) in doc_numbers:
+    for (i, bibdoc) in enumerate(bibdocs):
         if not bibdoc.deleted_p():
-            bibdoc_number = doc_numbers.index((bibdoc.get_id(), bibdoc.get_docname(), bibdoc)) + 1
-            image = generate_mediaexport(recid, True, resource_id, bibdoc_number, False)
+            bibdoc_number = i + 1
+            image = generate_mediaexport(recid, True, resource_id, bibdoc_number, False, False,
+                                         context=context)
             image['tirage_id'] = bibdoc_number
             image['id'] = '{0}-{1}'.format(image['id'], bibdoc_number)
             entry['images'].append(image)
@@ -844,11 +1301,42 @@ def generate_mediaexport_basket(basket_id):
 
     :param str basket_id: The basket id.
     """
+    output = {}
+    output['entries'] = list(_generate_mediaexport_basket_entries(basket_id))
+    return json.dumps(output)
+
+
+def stream_mediaexport_basket(basket_id, ndjson=False):
+    """
+    Exports the content of a basket as generate_mediaexport_basket, but
+    yields the JSON by pieces as soon as each entry is exported, so that
+    the whole export is never kept in memory. The pieces put together
+    are the output of generate_mediaexport_basket.
+
+    :param str basket_id: The basket id.
+    :param bool ndjson: If true, yields one line of JSON per entry instead
+                        (newline-delimited JSON), without the envelope.
+    """
+    if ndjson:
+        for entry in _generate_mediaexport_basket_entries(basket_id):
+            yield json.dumps(entry) + '\n'
+        return
+    separator = ''
+    yield '{"entries": ['
+    for entry in _generate_mediaexport_basket_entries(basket_id):
+        yield separator + json.dumps(entry)
+        separator = ', '
+    yield ']}'
+
+
+def _generate_mediaexport_basket_entries(basket_id):
+    """
+    Yields the entries of the export of the basket (see
+    generate_mediaexport_basket), one record at a time.
+    """
     records = get_basket_content(basket_id, format='')
     recids = [record[0] for record in records]
 
-    output = {}
-    output['entries'] = []
     for record_id in recids:
         # For each record_id return metadata
         record = get_record(record_id)
@@ -857,10 +1345,10 @@ def generate_mediaexport_basket(basket_id):
             # resource). Skip it.
             continue
         report_number = record_get_field_value(record, *('037', ' ', ' ', 'a'))
-        album_dict = generate_mediaexport_album(record_id, report_number, False)
+        album_dict = generate_mediaexport_album(record_id, report_number, False, record=record)
         album_entries = album_dict.get('entries', None)
         if album_entries:
-            output['entries'].append(album_entries)
+            yield album_entries
         else:
             # If it's not an album, check if it's an image
             is_image = False
@@ -871,18 +1359,21 @@ def generate_mediaexport_basket(basket_id):
                     is_image = True
                     break
             tirage = report_number.rsplit("-", 1)[-1]
-            media_dict = generate_mediaexport(record_id, is_image, report_number, tirage, False, False)
+            media_dict = generate_mediaexport(record_id, is_image, report_number, tirage, False, False,
+                                              record=record)
             if media_dict:
-                output['entries'].append(media_dict)
-
-    return json.dumps(output)
+                yield media_dict
 
 
-def generate_mediaexport(recid, is_image, resource_id, tirage, wrapped, json_format=True):
+def generate_mediaexport(recid, is_image, resource_id, tirage, wrapped, json_format=True,
+                         record=None, context=None):
     """Generates the JSON with the info needed to export a media resource to  CERN-Drupal"""
     """Mandatory fields to export: title_en, title_fr, caption_en, caption_fr,
                                    copyright_holder, copyright_date, attribution (image),
                                    keywords (image), directors (video), producer (video)
+
+    The record structure can be given when it is already read, and the
+    MediaExportContext of the record to export several of its media.
     """
 
     MEDIA_CONFIG = {'title_en':         ('245', ' ', ' ', 'a'),
@@ -903,25 +1394,20 @@ def generate_mediaexport(recid, is_image, resource_id, tirage, wrapped, json_for
                     'abstract_fr':      ('590', ' ', ' ', 'a')}
 
     entry = {}
-    record = get_record(recid)
+    if context is None:
+        context = MediaExportContext(recid, record)
 
     for key in MEDIA_CONFIG:
-        entry[key] = record_get_field_value(record, *MEDIA_CONFIG[key])#.encode('utf-8')
+        entry[key] = context.get_field_value(MEDIA_CONFIG[key])#.encode('utf-8')
 
     entry['id'] = resource_id
     entry['record_id'] = str(recid)
     entry['type'] = is_image and "image" or "video"
-    entry['entry_date'] = get_creation_date(recid)
+    entry['entry_date'] = context.get_creation_date()
 
     toc_recid = 0
-    toc_record = {}
-    if not is_image and 'asset' in record_get_field_value(record, *('970', ' ', ' ', 'a')):
-        toc_repnum = record_get_field_value(record, *('773', ' ', ' ', 'r'))
-        if toc_repnum:
-            try:
-                toc_recid = search_pattern(p='reportnumber:"%s"' %toc_repnum)[0]
-            except IndexError:
-                pass
+    if not is_image and 'asset' in context.get_field_value(('970', ' ', ' ', 'a')):
+        toc_recid = context.get_toc_recid()
 
     #corner cases for copyright & licence
     if not entry['copyright_holder']:
@@ -931,19 +1417,16 @@ def generate_mediaexport(recid, is_image, resource_id, tirage, wrapped, json_for
     if not entry['license_desc']:
         entry['license_desc'] = 'CERN'
     if not entry['license_url']:
-        from invenio.bibknowledge import get_kb_mapping
-        try:
-            entry['license_url'] = get_kb_mapping(kb_name='LICENSE2URL', key=entry['license_desc'])['value']
-        except KeyError:
-            pass
+        license_url = context.get_license_url(entry['license_desc'])
+        if license_url is not None:
+            entry['license_url'] = license_url
 
     #keywords
-    entry['keywords'] = ','.join(record_get_field_values(record, *MEDIA_CONFIG['keywords']))
+    entry['keywords'] = ','.join(context.get_field_values(MEDIA_CONFIG['keywords']))
 
     #attribution
     if not entry.get('author', '') and not entry.get('attribution', '') and toc_recid > 0:
-        if not toc_record:
-            toc_record = get_record(toc_recid)
+        toc_record = context.get_toc_record()
         entry['author'] = record_get_field_value(toc_record, *MEDIA_CONFIG['author'])
         entry['affiliation'] = record_get_field_value(toc_record, *MEDIA_CONFIG['affiliation'])
         if not entry.get('directors', ''):
@@ -963,7 +1446,7 @@ def generate_mediaexport(recid, is_image, resource_id, tirage, wrapped, json_for
         files_field = ('856', '7', ' ', 'u')
         # Filter all that are images
         thumbnails = [
-            image for image in record_get_field_values(record, *files_field)
+            image for image in context.get_field_values(files_field)
             if 'jpg' in image
         ]
         # If exists get the first one
@@ -977,8 +1460,7 @@ def generate_mediaexport(recid, is_image, resource_id, tirage, wrapped, json_for
     #
     #title
     if not entry['title_en'] and not entry['title_fr'] and toc_recid > 0:
-        if not toc_record:
-            toc_record = get_record(toc_recid)
+        toc_record = context.get_toc_record()
         entry['title_en'] = record_get_field_value(toc_record, *MEDIA_CONFIG['title_en'])
         entry['title_fr'] = record_get_field_value(toc_record, *MEDIA_CONFIG['title_fr'])
 
@@ -986,15 +1468,12 @@ def generate_mediaexport(recid, is_image, resource_id, tirage, wrapped, json_for
     if is_image:
         entry['file_params'] = {'size': ['small', 'medium', 'large'], 'crop': False}
 
-        if 'MediaArchive' in record_get_field_values(record, *('856', '7', ' ', '2')):
-            entry['caption_en'] = get_photolab_image_caption(record, tirage)
+        if 'MediaArchive' in context.get_field_values(('856', '7', ' ', '2')):
+            entry['caption_en'] = context.get_captions().get(tirage, '')
             entry['caption_fr'] = ''
         else:
-            brd = BibRecDocs(recid, deleted_too=True)
-            doc_numbers = [(bibdoc.get_id(), bibdoc) for bibdoc in brd.list_bibdocs()]
-            doc_numbers.sort()
-            bibdoc = doc_numbers[tirage-1][1]
-            entry['filename'] = brd.get_docname(bibdoc.get_id()) #bibdoc.get_docname()
+            bibdoc = context.get_bibdocs()[tirage-1]
+            entry['filename'] = context.get_docname(bibdoc) #bibdoc.get_docname()
             if 'crop' in [bibdocfile.get_subformat() for bibdocfile in bibdoc.list_latest_files()]:
                 entry['file_params']['crop'] = True
             if not bibdoc.deleted_p():
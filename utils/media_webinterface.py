@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+
+"""
+Web interface of the fragments of the media pages, loaded by the pages
+of the records to display more of their media:
+
+    /photo/album/<recid>  next page of the photos of an album
+                          (see bfe_CERN_photo_resources.format_photo_album_page)
+    /video/toc/<recid>    next page of the assets of a TOC record
+                          (see bfe_CERN_movie.format_toc_assets_page)
+
+The fragments are only served to the users who can see the record. To
+be mounted in webinterface_layout, e.g.:
+
+    from invenio.media_webinterface import WebInterfacePhotoPages, \
+         WebInterfaceVideoPages
+    ...
+    photo = WebInterfacePhotoPages()
+    video = WebInterfaceVideoPages()
+"""
+
+from invenio import webinterface_handler_config as apache
+from invenio.webinterface_handler import wash_urlargd, WebInterfaceDirectory
+from invenio.webuser import collect_user_info
+from invenio.search_engine import record_exists, check_user_can_view_record
+from invenio.bibformat_elements.bfe_CERN_photo_resources import format_photo_album_page
+from invenio.bibformat_elements.bfe_CERN_movie import format_toc_assets_page
+
+
+def check_record_access(req, recid):
+    """
+    Stops the request with a 404 if the record does not exist, or a 403
+    if the user cannot see it
+    """
+    if record_exists(recid) != 1:
+        raise apache.SERVER_RETURN, apache.HTTP_NOT_FOUND
+    (auth_code, dummy) = check_user_can_view_record(collect_user_info(req), recid)
+    if auth_code:
+        raise apache.SERVER_RETURN, apache.HTTP_FORBIDDEN
+
+
+class WebInterfacePhotoAlbumPage(WebInterfaceDirectory):
+    """Serves the pages of the photos of an album: /photo/album/<recid>"""
+
+    _exports = ['']
+
+    def __init__(self, recid):
+        self.recid = recid
+
+    def index(self, req, form):
+        argd = wash_urlargd(form, {'page': (str, '1'),
+                                   'page_size': (str, ''),
+                                   'display_name': (str, 'no'),
+                                   'display_reference': (str, 'yes'),
+                                   'display_description': (str, 'yes'),
+                                   'display_comment': (str, 'yes'),
+                                   'display_tirage': (str, 'yes'),
+                                   'submission_doctype': (str, '')})
+        del argd['ln']
+        check_record_access(req, self.recid)
+        req.content_type = 'text/html'
+        return format_photo_album_page(self.recid, **argd)
+
+    __call__ = index
+
+
+class WebInterfacePhotoAlbumPages(WebInterfaceDirectory):
+    """/photo/album/"""
+
+    def _lookup(self, component, path):
+        if component.isdigit():
+            return WebInterfacePhotoAlbumPage(int(component)), path
+        return None, []
+
+
+class WebInterfacePhotoPages(WebInterfaceDirectory):
+    """/photo/"""
+
+    _exports = ['album']
+
+    album = WebInterfacePhotoAlbumPages()
+
+
+class WebInterfaceVideoTocPage(WebInterfaceDirectory):
+    """Serves the pages of the assets of a TOC record: /video/toc/<recid>"""
+
+    _exports = ['']
+
+    def __init__(self, recid):
+        self.recid = recid
+
+    def index(self, req, form):
+        argd = wash_urlargd(form, {'page': (str, '1'),
+                                   'page_size': (str, '')})
+        del argd['ln']
+        check_record_access(req, self.recid)
+        req.content_type = 'text/html'
+        return format_toc_assets_page(self.recid, **argd)
+
+    __call__ = index
+
+
+class WebInterfaceVideoTocPages(WebInterfaceDirectory):
+    """/video/toc/"""
+
+    def _lookup(self, component, path):
+        if component.isdigit():
+            return WebInterfaceVideoTocPage(int(component)), path
+        return None, []
+
+
+class WebInterfaceVideoPages(WebInterfaceDirectory):
+    """/video/"""
+
+    _exports = ['toc']
+
+    toc = WebInterfaceVideoTocPages()
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Compiled rules of the output formats (.bfo files), to choose the format
+template of a record without scanning all the rules.
+
+BibFormat tries the 'tag X: VALUE --- template' rules one after the
+other, reading the field of the rule from the record each time, and
+uses the template of the first rule whose value (a regular expression,
+case insensitive) matches a value of the field entirely. The compiled
+output format gives the same template, but reads each field once and
+finds the first matching rule of the field with:
+
+ - a dictionary of the values of the rules that are plain strings
+   (e.g. 980__a: ARTICLE),
+
+ - a single regular expression combining the other rules of the field
+   (e.g. 970__a: FCS.project.*), in the order of the rules.
+
+The rules that can never be used (e.g. duplicates, or values already
+matched by a previous rule), and the rules of a field that are tried
+after the rules of other fields while other rules of the field are
+tried before, are reported by running this module:
+
+    $ python output_format_rules.py HB HD
+"""
+
+import os
+import re
+import threading
+import time
+from optparse import OptionParser
+
+from invenio.config import CFG_BIBFORMAT_OUTPUTS_PATH
+
+# Time (in seconds) between two checks for modified output formats
+CFG_OUTPUT_FORMAT_RULES_CHECK_INTERVAL = 60
+
+# The values of the rules that are not plain strings
+REGEXP_CHARACTERS = re.compile(r'[.^$*+?{}\[\]\\|()]')
+# The regular expressions that cannot be combined with others (named
+# groups and references to groups)
+UNCOMBINABLE_REGEXP = re.compile(r'\(\?P|\\\d')
+
+# The compiled output formats: code -> [time of the last check, mtime, compiled]
+_output_formats = {}
+_output_formats_lock = threading.Lock()
+
+
+def parse_output_format(path):
+    """
+    Returns the rules and the default template of the output format file,
+    as read by BibFormat: {'rules': [{'field', 'value', 'template',
+    'line'}, ...], 'default': template}
+    """
+    output_format = {'rules': [], 'default': ''}
+    current_tag = ''
+    format_file = open(path)
+    try:
+        for (line_number, line) in enumerate(format_file):
+            line = line.strip()
+            if not line:
+                continue
+            if line.endswith(':'):
+                current_tag = ''.join(line.rstrip(': \n\r').split()[1:]).strip()
+            elif '---' in line:
+                words = line.split('---')
+                output_format['rules'].append({'field': current_tag,
+                                               'value': ''.join(words[:-1]),
+                                               'template': words[-1].strip(),
+                                               'line': line_number + 1})
+            elif ':' in line:
+                output_format['default'] = line.split(':')[1].strip()
+    finally:
+        format_file.close()
+    return output_format
+
+
+def rule_matches(pattern, value):
+    """
+    Returns True if the value of a field matches the value of a rule
+    entirely, as BibFormat checks it
+    """
+    match = re.match(pattern.strip(), value.strip(), re.IGNORECASE)
+    return match is not None and match.end() == len(value.strip())
+
+
+class CompiledOutputFormat(object):
+    """
+    The rules of an output format, compiled to choose the template of a
+    record (see module documentation)
+    """
+
+    def __init__(self, output_format):
+        """
+        @param output_format: the rules and default template of the output
+                              format (see parse_output_format)
+        """
+        self.rules = output_format['rules']
+        self.default = output_format['default'] or None
+        # (rule, line, kind, message) for each rule that is never used
+        # ('shadowed' or 'unreachable'), or used only after the rules of
+        # other fields although other rules of its field are tried before
+        # them ('ordering')
+        self.report = []
+        # The fields, in the order of their first rule:
+        # (index of the first rule, tag, values -> index,
+        #  [(index, regexp, combinable)], combined regexp)
+        self.fields = []
+        fields = {}
+        for (index, rule) in enumerate(self.rules):
+            tag = rule['field']
+            pattern = rule['value'].strip()
+            if not tag:
+                self._report(index, 'unreachable', 'rule without tag')
+                continue
+            if tag not in fields:
+                fields[tag] = (index, tag, {}, [])
+                self.fields.append(fields[tag])
+            elif self.rules[index - 1]['field'] != tag:
+                # The rules of other fields since the previous rules of
+                # this one are tried first
+                others = [other for other in xrange(fields[tag][0], index)
+                          if self.rules[other]['field'] not in ('', tag)]
+                lines = str(self.rules[others[0]]['line'])
+                if len(others) > 1:
+                    lines = 'lines %s-%s' % (lines, self.rules[others[-1]]['line'])
+                else:
+                    lines = 'line %s' % lines
+                self._report(index, 'ordering', "rules of %s from here on are tried after "
+                             "the rules of %s of %s"
+                             % (tag, ', '.join(sorted(set([self.rules[other]['field'] for other in others]))),
+                                lines))
+            (dummy, dummy, values, regexps) = fields[tag]
+            if not REGEXP_CHARACTERS.search(pattern):
+                self._add_value(index, pattern, values, regexps)
+            else:
+                self._add_regexp(index, pattern, regexps)
+        self.fields = [(first, tag, values, regexps, self._combine(regexps))
+                       for (first, tag, values, regexps) in self.fields]
+        self.report.sort()
+
+    def _report(self, index, kind, message):
+        """Reports a rule that is never used"""
+        self.report.append((index, self.rules[index]['line'], kind, message))
+
+    def _describe(self, index):
+        """Returns a short description of a rule, for the report"""
+        return "line %s (%s)" % (self.rules[index]['line'], self.rules[index]['template'])
+
+    def _add_value(self, index, pattern, values, regexps):
+        """Adds a rule whose value is a plain string"""
+        for (other, regexp, dummy) in regexps:
+            if rule_matches(regexp.pattern, pattern):
+                self._report(index, 'shadowed', "%s already matched by %s"
+                             % (pattern, self._describe(other)))
+                return
+        other = values.get(pattern.lower())
+        if other is not None:
+            self._report(index, 'shadowed', "%s already matched by %s"
+                         % (pattern, self._describe(other)))
+            return
+        values[pattern.lower()] = index
+
+    def _add_regexp(self, index, pattern, regexps):
+        """Adds a rule whose value is a regular expression"""
+        try:
+            regexp = re.compile(pattern, re.IGNORECASE)
+        except re.error, error:
+            self._report(index, 'unreachable', "invalid regular expression %s: %s"
+                         % (pattern, error))
+            return
+        for (other, other_regexp, dummy) in regexps:
+            if other_regexp.pattern == pattern or \
+                   ('\\' not in pattern and other_regexp.pattern.lower() == pattern.lower()):
+                self._report(index, 'shadowed', "%s already matched by %s"
+                             % (pattern, self._describe(other)))
+                return
+        regexps.append((index, regexp, not UNCOMBINABLE_REGEXP.search(pattern)))
+
+    def _combine(self, regexps):
+        """
+        Returns a regular expression matching the values entirely matched
+        by one of the given ones, the group named after the first one, or
+        None if there are none
+        """
+        alternatives = ['(?P<r%s>(?:%s)\Z)' % (index, regexp.pattern)
+                        for (index, regexp, combinable) in regexps if combinable]
+        if not alternatives:
+            return None
+        return re.compile('|'.join(alternatives), re.IGNORECASE)
+
+    def _match(self, value, values, regexps, combined):
+        """
+        Returns the index of the first rule of the field matching the
+        value, or None
+        """
+        value = value.strip()
+        index = values.get(value.lower())
+        # The combined regexp gives the first regexp matching the value
+        # followed by its end: the combined ones before cannot match it
+        first_candidate = None
+        if combined is not None:
+            match = combined.match(value)
+            if match is None:
+                first_candidate = len(self.rules)
+            else:
+                first_candidate = int(match.lastgroup[1:])
+        for (other, regexp, combinable) in regexps:
+            if index is not None and other > index:
+                break
+            if combinable and first_candidate is not None and other < first_candidate:
+                continue
+            # Check the match as BibFormat does, since a regexp can match
+            # followed by the end of the value but not entirely (e.g. 'A|AB')
+            match = regexp.match(value)
+            if match is not None and match.end() == len(value):
+                return other
+        return index
+
+    def get_rule(self, get_values):
+        """
+        Returns the index of the rule used for the record, or None
+
+        @param get_values: function returning the values of a field of
+                           the record
+        """
+        best = None
+        for (first, tag, values, regexps, combined) in self.fields:
+            if best is not None and first > best:
+                break
+            for value in get_values(tag):
+                index = self._match(value, values, regexps, combined)
+                if index is not None and (best is None or index < best):
+                    best = index
+        return best
+
+    def decide_format_template(self, bfo):
+        """
+        Returns the format template to use for the record of bfo, or None
+        """
+        def get_values(tag):
+            "Returns the values of the field, as BibFormat reads them"
+            if tag.startswith('00'):
+                return [bfo.control_field(tag)]
+            return bfo.fields(tag)
+        index = self.get_rule(get_values)
+        if index is None:
+            return self.default
+        return self.rules[index]['template']
+
+
+def get_output_format_path(of):
+    """
+    Returns the path of the file of the output format of the given code
+    """
+    return os.path.join(CFG_BIBFORMAT_OUTPUTS_PATH,
+                        re.sub(r'\W', '', of).upper() + '.bfo')
+
+
+def get_compiled_output_format(of):
+    """
+    Returns the compiled rules of the output format, compiled again when
+    its file changes
+    """
+    _output_formats_lock.acquire()
+    try:
+        now = time.time()
+        output_format = _output_formats.setdefault(of, [0, None, None])
+        if now - output_format[0] >= CFG_OUTPUT_FORMAT_RULES_CHECK_INTERVAL:
+            output_format[0] = now
+            path = get_output_format_path(of)
+            mtime = os.path.getmtime(path)
+            if mtime != output_format[1]:
+                output_format[2] = CompiledOutputFormat(parse_output_format(path))
+                output_format[1] = mtime
+        return output_format[2]
+    finally:
+        _output_formats_lock.release()
+
+
+def decide_format_template(bfo, of):
+    """
+    Returns the format template to use for the record of bfo in the given
+    output format, or None (same as
+    bibformat_engine.decide_format_template)
+    """
+    return get_compiled_output_format(of).decide_format_template(bfo)
+
+
+def main():
+    """
+    Prints the rules of the output formats that are never used.
+    """
+    parser = OptionParser(usage="%prog [output format code ...]")
+    (dummy, codes) = parser.parse_args()
+    if not codes:
+        codes = sorted([filename[:-len('.bfo')] for filename in os.listdir(CFG_BIBFORMAT_OUTPUTS_PATH)
+                        if filename.endswith('.bfo')])
+    for of in codes:
+        path = get_output_format_path(of)
+        output_format = CompiledOutputFormat(parse_output_format(path))
+        never_used = [kind for (dummy, dummy, kind, dummy) in output_format.report
+                      if kind != 'ordering']
+        print "%s: %s rules, %s never used" % (os.path.basename(path), len(output_format.rules),
+                                               len(never_used))
+        for (index, line, kind, message) in output_format.report:
+            rule = output_format.rules[index]
+            print "  line %s: %s %s --- %s: %s: %s" % (line, rule['field'], rule['value'].strip(),
+                                                     rule['template'], kind, message)
+
+
+if __name__ == '__main__':
+    main()
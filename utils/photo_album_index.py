@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Index of the photos attached to a record (album, event display...).
+
+The bibdocs of the record, deleted ones included, and their latest
+files are read once into a compact structure: the photos sorted by
+docid (their position gives their tirage), each with the information
+about its files needed to display it. The structure is cached per
+revision of the record and of its documents: the bibdocfile operations
+(hiding or deleting a photo, adding an icon...) modify the documents
+without modifying the record (see cache_utils.get_bibdocs_revision).
+"""
+
+from collections import namedtuple
+
+from invenio.dbquery import run_sql
+from invenio.bibdocfile import BibRecDocs
+from invenio.cache_utils import TTLCache, get_record_revision, get_bibdocs_revision
+from invenio.media_utils import chunkify
+
+# Number of albums kept in memory, and for how long (in seconds)
+CFG_PHOTO_ALBUM_INDEX_CACHE_SIZE = 500
+CFG_PHOTO_ALBUM_INDEX_CACHE_TTL = 3600
+
+AlbumFile = namedtuple('AlbumFile', ('format', 'subformat', 'url', 'size', 'icon',
+                                     'hidden', 'description', 'comment'))
+AlbumPhoto = namedtuple('AlbumPhoto', ('docid', 'docname', 'doctype', 'deleted',
+                                       'flash_panorama', 'files', 'sort_key'))
+Album = namedtuple('Album', ('recid', 'revision', 'photos', 'nb_photos'))
+
+_album_cache = TTLCache(max_size=CFG_PHOTO_ALBUM_INDEX_CACHE_SIZE,
+                        ttl=CFG_PHOTO_ALBUM_INDEX_CACHE_TTL)
+
+
+def build_album_index(recid, revision=None):
+    """
+    Returns the Album of the record: its photos (AlbumPhoto, deleted
+    ones included, sorted by docid, each with the AlbumFile of its
+    latest files if not deleted) and the number of photos that are not
+    deleted.
+    """
+    bibarchive = BibRecDocs(recid, deleted_too=True)
+    # The names of all the bibdocs at once, rather than one query per
+    # bibdoc with bibarchive.get_docname
+    docnames = dict(run_sql("SELECT id_bibdoc, docname FROM bibrec_bibdoc WHERE id_bibrec=%s",
+                            (recid, )))
+    photos = []
+    for bibdoc in bibarchive.list_bibdocs():
+        docid = bibdoc.get_id()
+        docname = docnames.get(docid)
+        if docname is None:
+            docname = bibarchive.get_docname(docid)
+        doctype = bibdoc.get_type()
+        deleted = bibdoc.deleted_p()
+        files = ()
+        flash_panorama = False
+        if not deleted:
+            files = tuple([AlbumFile(docfile.get_format(), docfile.get_subformat(),
+                                     docfile.get_url(), docfile.get_size(),
+                                     docfile.is_icon(), docfile.hidden_p(),
+                                     docfile.get_description(), docfile.get_comment())
+                           for docfile in bibdoc.list_latest_files()])
+            # Flash panoramas are not displayed as photos
+            flash_panorama = doctype == 'panorama' and bibdoc.format_already_exists_p('.swf')
+        photos.append(AlbumPhoto(docid, docname, doctype, deleted,
+                                 flash_panorama, files, chunkify(docname)))
+    photos.sort()
+    return Album(recid, revision, tuple(photos),
+                 len([photo for photo in photos if not photo.deleted]))
+
+
+def get_album_revision(recid):
+    """
+    Returns the revision of the album of the record: the revisions of the
+    record and of its documents
+    """
+    return (get_record_revision(recid), get_bibdocs_revision(recid))
+
+
+def get_album_index(recid, revision=None):
+    """
+    Returns the Album of the record (see build_album_index), cached
+    until the record or its documents are modified
+
+    @param revision: the revision of the album, if already known (see
+                     get_album_revision)
+    """
+    if revision is None:
+        revision = get_album_revision(recid)
+    album = _album_cache.get(recid)
+    if album is None or album.revision != revision or revision[0] is None:
+        album = build_album_index(recid, revision)
+        _album_cache.set(recid, album)
+    return album
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Prefetching of the records of a page of results, before formatting them.
+
+A BibFormatObject reads its record from the database the first time an
+element asks for a field, so that formatting a page of results costs
+one query per record (and more for the media manifests, the revisions
+of the records, the photos of the albums...). prefetch_records reads
+all these at once for the records of the page, and fills the
+BibFormatObjects with them, so that the elements find their fields
+already in memory.
+
+BFE_CERN_MOVIE prefetches the assets of a TOC record this way. The pages
+of search results are formatted by the search engine, outside of this
+tree: it has to call get_prefetched_bfos (or
+format_template_plans.format_records_with_format_template_plan) for
+their records to be prefetched.
+"""
+
+from invenio.bibformat_engine import BibFormatObject
+from invenio.cache_utils import get_record_structures, get_record_revisions
+from invenio.media_manifest import prefetch_media_manifests
+from invenio.media_utils import get_request_cache
+
+
+def get_album_photo_recids(bfo):
+    """
+    Returns the ids of the photos of the album displayed in its brief
+    format by BFE_CERN_PHOTO_THUMBNAILS: the first photo, and the first
+    cover photo
+    """
+    recids = []
+    photos = bfo.fields('774')
+    cover_photos = [photo for photo in photos if "Cover" in photo.get("n", "")]
+    for photo in cover_photos[:1] + photos[:1]:
+        if photo.get("r", "") and photo.get("r", "") not in recids:
+            recids.append(photo.get("r", ""))
+    if bfo.field('774__r') and bfo.field('774__r') not in recids:
+        recids.append(bfo.field('774__r'))
+    return recids
+
+
+def get_related_bfo(bfo, recid):
+    """
+    Returns a BibFormatObject of the record recid, related to the record
+    of bfo (e.g. a photo of an album), created only once while formatting
+    the record, and prefetched with it if possible (see prefetch_records)
+    """
+    cache = get_request_cache(bfo, 'related_bfo')
+    if recid not in cache:
+        cache[recid] = BibFormatObject(recid)
+    return cache[recid]
+
+
+def prefetch_records(bfos, related=True):
+    """
+    Reads at once the records of the given BibFormatObjects, their
+    revisions (see fragment_cache) and their media manifests (see
+    media_manifest), and, if related is True, the photos of the albums
+    (see get_related_bfo).
+    """
+    bfos = [bfo for bfo in bfos if bfo.recID]
+    if not bfos:
+        return
+    records = get_record_structures([bfo.recID for bfo in bfos if bfo.record is None])
+    for bfo in bfos:
+        if bfo.record is None and int(bfo.recID) in records:
+            bfo.record = records[int(bfo.recID)]
+
+    revisions = get_record_revisions([bfo.recID for bfo in bfos])
+    for bfo in bfos:
+        get_request_cache(bfo, 'record_revision')[bfo.recID] = revisions.get(int(bfo.recID))
+    prefetch_media_manifests(bfos, revisions)
+
+    if related:
+        related_bfos = {}
+        for bfo in bfos:
+            if bfo.field('999__a') == "ALBUM":
+                cache = get_request_cache(bfo, 'related_bfo')
+                for recid in get_album_photo_recids(bfo):
+                    if recid not in cache:
+                        if recid not in related_bfos:
+                            related_bfos[recid] = BibFormatObject(recid)
+                        cache[recid] = related_bfos[recid]
+        prefetch_records(related_bfos.values(), related=False)
+
+
+def get_prefetched_bfos(recids, ln, search_pattern=None, user_info=None):
+    """
+    Returns the BibFormatObjects of the given records, prefetched (see
+    prefetch_records)
+    """
+    bfos = [BibFormatObject(recid, ln=ln, search_pattern=search_pattern, user_info=user_info)
+            for recid in recids]
+    prefetch_records(bfos)
+    return bfos
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Index of the video folders of the MediaArchive that have a SMIL file.
+
+The player streams a video over HLS when the folder of its mp4 slave
+has a SMIL file (<dir>/<dirname>.smil). Instead of checking it on the
+MediaArchive each time a player is displayed, the SMIL files found are
+kept in an index file (one path, relative to /MediaArchive/, per line),
+loaded in memory and reloaded when it changes.
+
+The index is built by probing the SMIL files of the mp4 slaves of the
+records, and updated for the records modified since the previous run,
+e.g. every few minutes from cron, and rebuilt from time to time (e.g.
+daily), for the SMIL files added later to the folders:
+
+    $ python smil_index.py
+    $ python smil_index.py --all
+"""
+
+import os
+import threading
+import time
+from optparse import OptionParser
+
+from invenio.config import CFG_CACHEDIR
+from invenio.dbquery import run_sql
+from invenio.media_prober import probe_urls, url_exists
+
+MEDIAARCHIVE_PATH = '/MediaArchive/'
+CFG_SMIL_INDEX_DIR = os.path.join(CFG_CACHEDIR, 'smil_index')
+CFG_SMIL_INDEX_FILE = os.path.join(CFG_SMIL_INDEX_DIR, 'smil_index')
+CFG_SMIL_INDEX_LAST_RUN_FILE = os.path.join(CFG_SMIL_INDEX_DIR, 'last_run')
+# Time (in seconds) between two checks for a new index file
+CFG_SMIL_INDEX_CHECK_INTERVAL = 60
+# Number of SMIL files probed at once when building the index
+CFG_SMIL_INDEX_CHUNK_SIZE = 200
+
+_index = {'keys': None, 'mtime': None, 'checked': 0}
+_index_lock = threading.Lock()
+
+
+def get_smil_url(mp4_path):
+    """
+    Returns the URL of the SMIL file of the folder of the given mp4
+    slave (whether it exists or not)
+    """
+    mp4_path_tokens = mp4_path.split('/')
+    return '%s/%s.smil' % ('/'.join(mp4_path_tokens[:-1]), mp4_path_tokens[-2])
+
+
+def get_smil_key(smil_url):
+    """
+    Returns the key of the SMIL file in the index (its path relative to
+    /MediaArchive/), or None if it is not on the MediaArchive
+    """
+    if MEDIAARCHIVE_PATH not in smil_url:
+        return None
+    return smil_url.split(MEDIAARCHIVE_PATH, 1)[1]
+
+
+def read_smil_index():
+    """
+    Returns the set of the keys in the index file, or None if the index
+    has not been built
+    """
+    try:
+        index_file = open(CFG_SMIL_INDEX_FILE)
+    except IOError:
+        return None
+    try:
+        return frozenset([line.rstrip('\n') for line in index_file if line.strip()])
+    finally:
+        index_file.close()
+
+
+def write_smil_index(keys):
+    """
+    Stores the given keys in the index file
+    """
+    if not os.path.exists(CFG_SMIL_INDEX_DIR):
+        os.makedirs(CFG_SMIL_INDEX_DIR)
+    # Write to a temporary file first, so that the index is never read
+    # half written
+    tmp_path = '%s.%s.tmp' % (CFG_SMIL_INDEX_FILE, os.getpid())
+    index_file = open(tmp_path, 'w')
+    try:
+        for key in sorted(keys):
+            index_file.write(key + '\n')
+    finally:
+        index_file.close()
+    os.rename(tmp_path, CFG_SMIL_INDEX_FILE)
+
+
+def get_smil_index():
+    """
+    Returns the set of the keys in the index, loaded once and reloaded
+    when the index file changes, or None if the index has not been built
+    """
+    _index_lock.acquire()
+    try:
+        now = time.time()
+        if now - _index['checked'] >= CFG_SMIL_INDEX_CHECK_INTERVAL:
+            _index['checked'] = now
+            try:
+                mtime = os.path.getmtime(CFG_SMIL_INDEX_FILE)
+            except OSError:
+                mtime = None
+            if mtime != _index['mtime']:
+                _index['keys'] = read_smil_index()
+                _index['mtime'] = mtime
+        return _index['keys']
+    finally:
+        _index_lock.release()
+
+
+def smil_file_exists(smil_url):
+    """
+    Returns True if the SMIL file exists, according to the index. If the
+    index has not been built, or if the file is not on the MediaArchive,
+    checks it on the server.
+    """
+    key = get_smil_key(smil_url)
+    index = get_smil_index()
+    if index is None or key is None:
+        return url_exists(smil_url)
+    return key in index
+
+
+def get_mp4_slaves(since=None):
+    """
+    Returns the mp4 slaves of the records (modified since given date
+    'YYYY-MM-DD HH:MM:SS', if any)
+    """
+    query = "SELECT DISTINCT b.value FROM bib85x b, bibrec_bib85x bb, bibrec r " \
+            "WHERE bb.id_bibxxx=b.id AND bb.id_bibrec=r.id " \
+            "AND b.tag='8567_u' AND b.value LIKE '%%.mp4'"
+    if since is None:
+        return [row[0] for row in run_sql(query)]
+    return [row[0] for row in run_sql(query + " AND r.modification_date >= %s", (since, ))]
+
+
+def update_smil_index(mp4_paths, keys=None):
+    """
+    Probes the SMIL files of the folders of the given mp4 slaves, and
+    returns the given keys updated accordingly (the SMIL files that could
+    not be probed are left as they were).
+
+    @param mp4_paths: the URLs of mp4 slaves
+    @param keys: the current keys of the index
+    """
+    keys = set(keys or [])
+    smil_urls = {}
+    for mp4_path in mp4_paths:
+        smil_url = get_smil_url(mp4_path)
+        key = get_smil_key(smil_url)
+        if key is not None:
+            smil_urls[smil_url] = key
+    smil_urls = smil_urls.items()
+    for i in xrange(0, len(smil_urls), CFG_SMIL_INDEX_CHUNK_SIZE):
+        chunk = smil_urls[i:i + CFG_SMIL_INDEX_CHUNK_SIZE]
+        results = probe_urls([smil_url for (smil_url, dummy) in chunk], budget=600)
+        for (smil_url, key) in chunk:
+            if results[smil_url].status is None:
+                continue
+            if url_exists(smil_url):
+                keys.add(key)
+            else:
+                keys.discard(key)
+    return keys
+
+
+def main():
+    """
+    Updates the index with the records modified since the previous run,
+    or builds it from all the records.
+    """
+    parser = OptionParser(usage="%prog [--all]")
+    parser.add_option("-a", "--all", dest="all", action="store_true", default=False,
+                      help="build the index from all the records")
+    (options, dummy) = parser.parse_args()
+
+    start = time.strftime('%Y-%m-%d %H:%M:%S')
+    keys = read_smil_index()
+    if options.all or keys is None:
+        keys = update_smil_index(get_mp4_slaves())
+    else:
+        try:
+            since = open(CFG_SMIL_INDEX_LAST_RUN_FILE).read().strip()
+        except IOError:
+            since = '0000-00-00 00:00:00'
+        keys = update_smil_index(get_mp4_slaves(since), keys)
+    write_smil_index(keys)
+    print "%s SMIL files in the index" % len(keys)
+
+    last_run_file = open(CFG_SMIL_INDEX_LAST_RUN_FILE, 'w')
+    last_run_file.write(start)
+    last_run_file.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Precomputed recent and similar videos (see bfe_CERN_movie_similar).
+
+For each video collection, the index keeps the most recent records of
+the collection, and for each record of the collection, the records
+most similar to it (word similarity), so that the element does not
+search the whole collection each time a video is displayed.
+
+The index is updated for the records added, modified or deleted since
+the previous run, e.g. every few minutes from cron, and rebuilt from
+time to time (e.g. daily), since adding records also changes the
+records similar to the other ones:
+
+    $ python video_similar_index.py
+    $ python video_similar_index.py --all
+"""
+
+import os
+import sys
+import threading
+import time
+import zlib
+from optparse import OptionParser
+
+from invenio.config import CFG_CACHEDIR
+from invenio.dbquery import run_sql, serialize_via_marshal, \
+     deserialize_via_marshal
+from invenio.errorlib import register_exception
+from invenio.search_engine import perform_request_search, get_collection_reclist
+
+CFG_VIDEO_SIMILAR_INDEX_COLLECTIONS = ('Video Movies', 'Video Rushes')
+CFG_VIDEO_SIMILAR_INDEX_DIR = os.path.join(CFG_CACHEDIR, 'video_similar_index')
+CFG_VIDEO_SIMILAR_INDEX_LAST_RUN_FILE = os.path.join(CFG_VIDEO_SIMILAR_INDEX_DIR, 'last_run')
+# Number of recent and similar records kept per collection and record
+CFG_VIDEO_SIMILAR_INDEX_SIZE = 50
+
+# The recent records per collection, read once and read again when the
+# index changes: collection -> (mtime, recids)
+_recent_records = {}
+_recent_records_lock = threading.Lock()
+
+
+def _get_index_path(name, recid=None):
+    """
+    Returns the path of the file of the recent records of a collection,
+    or of the similar records of a record
+    """
+    if recid is None:
+        return os.path.join(CFG_VIDEO_SIMILAR_INDEX_DIR, 'recent',
+                            '%s.index' % name.replace(' ', '_').replace('/', '_'))
+    return os.path.join(CFG_VIDEO_SIMILAR_INDEX_DIR, 'similar', str(int(recid) / 1000),
+                        '%s.index' % recid)
+
+
+def _read_index(path):
+    """
+    Returns the value stored in the file, or None if there is none
+    """
+    try:
+        index_file = open(path, 'rb')
+        try:
+            return deserialize_via_marshal(index_file.read())
+        finally:
+            index_file.close()
+    except (IOError, EOFError, ValueError, TypeError, zlib.error):
+        return None
+
+
+def _write_index(path, value):
+    """
+    Stores the value in the file, or removes the file if value is None
+    """
+    if value is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    # Write to a temporary file first, so that the index is never read
+    # half written
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    index_file = open(tmp_path, 'wb')
+    try:
+        index_file.write(serialize_via_marshal(value))
+    finally:
+        index_file.close()
+    os.rename(tmp_path, path)
+
+
+def get_recent_records(collection, nb_max):
+    """
+    Returns the (at least nb_max + 1) most recent records of the
+    collection, as perform_request_search(c=collection, cc=collection)
+    would, or None if they are not in the index.
+    """
+    path = _get_index_path(collection)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    _recent_records_lock.acquire()
+    try:
+        if collection not in _recent_records or _recent_records[collection][0] != mtime:
+            _recent_records[collection] = (mtime, _read_index(path))
+        recids = _recent_records[collection][1]
+    finally:
+        _recent_records_lock.release()
+    if recids is None or (len(recids) <= nb_max and len(recids) == CFG_VIDEO_SIMILAR_INDEX_SIZE + 1):
+        # Not enough records in the index
+        return None
+    return list(recids)
+
+
+def get_similar_records(recid, collection, nb_max):
+    """
+    Returns the (at least nb_max + 1) records of the collection most
+    similar to the record, as perform_request_search(p='recid:RECID',
+    rm='wrd', c=collection, cc=collection) would, or None if they are
+    not in the index.
+    """
+    similar = _read_index(_get_index_path(collection, recid))
+    if similar is None or collection not in similar:
+        return None
+    recids = similar[collection]
+    if len(recids) <= nb_max and len(recids) == CFG_VIDEO_SIMILAR_INDEX_SIZE + 1:
+        # Not enough records in the index
+        return None
+    return list(recids)
+
+
+def build_recent_index(collection):
+    """
+    Computes and stores the most recent records of the collection
+    """
+    recids = perform_request_search(of="id", c=collection, cc=collection)
+    _write_index(_get_index_path(collection), list(recids[:CFG_VIDEO_SIMILAR_INDEX_SIZE + 1]))
+
+
+def build_similar_index(recid, collection_reclists):
+    """
+    Computes and stores the records similar to the record, in each of
+    the collections it belongs to.
+
+    @param collection_reclists: the records of each collection
+    """
+    similar = {}
+    for (collection, reclist) in collection_reclists.iteritems():
+        if recid in reclist:
+            recids = perform_request_search(of="id", p="recid:%s" % recid, rm="wrd",
+                                            c=collection, cc=collection)
+            similar[collection] = list(recids[:CFG_VIDEO_SIMILAR_INDEX_SIZE + 1])
+    _write_index(_get_index_path(None, recid), similar or None)
+
+
+def get_recids_modified_since(since):
+    """
+    Returns the ids of the records modified (or deleted) since given
+    date ('YYYY-MM-DD HH:MM:SS')
+    """
+    return [row[0] for row in run_sql("SELECT id FROM bibrec WHERE modification_date >= %s",
+                                      (since, ))]
+
+
+def main():
+    """
+    Updates the index with the records modified since the previous run,
+    or builds it from all the records.
+    """
+    parser = OptionParser(usage="%prog [--all]")
+    parser.add_option("-a", "--all", dest="all", action="store_true", default=False,
+                      help="build the index from all the records")
+    (options, dummy) = parser.parse_args()
+
+    start = time.strftime('%Y-%m-%d %H:%M:%S')
+    collection_reclists = {}
+    for collection in CFG_VIDEO_SIMILAR_INDEX_COLLECTIONS:
+        build_recent_index(collection)
+        collection_reclists[collection] = get_collection_reclist(collection)
+
+    if options.all:
+        recids = set()
+        for reclist in collection_reclists.values():
+            recids.update(reclist)
+    else:
+        try:
+            since = open(CFG_VIDEO_SIMILAR_INDEX_LAST_RUN_FILE).read().strip()
+        except IOError:
+            since = '0000-00-00 00:00:00'
+        recids = get_recids_modified_since(since)
+
+    nb_errors = 0
+    for recid in recids:
+        try:
+            build_similar_index(recid, collection_reclists)
+        except Exception:
+            register_exception(alert_admin=False,
+                               prefix="Could not index the videos similar to record %s" % recid)
+            nb_errors += 1
+    print "%s records indexed, %s errors" % (len(recids) - nb_errors, nb_errors)
+
+    last_run_file = open(CFG_VIDEO_SIMILAR_INDEX_LAST_RUN_FILE, 'w')
+    last_run_file.write(start)
+    last_run_file.close()
+    if nb_errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Content similarity of the video records, computed offline.
+
+The titles (245, 246), keywords (6531_, 653_1) and abstracts (520) of
+the video records (960__a:85) are turned into TF-IDF vectors, and the
+nearest neighbours of each record (cosine similarity) are computed with
+NumPy, by batches of records. They are stored in a single array file
+(one row per record: the recid, then the recids of its neighbours),
+which is memory-mapped when looking up the videos similar to a record.
+
+NumPy is needed to build and to read the neighbours. The neighbours are
+rebuilt by running this module, e.g. daily from cron:
+
+    $ python video_similarity.py
+"""
+
+import math
+import os
+import re
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+try:
+    import numpy
+    CFG_NUMPY_AVAILABLE = True
+except ImportError:
+    CFG_NUMPY_AVAILABLE = False
+
+from invenio.config import CFG_CACHEDIR
+from invenio.dbquery import run_sql
+
+CFG_VIDEO_SIMILARITY_FILE = os.path.join(CFG_CACHEDIR, 'video_similarity', 'neighbours.npy')
+# The fields the vectors are built from
+CFG_VIDEO_SIMILARITY_FIELDS = ('245__a', '245__b', '246__a', '6531_a', '653_1a', '520__a')
+# Number of neighbours kept per record
+CFG_VIDEO_SIMILARITY_NEIGHBOURS = 50
+# Words found in less records than this, or in more than this fraction
+# of the records, are ignored
+CFG_VIDEO_SIMILARITY_MIN_DF = 2
+CFG_VIDEO_SIMILARITY_MAX_DF = 0.05
+# Maximum number of similarity scores computed at once (memory usage)
+CFG_VIDEO_SIMILARITY_BATCH_SCORES = 4000000
+
+WORD_PATTERN = re.compile(r'[^\W\d_]{3,}', re.U)
+
+# The memory-mapped neighbours: [mtime, array, recids of the rows]
+_neighbours = [None, None, None]
+_neighbours_lock = threading.Lock()
+
+
+def tokenize(text):
+    """
+    Returns the words of the text, lower-cased
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'ignore')
+    return WORD_PATTERN.findall(text.lower())
+
+
+def get_video_texts():
+    """
+    Returns a dictionary with the ids of the video records as keys, and
+    the text of their titles, keywords and abstracts as values
+    """
+    recids = set([row[0] for row in run_sql(
+        "SELECT DISTINCT bb.id_bibrec FROM bibrec_bib96x bb, bib96x b "
+        "WHERE bb.id_bibxxx=b.id AND b.tag='960__a' AND b.value='85'")])
+    texts = dict([(recid, []) for recid in recids])
+    for tag in CFG_VIDEO_SIMILARITY_FIELDS:
+        table = 'bib%sx' % tag[:2]
+        for (recid, value) in run_sql("SELECT bb.id_bibrec, b.value FROM bibrec_%s bb, %s b "
+                                      "WHERE bb.id_bibxxx=b.id AND b.tag=%%s" % (table, table),
+                                      (tag, )):
+            if recid in texts:
+                texts[recid].append(value)
+    return dict([(recid, ' '.join(values)) for (recid, values) in texts.iteritems()])
+
+
+def build_tfidf_matrix(documents):
+    """
+    Returns the normalized TF-IDF vectors of the documents (list of lists
+    of words), as a sparse matrix in CSR form (indptr, indices, data),
+    together with the number of distinct words kept.
+    """
+    nb_documents = len(documents)
+    document_frequency = {}
+    for words in documents:
+        for word in set(words):
+            document_frequency[word] = document_frequency.get(word, 0) + 1
+    max_df = max(CFG_VIDEO_SIMILARITY_MIN_DF, CFG_VIDEO_SIMILARITY_MAX_DF * nb_documents)
+    vocabulary = {}
+    idf = []
+    for (word, frequency) in document_frequency.iteritems():
+        if CFG_VIDEO_SIMILARITY_MIN_DF <= frequency <= max_df:
+            vocabulary[word] = len(idf)
+            idf.append(math.log(float(nb_documents) / frequency))
+
+    indptr = [0]
+    indices = []
+    data = []
+    for words in documents:
+        term_frequency = {}
+        for word in words:
+            if word in vocabulary:
+                term = vocabulary[word]
+                term_frequency[term] = term_frequency.get(term, 0) + 1
+        weights = [(term, (1 + math.log(frequency)) * idf[term])
+                   for (term, frequency) in sorted(term_frequency.iteritems())]
+        norm = math.sqrt(sum([weight * weight for (dummy, weight) in weights])) or 1.0
+        for (term, weight) in weights:
+            indices.append(term)
+            data.append(weight / norm)
+        indptr.append(len(indices))
+    return ((numpy.array(indptr, dtype=numpy.int64),
+             numpy.array(indices, dtype=numpy.int32),
+             numpy.array(data, dtype=numpy.float32)),
+            len(idf))
+
+
+def _transpose(matrix, nb_columns):
+    """
+    Returns the transpose of a CSR matrix, in CSR form (i.e. the matrix in
+    CSC form): for each word, the documents that contain it
+    """
+    (indptr, indices, data) = matrix
+    rows = numpy.repeat(numpy.arange(len(indptr) - 1, dtype=numpy.int32), numpy.diff(indptr))
+    order = numpy.argsort(indices, kind='mergesort')
+    transposed_indptr = numpy.zeros(nb_columns + 1, dtype=numpy.int64)
+    transposed_indptr[1:] = numpy.cumsum(numpy.bincount(indices, minlength=nb_columns))
+    return (transposed_indptr, rows[order], data[order])
+
+
+def compute_neighbours(matrix, nb_columns, nb_neighbours=CFG_VIDEO_SIMILARITY_NEIGHBOURS):
+    """
+    Returns, for each row of the CSR matrix (normalized vectors), the
+    indices of the rows with the highest dot products (cosine
+    similarities), as an array of nb_neighbours columns padded with -1.
+
+    The scores of a batch of rows against all the rows are accumulated
+    word by word from the transposed matrix, so that only the rows that
+    share words with the batch are visited.
+    """
+    (indptr, indices, data) = matrix
+    (word_indptr, word_rows, word_data) = _transpose(matrix, nb_columns)
+    nb_rows = len(indptr) - 1
+    nb_neighbours = min(nb_neighbours, max(nb_rows - 1, 0))
+    neighbours = numpy.empty((nb_rows, nb_neighbours), dtype=numpy.int32)
+    neighbours.fill(-1)
+    if not nb_neighbours:
+        return neighbours
+    batch_size = max(1, CFG_VIDEO_SIMILARITY_BATCH_SCORES // nb_rows)
+
+    for start in xrange(0, nb_rows, batch_size):
+        end = min(start + batch_size, nb_rows)
+        # The words of the batch, and the rows that contain them
+        batch_rows = numpy.repeat(numpy.arange(end - start), numpy.diff(indptr[start:end + 1]))
+        batch_words = indices[indptr[start]:indptr[end]]
+        batch_weights = data[indptr[start]:indptr[end]]
+        lengths = word_indptr[batch_words + 1] - word_indptr[batch_words]
+        total = lengths.sum()
+        offsets = numpy.arange(total) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        positions = numpy.repeat(word_indptr[batch_words], lengths) + offsets
+        scores = numpy.bincount(numpy.repeat(batch_rows, lengths) * nb_rows + word_rows[positions],
+                                weights=numpy.repeat(batch_weights, lengths) * word_data[positions],
+                                minlength=(end - start) * nb_rows).reshape((end - start, nb_rows))
+        # A record is not its own neighbour
+        scores[numpy.arange(end - start), numpy.arange(start, end)] = 0
+        best = numpy.argpartition(-scores, nb_neighbours - 1, axis=1)[:, :nb_neighbours]
+        best_scores = scores[numpy.arange(end - start)[:, None], best]
+        order = numpy.argsort(-best_scores, axis=1, kind='mergesort')
+        best = best[numpy.arange(end - start)[:, None], order]
+        best_scores = best_scores[numpy.arange(end - start)[:, None], order]
+        best[best_scores <= 0] = -1
+        neighbours[start:end] = best
+    return neighbours
+
+
+def build_video_similarity(texts):
+    """
+    Computes the neighbours of the records and stores them.
+
+    @param texts: dictionary with the recids as keys and the texts of the
+                  records as values (see get_video_texts)
+    """
+    recids = sorted(texts)
+    (matrix, nb_words) = build_tfidf_matrix([tokenize(texts[recid]) for recid in recids])
+    neighbours = compute_neighbours(matrix, nb_words)
+    recids = numpy.array(recids, dtype=numpy.int32)
+    # Replace the indices of the rows by the recids
+    table = numpy.zeros((len(recids), neighbours.shape[1] + 1), dtype=numpy.int32)
+    table[:, 0] = recids
+    table[:, 1:] = numpy.where(neighbours >= 0, recids[neighbours], -1)
+
+    if not os.path.exists(os.path.dirname(CFG_VIDEO_SIMILARITY_FILE)):
+        os.makedirs(os.path.dirname(CFG_VIDEO_SIMILARITY_FILE))
+    # Write to a temporary file first, so that the file is never read
+    # half written
+    tmp_path = '%s.%s.tmp' % (CFG_VIDEO_SIMILARITY_FILE, os.getpid())
+    tmp_file = open(tmp_path, 'wb')
+    try:
+        numpy.save(tmp_file, table)
+    finally:
+        tmp_file.close()
+    os.rename(tmp_path, CFG_VIDEO_SIMILARITY_FILE)
+
+
+def _get_neighbours():
+    """
+    Returns the memory-mapped neighbours and the recids of their rows,
+    mapped again when the file changes, or (None, None) if they are not
+    available
+    """
+    if not CFG_NUMPY_AVAILABLE:
+        return (None, None)
+    try:
+        mtime = os.path.getmtime(CFG_VIDEO_SIMILARITY_FILE)
+    except OSError:
+        return (None, None)
+    _neighbours_lock.acquire()
+    try:
+        if _neighbours[0] != mtime:
+            try:
+                table = numpy.load(CFG_VIDEO_SIMILARITY_FILE, mmap_mode='r')
+                _neighbours[1:] = [table, numpy.array(table[:, 0])]
+            except (IOError, ValueError):
+                _neighbours[1:] = [None, None]
+            _neighbours[0] = mtime
+        return (_neighbours[1], _neighbours[2])
+    finally:
+        _neighbours_lock.release()
+
+
+def get_similar_videos(recid):
+    """
+    Returns the ids of the videos most similar to the record, the most
+    similar first, or None if the similarities are not available or were
+    computed before the record was created.
+    """
+    (table, recids) = _get_neighbours()
+    if table is None:
+        return None
+    recid = int(recid)
+    row = numpy.searchsorted(recids, recid)
+    if row >= len(recids) or recids[row] != recid:
+        return None
+    return [neighbour for neighbour in table[row, 1:].tolist() if neighbour >= 0]
+
+
+def main():
+    """
+    Computes the neighbours of all the video records.
+    """
+    parser = OptionParser(usage="%prog")
+    parser.parse_args()
+    if not CFG_NUMPY_AVAILABLE:
+        print "NumPy is needed to compute the similar videos"
+        sys.exit(1)
+    start = time.time()
+    texts = get_video_texts()
+    build_video_similarity(texts)
+    print "Similar videos of %s records computed in %.1f s" % (len(texts), time.time() - start)
+
+
+if __name__ == '__main__':
+    main()